@@ -1,19 +1,27 @@
 import os
 import uuid
+import socket
 import json
+import gzip
+import base64
+import hashlib
+import collections
 import logging
+import math
 import asyncio
 import threading
 from datetime import datetime, timedelta
+from email.utils import formatdate
 from typing import Optional, List
 
-import socket
 import time
+import bisect
 import ipaddress
-import requests
-import redis
+import httpx
+import redis.asyncio
+from prometheus_client import Counter, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
@@ -22,9 +30,66 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# --- Metrics ---
+# Prometheus metrics served at /metrics. Each worker process has its own registry, so with several
+# uvicorn workers set PROMETHEUS_MULTIPROC_DIR (in the process environment, to a directory emptied
+# before start): every worker then writes its samples there and /metrics aggregates all of them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+REQUEST_LATENCY = Histogram("honeyapi_request_duration_seconds", "HTTP request latency by route",
+                            ["route", "method", "status"])
+REDIS_COMMANDS = Counter("honeyapi_redis_commands_total", "Redis commands sent, pipelined ones included", ["command"])
+REDIS_LATENCY = Histogram("honeyapi_redis_roundtrip_seconds", "Redis round-trip time of one command or one pipeline",
+                          ["kind"], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+OSINT_FEED_DURATION = Histogram("honeyapi_osint_feed_seconds", "OSINT feed processing time per phase",
+                                ["feed", "phase"], buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+OSINT_FEED_NEW_IPS = Counter("honeyapi_osint_feed_new_ips_total", "New IPs stored from an OSINT feed", ["feed"])
+OSINT_FEED_RUNS = Counter("honeyapi_osint_feed_runs_total", "OSINT feed runs by outcome", ["feed", "status"])
+JOB_DURATION = Histogram("honeyapi_job_duration_seconds", "Duration of background jobs",
+                         ["job"], buckets=(.01, .05, .1, .5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+EVENT_LOOP_LAG = Histogram("honeyapi_event_loop_lag_seconds", "Delay of a scheduled wake-up on the event loop",
+                           buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+EVENT_LOOP_LAG_INTERVAL = 0.5 # Seconds between event loop lag probes
+
+class InstrumentedPipeline(redis.asyncio.client.Pipeline):
+    """Pipeline that counts its queued commands and times the round-trip of execute()."""
+    async def execute(self, raise_on_error: bool = True):
+        for args, _ in self.command_stack:
+            REDIS_COMMANDS.labels(str(args[0]).upper()).inc()
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("pipeline").observe(time.perf_counter() - start)
+
+class InstrumentedRedis(redis.asyncio.Redis):
+    """Redis client that counts and times every command (pipelines via InstrumentedPipeline)."""
+    async def execute_command(self, *args, **options):
+        REDIS_COMMANDS.labels(str(args[0]).upper()).inc()
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels("command").observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+async def monitor_event_loop_lag():
+    """Measures how late a timed sleep wakes up; anything blocking the loop shows up here."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL))
+
 # --- Configuration ---
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-REDIS_CLIENT = redis.from_url(REDIS_URL, decode_responses=True)
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5")) # Seconds to wait for a free connection
+# Shared asyncio client: Redis round-trips never block the event loop
+REDIS_POOL = redis.asyncio.BlockingConnectionPool.from_url(
+    REDIS_URL, decode_responses=True, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT
+)
+REDIS_CLIENT = InstrumentedRedis(connection_pool=REDIS_POOL)
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin")
 SESSION_SECRET_KEY = os.getenv("SESSION_SECRET_KEY", "change-me-at-all-costs")
 GLOBAL_BLACKLIST_URL = "https://raw.githubusercontent.com/derlemue/honey-scan/refs/heads/main/sidecar/scan-blacklist.conf"
@@ -36,6 +101,15 @@ app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET_KEY)
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def metrics():
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    # Reads the sample files of all workers
+    return Response(content=await asyncio.to_thread(generate_latest, registry), media_type=CONTENT_TYPE_LATEST)
+
 @app.middleware("http")
 async def fix_double_slashes(request: Request, call_next):
     if "//" in request.scope["path"]:
@@ -43,6 +117,15 @@ async def fix_double_slashes(request: Request, call_next):
     response = await call_next(request)
     return response
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Route template (e.g. /list/entries), never the raw path, to keep label cardinality bounded
+    route = request.scope.get("route")
+    REQUEST_LATENCY.labels(getattr(route, "path", "unmatched"), request.method, response.status_code).observe(time.perf_counter() - start)
+    return response
+
 templates = Jinja2Templates(directory="app/templates")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
@@ -73,6 +156,10 @@ def log_logo():
 class HFishWebhook(BaseModel):
     attack_ip: str
 
+class ReputationBatchRequest(BaseModel):
+    resource: Optional[str] = None # ThreatBook-style, comma-separated
+    resources: List[str] = []
+
 # --- Database Keys ---
 KEY_WHITELIST = "ti:whitelist"
 KEY_BLACKLIST = "ti:blacklist"
@@ -82,6 +169,69 @@ KEY_API_KEYS = "ti:api_keys"
 KEY_API_KEYS_V2 = "ti:api_keys_v2" # Hash: key -> name
 KEY_STATS_LOCAL = "stats:total_local"
 KEY_STATS_OSINT = "stats:total_osint"
+KEY_STATS_CLOUD_NEW = "stats:cloud_new_24h" # New local IPs in the current ~24h window
+KEY_LISTS_GENERATION = "ti:lists:generation" # Bumped on every whitelist/blacklist change
+KEY_BLACKLIST_STAGING = "ti:blacklist:staging" # Built by the file reload, then RENAMEd over KEY_BLACKLIST
+KEY_BLACKLIST_SOURCE_HASH = "ti:blacklist:source_hash" # sha256 of the config files last loaded
+KEY_BLACKLIST_APPLIED = "ti:blacklist:applied" # Blacklist rules already purged from stored indicators
+KEY_API_KEYS_GENERATION = "ti:api_keys:generation" # Bumped on every API key generate/delete
+KEY_SCHEDULER_LEASE = "ti:scheduler:lease" # "{fencing token}:{node}", expires unless the leader renews it
+KEY_SCHEDULER_FENCE = "ti:scheduler:fence" # Counter: fencing token of the latest lease
+KEY_SCHEDULER_JOBS = "ti:scheduler:jobs" # Hash: job name -> JSON of its last run
+KEY_BAN_FEED = "ti:ban_feed" # Hash: generation, meta (JSON), gzip:{etag} -> base64 feed artifact
+
+# Max number of IPs accepted by one batch reputation request
+REPUTATION_BATCH_MAX = int(os.getenv("REPUTATION_BATCH_MAX", "10000"))
+
+# Max number of attack IPs accepted by one /webhook/batch request
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", "10000"))
+
+# Max size of the pasted "rules" field of a /list/import form (file uploads are streamed)
+LIST_IMPORT_MAX_FIELD_BYTES = int(os.getenv("LIST_IMPORT_MAX_FIELD_BYTES", str(64 * 1024 * 1024)))
+
+# Optional write-behind mode for /webhook: IPs are acknowledged immediately and written in coalesced batches
+WEBHOOK_WRITE_BEHIND = os.getenv("WEBHOOK_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv("WEBHOOK_FLUSH_INTERVAL_MS", "250")) / 1000
+WEBHOOK_FLUSH_MAX_ITEMS = int(os.getenv("WEBHOOK_FLUSH_MAX_ITEMS", "1000")) # Flush early once this many IPs are pending
+WEBHOOK_BUFFER_MAX = int(os.getenv("WEBHOOK_BUFFER_MAX", "50000")) # Backpressure: callers wait for a flush beyond this
+
+# Max staleness (seconds) of per-worker caches keyed by a generation counter (lists, API keys)
+GENERATION_POLL_INTERVAL = float(os.getenv("GENERATION_POLL_INTERVAL", "2"))
+
+# API reachability prober behind the "api_up" flag of the stats endpoints (host:port, comma-separated)
+HEALTH_PROBE_TARGETS = os.getenv("HEALTH_PROBE_TARGETS", "api.sec.lemue.org:443,127.0.0.1:8080")
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "15"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "2"))
+
+# Dashboard/status stats are rebuilt by one background task and pushed to SSE subscribers
+STATS_SNAPSHOT_INTERVAL = float(os.getenv("STATS_SNAPSHOT_INTERVAL", "5"))
+STATS_STREAM_KEEPALIVE = 15 # Seconds between SSE keepalive comments
+
+# Precomputed banned-IP feed (/feed/banned_ips.txt): rebuilt by the scheduler leader after changes
+# (at most every FEED_EXPORT_MIN_INTERVAL seconds) and at least every FEED_EXPORT_INTERVAL seconds
+FEED_EXPORT_INTERVAL = float(os.getenv("FEED_EXPORT_INTERVAL", "900"))
+FEED_EXPORT_MIN_INTERVAL = float(os.getenv("FEED_EXPORT_MIN_INTERVAL", "60"))
+FEED_EXPORT_DIR = os.getenv("FEED_EXPORT_DIR", "") # Optional: also write the .gz artifacts here (e.g. for nginx gzip_static)
+# The feed is public by default, like the feed URL scripts/client_banned_ips.sh polls without a key
+FEED_REQUIRE_API_KEY = os.getenv("FEED_REQUIRE_API_KEY", "false").lower() in ("1", "true", "yes")
+
+# Per-worker Bloom filter of stored indicator IPs: reputation lookups of clean IPs skip Redis
+INDICATOR_FILTER_ENABLED = os.getenv("INDICATOR_FILTER_ENABLED", "true").lower() in ("1", "true", "yes")
+INDICATOR_FILTER_FP_RATE = float(os.getenv("INDICATOR_FILTER_FP_RATE", "0.01"))
+INDICATOR_FILTER_MIN_CAPACITY = int(os.getenv("INDICATOR_FILTER_MIN_CAPACITY", "100000"))
+INDICATOR_FILTER_REBUILD_INTERVAL = float(os.getenv("INDICATOR_FILTER_REBUILD_INTERVAL", "3600")) # Drops expired IPs
+
+# API key verification cache
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "60"))
+API_KEY_NEGATIVE_CACHE_TTL = float(os.getenv("API_KEY_NEGATIVE_CACHE_TTL", "10"))
+API_KEY_CACHE_MAX_ENTRIES = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", "10000"))
+
+# Reputation result cache for hot IPs (0 disables it)
+REPUTATION_CACHE_TTL = float(os.getenv("REPUTATION_CACHE_TTL", "5"))
+REPUTATION_CACHE_MAX_ENTRIES = int(os.getenv("REPUTATION_CACHE_MAX_ENTRIES", "50000"))
+
+# Periodic jobs run on the one process holding the scheduler lease; others take over within the TTL
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "30"))
 
 # --- Auth Dependency ---
 def get_current_user(request: Request):
@@ -96,6 +246,7 @@ def is_ip_in_cidr_list(ip: str, blacklist_members: set) -> bool:
     """
     Check if an IP is in a provided set of members (exact match or CIDR).
     Optimized to avoid repeated Redis calls.
+    Linear scan over all members - hot paths use CIDRIndex instead.
     """
     # 1. Try exact match first
     if ip in blacklist_members:
@@ -119,346 +270,2406 @@ def is_ip_in_cidr_list(ip: str, blacklist_members: set) -> bool:
             
     return False
 
-def get_ip_reputation(ip: str):
-    blacklist_members = REDIS_CLIENT.smembers(KEY_BLACKLIST)
-    # 1. Whitelist
-    if is_ip_in_cidr_list(ip, REDIS_CLIENT.smembers(KEY_WHITELIST)):
-        return "clean", ["whitelist"]
-    
-    # 2. Blacklist
-    if is_ip_in_cidr_list(ip, blacklist_members):
-        return "high", ["permanent blacklist"]
-    
+def parse_ip_range(member: str):
+    """(version, first, last) integer range of an IP or CIDR, or None if it is invalid."""
+    try:
+        network = ipaddress.ip_network(member.strip(), strict=False)
+    except ValueError:
+        return None
+    start = int(network.network_address)
+    return network.version, start, start + network.num_addresses - 1
+
+def merge_ranges(ranges):
+    """Merges sorted (start, end) ranges into non-overlapping, non-adjacent starts/ends lists."""
+    starts, ends = [], []
+    for start, end in ranges:
+        if ends and start <= ends[-1] + 1:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+class CIDRIndex:
+    """
+    Lookup index and range-union engine for a set of IPs/CIDRs.
+    All rules are parsed once and merged into sorted, non-overlapping integer
+    ranges per IP version, so a membership check is a single bisect (O(log n))
+    instead of re-parsing every rule on every call. Single rules can be added or
+    removed in place, keeping the number of covered unique addresses exact
+    (overlapping rules count once) without materializing any address.
+    add()/remove() find their position by bisect but insert into / splice plain
+    sorted lists, so an edit is O(n) in the number of rules (a memmove, cheap at
+    dashboard-edit rates; far below rebuilding the index from the set).
+    """
+    __slots__ = ("_starts", "_ends", "_rules", "_rule_members", "_covered", "rule_count")
+
+    def __init__(self, members=()):
+        spans = {4: [], 6: []}
+        self._rule_members = {} # (version, start, end) -> rule strings with that range
+        self.rule_count = 0
+        for member in members:
+            parsed = parse_ip_range(member)
+            if parsed is None:
+                continue # Ignore invalid entries
+            if parsed not in self._rule_members:
+                spans[parsed[0]].append(parsed[1:])
+                self._rule_members[parsed] = set()
+            elif member in self._rule_members[parsed]:
+                continue
+            self._rule_members[parsed].add(member)
+            self.rule_count += 1
+
+        self._starts = {}
+        self._ends = {}
+        self._rules = {}
+        self._covered = {}
+        for version, ranges in spans.items():
+            ranges.sort()
+            self._rules[version] = ranges
+            self._starts[version], self._ends[version] = merge_ranges(ranges)
+            self._covered[version] = sum(end - start + 1 for start, end in zip(self._starts[version], self._ends[version]))
+
+    def __len__(self):
+        return self.rule_count
+
+    def __contains__(self, ip) -> bool:
+        try:
+            target_ip = ipaddress.ip_address(ip)
+        except ValueError:
+            return False # Invalid IP input
+        starts = self._starts[target_ip.version]
+        pos = bisect.bisect_right(starts, int(target_ip)) - 1
+        return pos >= 0 and int(target_ip) <= self._ends[target_ip.version][pos]
+
+    def covers(self, member: str) -> bool:
+        """True if every address of the IP/CIDR is already covered by the rules."""
+        parsed = parse_ip_range(member)
+        if parsed is None:
+            return False
+        version, start, end = parsed
+        pos = bisect.bisect_right(self._starts[version], start) - 1
+        return pos >= 0 and end <= self._ends[version][pos]
+
+    def overlapping(self, member: str) -> List[str]:
+        """Rules that share at least one address with the IP/CIDR (containing, contained or partial)."""
+        parsed = parse_ip_range(member)
+        if parsed is None:
+            return []
+        version, start, end = parsed
+        starts, ends, rules = self._starts[version], self._ends[version], self._rules[version]
+        # Only rules inside merged ranges that overlap the query can match
+        lo = bisect.bisect_left(ends, start)
+        hi = bisect.bisect_right(starts, end)
+        if lo >= hi:
+            return []
+        first = bisect.bisect_left(rules, (starts[lo], -1))
+        last = bisect.bisect_right(rules, (end, float("inf")))
+        matches = []
+        for rule_start, rule_end in rules[first:last]:
+            if rule_end >= start:
+                matches.extend(self._rule_members[(version, rule_start, rule_end)])
+        return sorted(matches)
+
+    def address_count(self, version: Optional[int] = None) -> int:
+        """Unique addresses covered by all rules (or one IP version)."""
+        if version:
+            return self._covered[version]
+        return self._covered[4] + self._covered[6]
+
+    def _replace(self, version, lo, hi, starts, ends):
+        """Replaces merged ranges lo..hi-1 of one version and keeps the covered count in sync."""
+        old_starts, old_ends = self._starts[version], self._ends[version]
+        self._covered[version] += (sum(end - start + 1 for start, end in zip(starts, ends))
+                                   - sum(old_ends[i] - old_starts[i] + 1 for i in range(lo, hi)))
+        old_starts[lo:hi] = starts
+        old_ends[lo:hi] = ends
+
+    def add(self, member: str) -> bool:
+        """Adds one rule. Returns False if it is invalid."""
+        parsed = parse_ip_range(member)
+        if parsed is None:
+            return False
+        if member in self._rule_members.get(parsed, ()):
+            return True
+        self.rule_count += 1
+        if parsed in self._rule_members:
+            self._rule_members[parsed].add(member)
+            return True # Same range already covered by an equivalent rule
+        self._rule_members[parsed] = {member}
+        version, start, end = parsed
+        bisect.insort(self._rules[version], (start, end))
+
+        # Merged ranges overlapping or touching [start, end] fold into one
+        starts, ends = self._starts[version], self._ends[version]
+        lo = bisect.bisect_left(ends, start - 1)
+        hi = bisect.bisect_right(starts, end + 1)
+        if lo < hi:
+            start, end = min(start, starts[lo]), max(end, ends[hi - 1])
+        self._replace(version, lo, hi, [start], [end])
+        return True
+
+    def remove(self, member: str) -> bool:
+        """Removes one rule. Returns False if it is invalid or not present."""
+        parsed = parse_ip_range(member)
+        if parsed is None or member not in self._rule_members.get(parsed, ()):
+            return False
+        self.rule_count -= 1
+        self._rule_members[parsed].discard(member)
+        if self._rule_members[parsed]:
+            return True # An equivalent rule still covers the range
+        del self._rule_members[parsed]
+        version, start, end = parsed
+        rules = self._rules[version]
+        del rules[bisect.bisect_left(rules, (start, end))]
+
+        # Re-merge only the remaining rules of the merged range that contained it
+        starts, ends = self._starts[version], self._ends[version]
+        pos = bisect.bisect_right(starts, start) - 1
+        first = bisect.bisect_left(rules, (starts[pos], -1))
+        last = bisect.bisect_right(rules, (ends[pos], float("inf")))
+        new_starts, new_ends = merge_ranges(rules[first:last])
+        self._replace(version, pos, pos + 1, new_starts, new_ends)
+        return True
+
+class ListSnapshot:
+    """
+    Per-worker copy of the whitelist/blacklist, keyed by KEY_LISTS_GENERATION.
+    Hot paths read only from here (zero Redis round-trips); the snapshot is
+    reloaded only when the generation counter changes.
+    """
+    def __init__(self):
+        self.generation = None
+        self.whitelist = set()
+        self.blacklist = set()
+        self.whitelist_index = CIDRIndex()
+        self.blacklist_index = CIDRIndex()
+        self.loaded_at = 0.0
+        self._sorted = {} # list_type -> (generation, sorted members)
+
+    def sorted_members(self, list_type: str) -> List[str]:
+        """Members of one list in sorted order, rebuilt at most once per generation (for paging/prefix search)."""
+        cached = self._sorted.get(list_type)
+        if cached is None or cached[0] != self.generation:
+            cached = (self.generation, sorted(getattr(self, list_type)))
+            self._sorted[list_type] = cached
+        return cached[1]
+
+LIST_SNAPSHOT = ListSnapshot()
+
+async def refresh_list_snapshot(force: bool = False) -> bool:
+    """Reloads LIST_SNAPSHOT if the list generation changed. Returns True if reloaded."""
+    generation = await REDIS_CLIENT.get(KEY_LISTS_GENERATION)
+    if not force and LIST_SNAPSHOT.loaded_at and generation == LIST_SNAPSHOT.generation:
+        return False
+
+    # Read generation and both sets in one transaction so they are consistent
+    pipe = REDIS_CLIENT.pipeline(transaction=True)
+    pipe.get(KEY_LISTS_GENERATION)
+    pipe.smembers(KEY_WHITELIST)
+    pipe.smembers(KEY_BLACKLIST)
+    generation, whitelist, blacklist = await pipe.execute()
+
+    LIST_SNAPSHOT.whitelist = whitelist
+    LIST_SNAPSHOT.blacklist = blacklist
+    LIST_SNAPSHOT.whitelist_index = CIDRIndex(whitelist)
+    LIST_SNAPSHOT.blacklist_index = CIDRIndex(blacklist)
+    LIST_SNAPSHOT.generation = generation
+    LIST_SNAPSHOT.loaded_at = time.time()
+    logger.info(f"{C_BLUE}[CACHE:LISTS] Snapshot reloaded (generation {generation}): {len(whitelist)} whitelist, {len(blacklist)} blacklist rules{C_RESET}")
+    return True
+
+LIST_STATS_KEYS = {"blacklist": "stats:blacklist_ip_count", "whitelist": "stats:whitelist_ip_count"}
+
+# KEYS: list set, KEY_LISTS_GENERATION, KEY_BLACKLIST_SOURCE_HASH
+# ARGV: 'add' or 'remove', member, '1' to drop the source hash (blacklist edits)
+# Returns the new list generation, or 0 if the set did not change.
+LIST_EDIT_LUA = """
+local changed
+if ARGV[1] == 'add' then
+    changed = redis.call('SADD', KEYS[1], ARGV[2])
+else
+    changed = redis.call('SREM', KEYS[1], ARGV[2])
+end
+if changed == 0 then
+    return 0
+end
+if ARGV[3] == '1' then
+    redis.call('UNLINK', KEYS[3]) -- Next file reload rebuilds the set, as before
+end
+return redis.call('INCR', KEYS[2])
+"""
+
+# KEYS: KEY_LISTS_GENERATION, stats keys...   ARGV: generation the counts were computed at, counts...
+# Writes the counts only if no list changed since, so a slower worker cannot overwrite newer counts.
+SET_LIST_STATS_LUA = """
+if (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i])
+end
+return 1
+"""
+
+LIST_EDIT_SCRIPT = REDIS_CLIENT.register_script(LIST_EDIT_LUA)
+SET_LIST_STATS_SCRIPT = REDIS_CLIENT.register_script(SET_LIST_STATS_LUA)
+
+async def store_list_stats(list_types) -> bool:
+    """
+    Stores the unique IP counts of the given lists from LIST_SNAPSHOT, fenced on
+    its generation. Returns False if the lists changed in the meantime; the
+    worker that made that change stores its own, newer counts.
+    """
+    indexes = [getattr(LIST_SNAPSHOT, f"{list_type}_index") for list_type in list_types]
+    return bool(await SET_LIST_STATS_SCRIPT(
+        keys=[KEY_LISTS_GENERATION] + [LIST_STATS_KEYS[list_type] for list_type in list_types],
+        args=[LIST_SNAPSHOT.generation or ""] + [index.address_count() for index in indexes]))
+
+async def apply_list_edit(list_type: str, member: str, added: bool) -> bool:
+    """
+    Adds or removes one whitelist/blacklist rule. The set change and the list
+    generation bump are one script, so every change gets its own generation.
+    The edit is then applied to the local snapshot in place and the list's new
+    unique IP count stored (fenced on that generation). Falls back to a full
+    reload if the local snapshot was already behind another worker's edit.
+    Returns False if the set did not change.
+    """
+    key = KEY_BLACKLIST if list_type == "blacklist" else KEY_WHITELIST
+    generation = await LIST_EDIT_SCRIPT(
+        keys=[key, KEY_LISTS_GENERATION, KEY_BLACKLIST_SOURCE_HASH],
+        args=["add" if added else "remove", member, "1" if list_type == "blacklist" else "0"])
+    if not generation:
+        return False
+    if int(LIST_SNAPSHOT.generation or 0) != generation - 1:
+        await refresh_list_snapshot(force=True)
+    else:
+        members = getattr(LIST_SNAPSHOT, list_type)
+        index = getattr(LIST_SNAPSHOT, f"{list_type}_index")
+        if added:
+            members.add(member)
+            index.add(member)
+        else:
+            members.discard(member)
+            index.remove(member)
+        LIST_SNAPSHOT.generation = str(generation)
+    await store_list_stats([list_type])
+    if list_type == "whitelist":
+        await log_change_reset("whitelist")
+    return True
+
+class APIKeyCache:
+    """
+    Per-worker cache of API key verification results.
+    Valid keys are cached for API_KEY_CACHE_TTL, invalid ones (negative caching)
+    for API_KEY_NEGATIVE_CACHE_TTL. The cache is bounded (LRU) so floods of junk
+    keys cannot grow it without limit, and it is cleared whenever
+    KEY_API_KEYS_GENERATION changes.
+    """
+    def __init__(self, ttl: float, negative_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.generation = None
+        self._entries = collections.OrderedDict() # key -> (valid, expires_at)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[bool]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if entry[0]:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return entry[0]
+
+    def put(self, key: str, valid: bool):
+        ttl = self.ttl if valid else self.negative_ttl
+        self._entries[key] = (valid, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.invalidations += 1
+
+    def sync_generation(self, generation):
+        """Drops all entries if API keys changed since the last check."""
+        if generation != self.generation:
+            if self.generation is not None:
+                logger.info(f"{C_BLUE}[CACHE:API_KEYS] API keys changed (generation {generation}), cache cleared{C_RESET}")
+            self.clear()
+            self.generation = generation
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+API_KEY_CACHE = APIKeyCache(API_KEY_CACHE_TTL, API_KEY_NEGATIVE_CACHE_TTL, API_KEY_CACHE_MAX_ENTRIES)
+
+class ReputationCache:
+    """
+    Per-worker LRU of reputation results ((severity, judgments) per IP) for hot IPs that
+    are queried over and over. Entries live for REPUTATION_CACHE_TTL, the whole cache is
+    dropped when the list snapshot generation changes, and single IPs are dropped when an
+    indicator change for them is written here or read from KEY_CHANGES by the indicator
+    filter (with the filter disabled, changes made by other workers show up after the TTL).
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation = None
+        self.version = 0 # Bumped on every invalidation, so lookups that raced one are not cached
+        self._entries = collections.OrderedDict() # ip -> (result, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.ip_invalidations = 0
+
+    def get(self, ip: str):
+        if self.ttl <= 0:
+            return None
+        if self.generation != LIST_SNAPSHOT.generation:
+            self.clear()
+            self.generation = LIST_SNAPSHOT.generation
+        entry = self._entries.get(ip)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(ip)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, ip: str, result, version: int):
+        """Stores a result computed while the cache was at `version` (skipped if it was invalidated since)."""
+        if self.ttl <= 0 or version != self.version:
+            return
+        self._entries[ip] = (result, time.monotonic() + self.ttl)
+        self._entries.move_to_end(ip)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, ips: List[str]):
+        if not ips:
+            return
+        self.version += 1
+        for ip in ips:
+            if self._entries.pop(ip, None) is not None:
+                self.ip_invalidations += 1
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "ip_invalidations": self.ip_invalidations,
+        }
+
+REPUTATION_CACHE = ReputationCache(REPUTATION_CACHE_TTL, REPUTATION_CACHE_MAX_ENTRIES)
+
+async def bump_api_keys_generation():
+    """Invalidates cached API key verifications in all workers."""
+    API_KEY_CACHE.sync_generation(str(await REDIS_CLIENT.incr(KEY_API_KEYS_GENERATION)))
+
+async def generation_watcher():
+    """Polls the generation counters so every worker sees list and API key changes within GENERATION_POLL_INTERVAL."""
+    while True:
+        await asyncio.sleep(GENERATION_POLL_INTERVAL)
+        try:
+            lists_generation, api_keys_generation = await REDIS_CLIENT.mget(KEY_LISTS_GENERATION, KEY_API_KEYS_GENERATION)
+            if lists_generation != LIST_SNAPSHOT.generation:
+                await refresh_list_snapshot(force=True)
+            API_KEY_CACHE.sync_generation(api_keys_generation)
+        except Exception as e:
+            logger.error(f"{C_RED}[CACHE] Error polling generation counters: {e}{C_RESET}")
+
+class HealthProber:
+    """
+    Checks TCP reachability of the API from a background task, so the stats
+    endpoints only read the cached result instead of opening sockets per request.
+    The API counts as up if any target accepts a connection: the public endpoint
+    first, the local listener as a fallback.
+    """
+    def __init__(self, targets: str, interval: float, timeout: float):
+        self.targets = []
+        for target in targets.split(","):
+            host, _, port = target.strip().rpartition(":")
+            if host and port.isdigit():
+                self.targets.append((host.strip("[]"), int(port)))
+        self.interval = interval
+        self.timeout = timeout
+        self.up = False
+        self.latency_ms = None
+        self.checked_at = None
+        self.changed_at = None
+        self.results = {}
+
+    async def probe(self, host: str, port: int):
+        """Latency in ms of a TCP connect to host:port, or None if it failed."""
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        latency = (time.perf_counter() - start) * 1000
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass # The probe already succeeded; only the socket cleanup failed
+        return latency
+
+    async def check(self) -> bool:
+        latencies = await asyncio.gather(*(self.probe(host, port) for host, port in self.targets))
+        self.results = {f"{host}:{port}": latency for (host, port), latency in zip(self.targets, latencies)}
+        reachable = [latency for latency in latencies if latency is not None]
+        up = bool(reachable)
+        if up != self.up or self.changed_at is None:
+            self.changed_at = datetime.now().isoformat()
+            if up:
+                logger.info(f"{C_GREEN}[HEALTH] API is reachable.{C_RESET}")
+            else:
+                logger.warning(f"{C_RED}[HEALTH] API is unreachable on all probe targets.{C_RESET}")
+        self.up = up
+        self.latency_ms = round(reachable[0], 2) if reachable else None
+        self.checked_at = datetime.now().isoformat()
+        return up
+
+    async def run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"{C_RED}[HEALTH] Probe error: {e}{C_RESET}")
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        return {
+            "up": self.up,
+            "latency_ms": self.latency_ms,
+            "checked_at": self.checked_at,
+            "changed_at": self.changed_at,
+            "targets": {target: round(latency, 2) if latency is not None else None for target, latency in self.results.items()},
+        }
+
+HEALTH_PROBER = HealthProber(HEALTH_PROBE_TARGETS, HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT)
+
+class StatsSnapshot:
+    """
+    Per-worker copy of the dashboard/status counters, rebuilt every interval by one
+    background task with a single pipeline. Stats endpoints and SSE streams only read
+    from here, so their Redis cost does not grow with the number of open viewers.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.data = {}
+        self.updated_at = 0.0
+        self.changed = None # asyncio.Event, set and replaced whenever the data changes
+        self.version = 0 # Bumped whenever the data changes
+        self.subscribers = 0
+
+    async def refresh(self) -> bool:
+        """Rebuilds the snapshot. Returns True (and wakes subscribers) if anything changed."""
+        pipe = REDIS_CLIENT.pipeline(transaction=False)
+        pipe.mget(KEY_STATS_LOCAL, KEY_STATS_OSINT, "stats:blacklist_ip_count", "stats:whitelist_ip_count",
+                  "stats:last_osint_count", KEY_STATS_CLOUD_NEW)
+        pipe.scard(KEY_BLACKLIST)
+        pipe.scard(KEY_WHITELIST)
+        counters, blacklist_count, whitelist_count = await pipe.execute()
+        local_ips, osint_ips, blacklist_ips, whitelist_ips, last_osint_count, cloud_new_24h = (int(value or 0) for value in counters)
+        data = {
+            "local": local_ips,
+            "osint": osint_ips,
+            "blacklist": blacklist_count,
+            "blacklist_ips": blacklist_ips,
+            "whitelist": whitelist_count,
+            "whitelist_ips": whitelist_ips,
+            "api_up": HEALTH_PROBER.up,
+            "last_osint_count": last_osint_count,
+            "last_cloud_count": cloud_new_24h,
+        }
+        self.updated_at = time.time()
+        if data == self.data:
+            return False
+        self.data = data
+        self.version += 1
+        if self.changed is not None:
+            self.changed.set()
+        self.changed = asyncio.Event()
+        return True
+
+    async def get(self) -> dict:
+        if not self.data:
+            await self.refresh()
+        return self.data
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"{C_RED}[STATS] Error refreshing stats snapshot: {e}{C_RESET}")
+            await asyncio.sleep(self.interval)
+
+    async def stream(self, request: Request):
+        """Server-Sent Events: the current snapshot, then every change, with keepalive comments."""
+        self.subscribers += 1
+        try:
+            await self.get()
+            sent = None # Version of the last snapshot sent
+            while not await request.is_disconnected():
+                # Compared after every yield, so a change while the client was being written to is not lost
+                if self.version != sent:
+                    sent = self.version
+                    yield f"event: stats\ndata: {json.dumps(self.data)}\n\n"
+                    continue
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=STATS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.subscribers -= 1
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": self.subscribers,
+            "updated_at": datetime.fromtimestamp(self.updated_at).isoformat() if self.updated_at else None,
+            "interval": self.interval,
+        }
+
+STATS_SNAPSHOT = StatsSnapshot(STATS_SNAPSHOT_INTERVAL)
+
+def etag_json_response(request: Request, content: dict) -> Response:
+    """JSON response with an ETag; answers 304 Not Modified if the client already has it."""
+    body = json.dumps(content, sort_keys=True)
+    etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def stats_stream_response(request: Request) -> StreamingResponse:
+    return StreamingResponse(STATS_SNAPSHOT.stream(request), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Indicator Storage ---
+# "keys" (default): one string key per IP and source (ti:local:{ip}, ti:osint:{ip}) with its own TTL.
+# "compact": IPv4 addresses are packed into bucketed hashes, one field per IP holding a
+#   source bitmask plus per-source expiry, so a single HGET answers both sources.
+#   IPv6 and anything that is not a plain IPv4 address stay on the legacy keys.
+IP_STORAGE_BACKEND = os.getenv("IP_STORAGE_BACKEND", "keys")
+SOURCE_LOCAL = 1
+SOURCE_OSINT = 2
+SOURCE_PREFIXES = {SOURCE_LOCAL: KEY_LOCAL, SOURCE_OSINT: KEY_OSINT}
+LOCAL_TTL = timedelta(days=365)
+KEY_COMPACT_BUCKET = "ti:v4:b:" # ti:v4:b:{ip >> 16} -> Hash: str(ip & 0xFFFF) -> "mask:local_expiry:osint_expiry"
+KEY_COMPACT_EXPIRY = "ti:v4:expiry" # ZSet: bucket key -> earliest expiry (epoch) of any entry in it
+KEY_COMPACT_MIGRATED = "ti:v4:migrated" # Set once no IPv4 indicator is left under legacy keys
+REDIS_WRITE_CHUNK_SIZE = int(os.getenv("REDIS_WRITE_CHUNK_SIZE", "2000")) # IPs per scripted/pipelined write
+KEY_CHANGES = "ti:changes" # Stream of indicator changes: op (add/remove/expire/reset), source, ips (comma-separated)
+KEY_LEGACY_EXPIRY = "ti:legacy:expiry" # ZSet: legacy indicator key -> expiry (epoch), so TTL expiries can be logged
+KEY_LEGACY_EXPIRY_INDEXED = "ti:legacy:expiry:indexed" # Set once keys written before the index existed are indexed
+# The legacy expiry index costs about as much memory as the legacy keys themselves, so the
+# "keys" backend only keeps it when asked to. The compact backend always does (it covers IPv6 only).
+LEGACY_EXPIRY_INDEX = os.getenv("LEGACY_EXPIRY_INDEX", "false").lower() in ("1", "true", "yes")
+CHANGE_LOG_MAXLEN = int(os.getenv("CHANGE_LOG_MAXLEN", "100000")) # Stream entries kept (approximate trim)
+SOURCE_NAMES = {SOURCE_LOCAL: "local", SOURCE_OSINT: "osint"}
+# Blacklist cleanup expands a new rule against stored IPs only up to these sizes, larger rules fall back to a scan
+CLEANUP_EXPAND_MAX_ADDRESSES = int(os.getenv("CLEANUP_EXPAND_MAX_ADDRESSES", "65536"))
+CLEANUP_EXPAND_MAX_BUCKETS = int(os.getenv("CLEANUP_EXPAND_MAX_BUCKETS", "256"))
+CLEANUP_EXPAND_MAX_RULES = int(os.getenv("CLEANUP_EXPAND_MAX_RULES", "1000")) # More new rules than this: one scan instead
+CLEANUP_EXPAND_MAX_TOTAL = int(os.getenv("CLEANUP_EXPAND_MAX_TOTAL", "262144")) # Lookups (addresses or compact buckets) per run, the rest are scanned
+
+# Lua helpers shared by the write scripts. Every script appends what it changed to the
+# change log (KEY_CHANGES) itself, so a write is never applied without its log entry.
+# Source names match SOURCE_NAMES.
+CHANGE_LOG_FN_LUA = """
+local function log_change(stream, maxlen, op, source, ips)
+    if #ips > 0 and tonumber(maxlen) > 0 then
+        redis.call('XADD', stream, 'MAXLEN', '~', maxlen, '*', 'op', op, 'source', source, 'ips', table.concat(ips, ','))
+    end
+end
+
+local function compact_ip(bucket, field, prefix_len)
+    local value = tonumber(string.sub(bucket, prefix_len + 1)) * 65536 + tonumber(field)
+    return string.format('%d.%d.%d.%d', math.floor(value / 16777216), math.floor(value / 65536) % 256,
+                         math.floor(value / 256) % 256, value % 256)
+end
+"""
+
+# Upserts legacy indicator keys with one TTL, indexes their expiry and returns a 0/1 "was new" flag per key.
+# A key that expired but is still in the expiry index was never swept (logged or counted
+# as expired), so writing it again is a refresh, not a new IP.
+# KEYS[1]: change log, KEYS[2]: legacy expiry index, KEYS[3..n]: indicator keys
+# ARGV[1]: ttl seconds, ARGV[2]: value (timestamp), ARGV[3]: now (0: expiry index off),
+# ARGV[4]: change log maxlen, ARGV[5]: source name, ARGV[6..]: IP per key
+UPSERT_INDICATORS_LUA = CHANGE_LOG_FN_LUA + """
+local indexed = tonumber(ARGV[3]) > 0
+local expiry = tonumber(ARGV[3]) + tonumber(ARGV[1])
+local flags, new_ips = {}, {}
+for i = 3, #KEYS do
+    local is_new = 0
+    if redis.call('EXISTS', KEYS[i]) == 0 and not (indexed and redis.call('ZSCORE', KEYS[2], KEYS[i])) then is_new = 1 end
+    redis.call('SET', KEYS[i], ARGV[2], 'EX', ARGV[1])
+    if indexed then redis.call('ZADD', KEYS[2], expiry, KEYS[i]) end
+    flags[i - 2] = is_new
+    if is_new == 1 then new_ips[#new_ips + 1] = ARGV[i + 3] end
+end
+log_change(KEYS[1], ARGV[4], 'add', ARGV[5], new_ips)
+return flags
+"""
+
+# Lua helper shared by the compact upsert scripts: upserts one entry for one source,
+# keeps expiries moving forward only and returns 1 if the IP was new for that source.
+# Expired sources are left for the sweep, which logs and counts them; refreshing one
+# before the sweep ran is not new.
+COMPACT_UPSERT_FN_LUA = """
+local function compact_upsert(index, bucket, field, source, expiry)
+    local exp_local, exp_osint = 0, 0
+    local value = redis.call('HGET', bucket, field)
+    if value then
+        local _, a, b = string.match(value, '(%d+):(%d+):(%d+)')
+        exp_local, exp_osint = tonumber(a), tonumber(b)
+    end
+    local new = 0
+    if source == 1 then
+        if exp_local == 0 then new = 1 end
+        if expiry > exp_local then exp_local = expiry end
+    else
+        if exp_osint == 0 then new = 1 end
+        if expiry > exp_osint then exp_osint = expiry end
+    end
+    local mask = 0
+    if exp_local > 0 then mask = mask + 1 end
+    if exp_osint > 0 then mask = mask + 2 end
+    redis.call('HSET', bucket, field, mask .. ':' .. exp_local .. ':' .. exp_osint)
+    redis.call('ZADD', index, 'LT', expiry, bucket)
+    return new
+end
+"""
+
+# Upserts compact entries for one source and returns a 0/1 "was new for that source" flag per IP.
+# Expiries only ever move forward, so re-running a migration is idempotent.
+# KEYS[1]: expiry index, KEYS[2]: change log, KEYS[3..n]: bucket per IP
+# ARGV[1]: source bit, ARGV[2]: change log maxlen (0: not logged), ARGV[3]: source name,
+# then per IP: field, expiry, IP
+COMPACT_UPSERT_LUA = CHANGE_LOG_FN_LUA + COMPACT_UPSERT_FN_LUA + """
+local source = tonumber(ARGV[1])
+local flags, new_ips = {}, {}
+for i = 3, #KEYS do
+    local arg = 3 * (i - 3) + 4
+    flags[i - 2] = compact_upsert(KEYS[1], KEYS[i], ARGV[arg], source, tonumber(ARGV[arg + 1]))
+    if flags[i - 2] == 1 then new_ips[#new_ips + 1] = ARGV[arg + 2] end
+end
+log_change(KEYS[2], ARGV[2], 'add', ARGV[3], new_ips)
+return flags
+"""
+
+# Upserts local attacker IPs (either layout) and updates the counters atomically, so
+# concurrent reports of the same new IP are counted once. Returns a 0/1 "was new" flag per IP.
+# KEYS[1]: new-IPs window counter, KEYS[2]: total local counter, KEYS[3]: compact expiry index,
+# KEYS[4]: legacy expiry index, KEYS[5]: change log, KEYS[6..n]: per IP its legacy key or compact bucket
+# ARGV[1]: now, ARGV[2]: ttl seconds, ARGV[3]: legacy value (timestamp), ARGV[4]: change log maxlen,
+# ARGV[5]: 1 if legacy keys are indexed in KEYS[4], then per IP: its compact field ('' for a legacy key), IP
+INGEST_LOCAL_LUA = CHANGE_LOG_FN_LUA + COMPACT_UPSERT_FN_LUA + """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local indexed = ARGV[5] == '1'
+local flags, new_ips = {}, {}
+for i = 6, #KEYS do
+    local arg = 2 * (i - 6) + 6
+    local is_new
+    if ARGV[arg] == '' then
+        -- Expired but not yet swept: a refresh, like in UPSERT_INDICATORS_LUA
+        is_new = 0
+        if redis.call('EXISTS', KEYS[i]) == 0 and not (indexed and redis.call('ZSCORE', KEYS[4], KEYS[i])) then is_new = 1 end
+        redis.call('SET', KEYS[i], ARGV[3], 'EX', ttl)
+        if indexed then redis.call('ZADD', KEYS[4], now + ttl, KEYS[i]) end
+    else
+        is_new = compact_upsert(KEYS[3], KEYS[i], ARGV[arg], 1, now + ttl)
+    end
+    flags[#flags + 1] = is_new
+    if is_new == 1 then new_ips[#new_ips + 1] = ARGV[arg + 1] end
+end
+if #new_ips > 0 then
+    redis.call('INCRBY', KEYS[1], #new_ips)
+    -- The "Last Cloud IPs" window (~24h) starts with its first new IP
+    if redis.call('TTL', KEYS[1]) == -1 then
+        redis.call('EXPIRE', KEYS[1], 86400)
+    end
+    redis.call('INCRBY', KEYS[2], #new_ips)
+end
+log_change(KEYS[5], ARGV[4], 'add', 'local', new_ips)
+return flags
+"""
+
+# Unlinks legacy indicator keys of one source and returns a 0/1 "existed" flag per key.
+# KEYS[1]: change log, KEYS[2]: legacy expiry index, KEYS[3..n]: indicator keys
+# ARGV[1]: change log maxlen, ARGV[2]: source name, ARGV[3..]: IP per key
+LEGACY_REMOVE_LUA = CHANGE_LOG_FN_LUA + """
+local flags, removed = {}, {}
+for i = 3, #KEYS do
+    flags[i - 2] = redis.call('UNLINK', KEYS[i])
+    redis.call('ZREM', KEYS[2], KEYS[i])
+    if flags[i - 2] == 1 then removed[#removed + 1] = ARGV[i] end
+end
+log_change(KEYS[1], ARGV[1], 'remove', ARGV[2], removed)
+return flags
+"""
+
+# Clears source bits from compact entries and returns the source mask actually removed per IP.
+# KEYS[1]: change log, KEYS[2..n]: bucket per IP
+# ARGV[1]: source mask to clear, ARGV[2]: change log maxlen, then per IP: field, IP
+COMPACT_REMOVE_LUA = CHANGE_LOG_FN_LUA + """
+local clear = tonumber(ARGV[1])
+local removed, removed_local, removed_osint = {}, {}, {}
+for i = 2, #KEYS do
+    local arg = 2 * (i - 2) + 3
+    local value = redis.call('HGET', KEYS[i], ARGV[arg])
+    local gone = 0
+    if value then
+        local _, a, b = string.match(value, '(%d+):(%d+):(%d+)')
+        local exp_local, exp_osint = tonumber(a), tonumber(b)
+        if clear % 2 == 1 and exp_local > 0 then exp_local = 0; gone = gone + 1 end
+        if clear >= 2 and exp_osint > 0 then exp_osint = 0; gone = gone + 2 end
+        if exp_local == 0 and exp_osint == 0 then
+            redis.call('HDEL', KEYS[i], ARGV[arg])
+        else
+            local mask = 0
+            if exp_local > 0 then mask = mask + 1 end
+            if exp_osint > 0 then mask = mask + 2 end
+            redis.call('HSET', KEYS[i], ARGV[arg], mask .. ':' .. exp_local .. ':' .. exp_osint)
+        end
+    end
+    if gone % 2 == 1 then removed_local[#removed_local + 1] = ARGV[arg + 1] end
+    if gone >= 2 then removed_osint[#removed_osint + 1] = ARGV[arg + 1] end
+    removed[i - 1] = gone
+end
+log_change(KEYS[1], ARGV[2], 'remove', 'local', removed_local)
+log_change(KEYS[1], ARGV[2], 'remove', 'osint', removed_osint)
+return removed
+"""
+
+# Drops expired sources from one bucket, re-scores it in the expiry index, logs the
+# expiries and returns a flat list of {field, expired_mask, ...}.
+# KEYS[1]: expiry index, KEYS[2]: bucket, KEYS[3]: change log
+# ARGV[1]: now, ARGV[2]: change log maxlen, ARGV[3]: length of the bucket key prefix
+COMPACT_SWEEP_LUA = CHANGE_LOG_FN_LUA + """
+local now = tonumber(ARGV[1])
+local entries = redis.call('HGETALL', KEYS[2])
+local expired, expired_local, expired_osint = {}, {}, {}
+local earliest = nil
+for i = 1, #entries, 2 do
+    local field = entries[i]
+    local _, a, b = string.match(entries[i + 1], '(%d+):(%d+):(%d+)')
+    local exp_local, exp_osint = tonumber(a), tonumber(b)
+    local gone = 0
+    if exp_local > 0 and exp_local < now then exp_local = 0; gone = gone + 1 end
+    if exp_osint > 0 and exp_osint < now then exp_osint = 0; gone = gone + 2 end
+    if gone > 0 then
+        if exp_local == 0 and exp_osint == 0 then
+            redis.call('HDEL', KEYS[2], field)
+        else
+            local mask = 0
+            if exp_local > 0 then mask = mask + 1 end
+            if exp_osint > 0 then mask = mask + 2 end
+            redis.call('HSET', KEYS[2], field, mask .. ':' .. exp_local .. ':' .. exp_osint)
+        end
+        table.insert(expired, field)
+        table.insert(expired, gone)
+        local ip = compact_ip(KEYS[2], field, tonumber(ARGV[3]))
+        if gone % 2 == 1 then expired_local[#expired_local + 1] = ip end
+        if gone >= 2 then expired_osint[#expired_osint + 1] = ip end
+    end
+    for _, expiry in ipairs({exp_local, exp_osint}) do
+        if expiry > 0 and (earliest == nil or expiry < earliest) then earliest = expiry end
+    end
+end
+if earliest then
+    redis.call('ZADD', KEYS[1], earliest, KEYS[2])
+else
+    redis.call('ZREM', KEYS[1], KEYS[2])
+end
+log_change(KEYS[3], ARGV[2], 'expire', 'local', expired_local)
+log_change(KEYS[3], ARGV[2], 'expire', 'osint', expired_osint)
+return expired
+"""
+
+# Legacy keys expire through their Redis TTL, so the expiry index is checked against the
+# keys that are due: keys that are gone are dropped from the index and logged as expired,
+# keys that are still alive (TTL extended meanwhile) are re-scored. Returns the expired keys.
+# KEYS[1]: legacy expiry index, KEYS[2]: change log, KEYS[3..n]: due indicator keys
+# ARGV[1]: now, ARGV[2]: change log maxlen, ARGV[3]: local key prefix, ARGV[4]: OSINT key prefix
+LEGACY_SWEEP_LUA = CHANGE_LOG_FN_LUA + """
+local now = tonumber(ARGV[1])
+local expired, expired_local, expired_osint = {}, {}, {}
+for i = 3, #KEYS do
+    local ttl = redis.call('TTL', KEYS[i])
+    if ttl > 0 then
+        redis.call('ZADD', KEYS[1], now + ttl, KEYS[i])
+    else
+        redis.call('ZREM', KEYS[1], KEYS[i])
+        if ttl == -2 then
+            expired[#expired + 1] = KEYS[i]
+            if string.sub(KEYS[i], 1, #ARGV[3]) == ARGV[3] then
+                expired_local[#expired_local + 1] = string.sub(KEYS[i], #ARGV[3] + 1)
+            elseif string.sub(KEYS[i], 1, #ARGV[4]) == ARGV[4] then
+                expired_osint[#expired_osint + 1] = string.sub(KEYS[i], #ARGV[4] + 1)
+            end
+        end
+    end
+end
+log_change(KEYS[2], ARGV[2], 'expire', 'local', expired_local)
+log_change(KEYS[2], ARGV[2], 'expire', 'osint', expired_osint)
+return expired
+"""
+
+UPSERT_INDICATORS_SCRIPT = REDIS_CLIENT.register_script(UPSERT_INDICATORS_LUA)
+COMPACT_UPSERT_SCRIPT = REDIS_CLIENT.register_script(COMPACT_UPSERT_LUA)
+INGEST_LOCAL_SCRIPT = REDIS_CLIENT.register_script(INGEST_LOCAL_LUA)
+LEGACY_REMOVE_SCRIPT = REDIS_CLIENT.register_script(LEGACY_REMOVE_LUA)
+COMPACT_REMOVE_SCRIPT = REDIS_CLIENT.register_script(COMPACT_REMOVE_LUA)
+COMPACT_SWEEP_SCRIPT = REDIS_CLIENT.register_script(COMPACT_SWEEP_LUA)
+LEGACY_SWEEP_SCRIPT = REDIS_CLIENT.register_script(LEGACY_SWEEP_LUA)
+
+def legacy_expiry_indexed() -> bool:
+    """Whether legacy keys are tracked in KEY_LEGACY_EXPIRY (always with the compact backend, opt-in otherwise)."""
+    return IP_STORAGE_BACKEND == "compact" or LEGACY_EXPIRY_INDEX
+
+def compact_location(ip: str):
+    """(bucket key, field) of an IPv4 address in the compact layout, or None if it is not plain IPv4."""
+    try:
+        value = int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+    return f"{KEY_COMPACT_BUCKET}{value >> 16}", str(value & 0xFFFF)
+
+def compact_ip(bucket_key: str, field: str) -> str:
+    """Inverse of compact_location."""
+    bucket = int(bucket_key[len(KEY_COMPACT_BUCKET):])
+    return str(ipaddress.IPv4Address((bucket << 16) | int(field)))
+
+def decode_compact_value(value: Optional[str], now: float) -> int:
+    """Source bitmask of a compact entry, ignoring sources whose expiry has passed."""
+    if not value:
+        return 0
+    mask, exp_local, exp_osint = (int(part) for part in value.split(":"))
+    if exp_local < now:
+        mask &= ~SOURCE_LOCAL
+    if exp_osint < now:
+        mask &= ~SOURCE_OSINT
+    return mask
+
+def split_by_layout(ips: List[str]):
+    """Splits IPs into compact-stored ({ip: (bucket, field)}) and legacy-key-stored ones."""
+    compact, legacy = {}, []
+    for ip in ips:
+        location = compact_location(ip) if IP_STORAGE_BACKEND == "compact" else None
+        if location:
+            compact[ip] = location
+        else:
+            legacy.append(ip)
+    return compact, legacy
+
+async def log_change_reset(reason: str):
+    """Marks a change the log cannot express per IP (e.g. a whitelist edit): consumers have to resync from the full feed."""
+    await REDIS_CLIENT.xadd(KEY_CHANGES, {"op": "reset", "source": reason, "ips": ""}, maxlen=CHANGE_LOG_MAXLEN, approximate=True)
+
+async def latest_change_id() -> str:
+    """ID of the newest change log entry ("0-0" if the log is empty)."""
+    entries = await REDIS_CLIENT.xrevrange(KEY_CHANGES, count=1)
+    return entries[0][0] if entries else "0-0"
+
+def parse_stream_id(value: str):
+    """Redis stream ID ("ms-seq") as a comparable tuple, or None if malformed."""
+    ms, _, seq = value.partition("-")
+    try:
+        return int(ms), int(seq or 0)
+    except ValueError:
+        return None
+
+class BloomFilter:
+    """Bloom filter over strings: a bytearray of bits, k positions per item by double hashing one blake2b digest."""
+    __slots__ = ("capacity", "size", "hashes", "bits", "count")
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        bits = self.bits
+        new = False
+        for pos in self._positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                bits[pos >> 3] |= 1 << (pos & 7)
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def fp_rate(self) -> float:
+        """Expected false-positive rate at the current fill."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+class IndicatorFilter:
+    """
+    Per-worker Bloom filter of every stored indicator IP (both sources). A miss proves the
+    IP is not stored, so lookup_indicators answers it without Redis; a hit falls back to
+    the authoritative lookup. Filled by a full scan at startup and every rebuild interval
+    (which drops expired IPs), and kept current in between from this worker's writes and
+    the KEY_CHANGES stream (writes of other workers, within GENERATION_POLL_INTERVAL).
+    """
+    def __init__(self, enabled: bool, fp_rate: float, min_capacity: int, rebuild_interval: float):
+        self.enabled = enabled
+        self.fp_rate = fp_rate
+        self.min_capacity = min_capacity
+        self.rebuild_interval = rebuild_interval
+        self.filter = None # BloomFilter, set once the first build finished
+        self._building = None # Filter being filled by a rebuild, receives live adds too
+        self.cursor = None # Last KEY_CHANGES entry applied
+        self.negatives = 0
+        self.positives = 0
+        self.false_positives = 0
+        self.builds = 0
+        self.built_at = 0.0
+        self.build_seconds = 0.0
+
+    def add(self, ips: List[str]):
+        for target in (self.filter, self._building):
+            if target is not None:
+                for ip in ips:
+                    target.add(ip)
+
+    def might_contain(self, ip: str) -> bool:
+        if self.filter is None:
+            return True
+        if ip in self.filter:
+            self.positives += 1
+            return True
+        self.negatives += 1
+        return False
+
+    async def build(self):
+        """Fills a new filter from a full scan (sized for twice the stored IPs), then swaps it in."""
+        start = time.perf_counter()
+        cursor = await latest_change_id()
+        stored = sum(int(value or 0) for value in await REDIS_CLIENT.mget(KEY_STATS_LOCAL, KEY_STATS_OSINT))
+        building = BloomFilter(max(self.min_capacity, 2 * stored), self.fp_rate)
+        self._building = building
+        try:
+            for source in SOURCE_PREFIXES:
+                async for batch in iter_indicators(source):
+                    for ip in batch:
+                        building.add(ip)
+        finally:
+            self._building = None
+        self.filter = building
+        if self.cursor is None:
+            self.cursor = cursor
+        self.builds += 1
+        self.built_at = time.time()
+        self.build_seconds = time.perf_counter() - start
+        logger.info(f"{C_BLUE}[CACHE:FILTER] Indicator filter built in {self.build_seconds:.2f}s: {building.count} IPs, {len(building.bits)} bytes, ~{building.fp_rate():.4f} false positives{C_RESET}")
+
+    async def follow_changes(self, batch: int = 1000) -> bool:
+        """
+        Applies KEY_CHANGES entries since the last poll (writes of other workers): adds new IPs,
+        drops cached reputations. Returns False if the log was trimmed past the cursor, so
+        entries may have been missed and the filter has to be rebuilt.
+        """
+        oldest = await REDIS_CLIENT.xrange(KEY_CHANGES, count=1)
+        if oldest and parse_stream_id(oldest[0][0]) > parse_stream_id(self.cursor):
+            # The cursor's entry is gone. If the log was empty at the build ("0-0"), nothing
+            # can have been trimmed unseen until it reached its length limit.
+            if self.cursor != "0-0" or await REDIS_CLIENT.xlen(KEY_CHANGES) >= CHANGE_LOG_MAXLEN:
+                return False
+        while True:
+            ms, seq = parse_stream_id(self.cursor)
+            entries = await REDIS_CLIENT.xrange(KEY_CHANGES, min=f"{ms}-{seq + 1}", count=batch)
+            for entry_id, fields in entries:
+                ips = fields.get("ips", "").split(",")
+                if fields.get("op") == "add":
+                    self.add(ips)
+                REPUTATION_CACHE.invalidate(ips)
+                self.cursor = entry_id
+            if len(entries) < batch:
+                return True
+
+    async def run(self):
+        if self.enabled and CHANGE_LOG_MAXLEN <= 0:
+            # Without the change log the filter would miss IPs added by other workers
+            logger.warning(f"{C_YELLOW}[CACHE:FILTER] Change log disabled (CHANGE_LOG_MAXLEN=0), indicator filter turned off.{C_RESET}")
+            self.enabled = False
+        if not self.enabled:
+            return
+        last_build = 0.0
+        while True:
+            try:
+                if (self.filter is None or time.monotonic() - last_build >= self.rebuild_interval
+                        or self.filter.count > self.filter.capacity):
+                    await self.build()
+                    last_build = time.monotonic()
+                if not await self.follow_changes():
+                    logger.warning(f"{C_YELLOW}[CACHE:FILTER] Change log trimmed past the filter's cursor, rebuilding.{C_RESET}")
+                    # Lookups bypass the filter until the rebuild, which restarts from the newest entry
+                    self.filter = None
+                    self.cursor = None
+                    REPUTATION_CACHE.clear()
+                    await self.build()
+                    last_build = time.monotonic()
+            except Exception as e:
+                logger.error(f"{C_RED}[CACHE:FILTER] Error updating indicator filter: {e}{C_RESET}")
+            await asyncio.sleep(GENERATION_POLL_INTERVAL)
+
+    def stats(self) -> dict:
+        bloom = self.filter
+        screened = self.negatives + self.false_positives
+        return {
+            "enabled": self.enabled,
+            "ready": bloom is not None,
+            "capacity": bloom.capacity if bloom else 0,
+            "items": bloom.count if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "memory_bytes": len(bloom.bits) if bloom else 0,
+            "estimated_fp_rate": round(bloom.fp_rate(), 6) if bloom else None,
+            "observed_fp_rate": round(self.false_positives / screened, 6) if screened else None,
+            "negatives": self.negatives,
+            "positives": self.positives,
+            "false_positives": self.false_positives,
+            "builds": self.builds,
+            "built_at": datetime.fromtimestamp(self.built_at).isoformat() if self.built_at else None,
+            "build_seconds": round(self.build_seconds, 3),
+        }
+
+INDICATOR_FILTER = IndicatorFilter(INDICATOR_FILTER_ENABLED, INDICATOR_FILTER_FP_RATE,
+                                   INDICATOR_FILTER_MIN_CAPACITY, INDICATOR_FILTER_REBUILD_INTERVAL)
+
+async def lookup_indicators(ips: List[str], use_filter: bool = True) -> List[int]:
+    """
+    Source bitmask (SOURCE_LOCAL | SOURCE_OSINT) for each IP, answered in one pipelined round-trip.
+    IPs the indicator filter rules out get 0 without touching Redis. Pass use_filter=False where a
+    stale filter must not hide an IP (cleanup), which also keeps those lookups out of the filter stats.
+    """
+    screened = use_filter and INDICATOR_FILTER.filter is not None
+    candidates = [ip for ip in ips if INDICATOR_FILTER.might_contain(ip)] if use_filter else ips
+    if not candidates:
+        return [0] * len(ips)
+
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    layouts = []
+    for ip in candidates:
+        location = compact_location(ip) if IP_STORAGE_BACKEND == "compact" else None
+        if location:
+            pipe.hget(*location)
+        else:
+            pipe.exists(f"{KEY_LOCAL}{ip}")
+            pipe.exists(f"{KEY_OSINT}{ip}")
+        layouts.append(location is not None)
+    replies = await pipe.execute()
+
+    now = time.time()
+    masks = []
+    pos = 0
+    for is_compact in layouts:
+        if is_compact:
+            masks.append(decode_compact_value(replies[pos], now))
+            pos += 1
+        else:
+            masks.append((SOURCE_LOCAL if replies[pos] else 0) | (SOURCE_OSINT if replies[pos + 1] else 0))
+            pos += 2
+    if screened:
+        INDICATOR_FILTER.false_positives += masks.count(0)
+    if len(candidates) == len(ips):
+        return masks
+    found = dict(zip(candidates, masks))
+    return [found.get(ip, 0) for ip in ips]
+
+async def queue_store_indicators(pipe, ips: List[str], source: int, ttl: timedelta) -> List[str]:
+    """
+    Queues the upsert scripts for IPs of one source on a pipeline (chunked by REDIS_WRITE_CHUNK_SIZE).
+    The scripts log new IPs to the change log themselves. Returns the IPs in the order in
+    which the scripts report their "was new" flags.
+    """
+    # Ahead of the write, so a lookup never sees the IP stored but missing from the filter
+    INDICATOR_FILTER.add(ips)
+    ttl_seconds = int(ttl.total_seconds())
+    compact, legacy = split_by_layout(ips)
+    now = int(time.time())
+    indexed_now = now if legacy_expiry_indexed() else 0
+
+    for i in range(0, len(legacy), REDIS_WRITE_CHUNK_SIZE):
+        chunk = legacy[i:i + REDIS_WRITE_CHUNK_SIZE]
+        keys = [KEY_CHANGES, KEY_LEGACY_EXPIRY] + [f"{SOURCE_PREFIXES[source]}{ip}" for ip in chunk]
+        args = [ttl_seconds, datetime.now().isoformat(), indexed_now, CHANGE_LOG_MAXLEN, SOURCE_NAMES[source]] + chunk
+        await UPSERT_INDICATORS_SCRIPT(keys=keys, args=args, client=pipe)
+
+    located = list(compact.items())
+    for i in range(0, len(located), REDIS_WRITE_CHUNK_SIZE):
+        chunk = located[i:i + REDIS_WRITE_CHUNK_SIZE]
+        args = [source, CHANGE_LOG_MAXLEN, SOURCE_NAMES[source]]
+        for ip, (_, field) in chunk:
+            args.extend((field, now + ttl_seconds, ip))
+        await COMPACT_UPSERT_SCRIPT(keys=[KEY_COMPACT_EXPIRY, KEY_CHANGES] + [bucket for _, (bucket, _) in chunk], args=args, client=pipe)
+    return legacy + list(compact)
+
+async def store_indicators(ips: List[str], source: int, ttl: timedelta) -> List[str]:
+    """Upserts IPs for one source (logged to the change log) in one pipelined round-trip and returns the new ones."""
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    ordered = await queue_store_indicators(pipe, ips, source, ttl)
+    flags = [flag for chunk_flags in await pipe.execute() for flag in chunk_flags]
+    new_ips = [ip for ip, is_new in zip(ordered, flags) if is_new]
+    REPUTATION_CACHE.invalidate(new_ips)
+    return new_ips
+
+async def remove_indicators(ips: List[str], source_mask: int) -> int:
+    """Removes IPs from the given source(s), logged to the change log, and returns how many source entries actually existed."""
+    removed = {source: [] for source in SOURCE_PREFIXES}
+    compact, legacy = split_by_layout(ips)
+
+    # Per queued script: the IPs it covers and the source it removes (None: compact, returns masks)
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    targets = []
+    for source, prefix in SOURCE_PREFIXES.items():
+        if source_mask & source:
+            for i in range(0, len(legacy), REDIS_WRITE_CHUNK_SIZE):
+                chunk = legacy[i:i + REDIS_WRITE_CHUNK_SIZE]
+                keys = [KEY_CHANGES, KEY_LEGACY_EXPIRY] + [f"{prefix}{ip}" for ip in chunk]
+                await LEGACY_REMOVE_SCRIPT(keys=keys, args=[CHANGE_LOG_MAXLEN, SOURCE_NAMES[source]] + chunk, client=pipe)
+                targets.append((chunk, source))
+
+    located = list(compact.items())
+    for i in range(0, len(located), REDIS_WRITE_CHUNK_SIZE):
+        chunk = located[i:i + REDIS_WRITE_CHUNK_SIZE]
+        args = [source_mask, CHANGE_LOG_MAXLEN]
+        for ip, (_, field) in chunk:
+            args.extend((field, ip))
+        await COMPACT_REMOVE_SCRIPT(keys=[KEY_CHANGES] + [bucket for _, (bucket, _) in chunk], args=args, client=pipe)
+        targets.append(([ip for ip, _ in chunk], None))
+
+    if targets:
+        for (chunk, source), results in zip(targets, await pipe.execute()):
+            for ip, result in zip(chunk, results):
+                mask = int(result) * source if source else int(result)
+                for removed_source in removed:
+                    if mask & removed_source:
+                        removed[removed_source].append(ip)
+    REPUTATION_CACHE.invalidate([ip for source_ips in removed.values() for ip in source_ips])
+    return sum(len(source_ips) for source_ips in removed.values())
+
+async def iter_indicators(source: int, count: int = 1000):
+    """Yields batches of IPs currently stored for a source (legacy keys first, then compact buckets)."""
+    prefix = SOURCE_PREFIXES[source]
+    cursor = 0
+    while True:
+        cursor, keys = await REDIS_CLIENT.scan(cursor=cursor, match=f"{prefix}*", count=count)
+        if keys:
+            yield [key[len(prefix):] for key in keys]
+        if str(cursor) == '0':
+            break
+
+    if IP_STORAGE_BACKEND != "compact":
+        return
+    now = time.time()
+    async for bucket_key in REDIS_CLIENT.scan_iter(match=f"{KEY_COMPACT_BUCKET}*", count=count):
+        entries = await REDIS_CLIENT.hgetall(bucket_key)
+        ips = [compact_ip(bucket_key, field) for field, value in entries.items() if decode_compact_value(value, now) & source]
+        if ips:
+            yield ips
+
+async def count_indicators(source: int) -> int:
+    """Number of IPs currently stored for a source (full scan)."""
+    total = 0
+    async for ips in iter_indicators(source):
+        total += len(ips)
+    return total
+
+async def legacy_ipv4_keys_left(count: int = 1000) -> bool:
+    """True if any IPv4 indicator is still stored under a legacy key (stops at the first one)."""
+    for prefix in SOURCE_PREFIXES.values():
+        async for key in REDIS_CLIENT.scan_iter(match=f"{prefix}*", count=count):
+            if compact_location(key[len(prefix):]):
+                return True
+    return False
+
+async def mark_compact_migrated() -> bool:
+    """Sets KEY_COMPACT_MIGRATED if no IPv4 legacy keys are left. Returns whether it is set."""
+    if await REDIS_CLIENT.exists(KEY_COMPACT_MIGRATED):
+        return True
+    if await legacy_ipv4_keys_left():
+        return False
+    await REDIS_CLIENT.set(KEY_COMPACT_MIGRATED, int(time.time()))
+    return True
+
+async def check_storage_backend():
+    """
+    The compact backend reads IPv4 indicators from buckets only, so IPv4 keys left
+    in the legacy layout would be counted and exported but never matched. Refuses
+    to start until tools/migrate_compact_storage.py --delete-legacy moved them
+    (checked with one SCAN, then remembered in KEY_COMPACT_MIGRATED). The keys
+    backend writes IPv4 legacy keys again, so it clears the marker.
+    """
+    if IP_STORAGE_BACKEND != "compact":
+        await REDIS_CLIENT.unlink(KEY_COMPACT_MIGRATED)
+        return
+    if not await mark_compact_migrated():
+        raise RuntimeError("IP_STORAGE_BACKEND=compact, but IPv4 indicators are still stored under legacy keys. "
+                           "Stop the old workers and run tools/migrate_compact_storage.py --delete-legacy first.")
+
+def network_expansion_cost(network) -> int:
+    """Lookups find_indicators_in_network makes for a network: buckets read for compact IPv4, addresses otherwise."""
+    if IP_STORAGE_BACKEND == "compact" and network.version == 4:
+        buckets = (int(network.broadcast_address) >> 16) - (int(network.network_address) >> 16) + 1
+        if buckets <= CLEANUP_EXPAND_MAX_BUCKETS:
+            return buckets
+    return network.num_addresses
+
+async def find_indicators_in_network(network) -> Optional[dict]:
+    """
+    Stored IPs inside a network as {ip: source mask}, found without scanning the keyspace:
+    compact IPv4 ranges read only the buckets they cover, other networks up to
+    CLEANUP_EXPAND_MAX_ADDRESSES are enumerated and looked up directly (bypassing the
+    indicator filter). Returns None if the network is too large, so the caller has to
+    fall back to a scan.
+    """
+    found = {}
+    if IP_STORAGE_BACKEND == "compact" and network.version == 4:
+        first, last = int(network.network_address), int(network.broadcast_address)
+        buckets = range(first >> 16, (last >> 16) + 1)
+        if len(buckets) <= CLEANUP_EXPAND_MAX_BUCKETS:
+            now = time.time()
+            for i in range(0, len(buckets), 256):
+                pipe = REDIS_CLIENT.pipeline(transaction=False)
+                for bucket in buckets[i:i + 256]:
+                    pipe.hgetall(f"{KEY_COMPACT_BUCKET}{bucket}")
+                for bucket, entries in zip(buckets[i:i + 256], await pipe.execute()):
+                    for field, value in entries.items():
+                        address = (bucket << 16) | int(field)
+                        mask = decode_compact_value(value, now)
+                        if first <= address <= last and mask:
+                            found[str(ipaddress.IPv4Address(address))] = mask
+                await asyncio.sleep(0) # Let other tasks run
+            return found
+
+    if network.num_addresses > CLEANUP_EXPAND_MAX_ADDRESSES:
+        return None
+    addresses = [str(address) for address in network]
+    for i in range(0, len(addresses), REDIS_WRITE_CHUNK_SIZE):
+        chunk = addresses[i:i + REDIS_WRITE_CHUNK_SIZE]
+        for ip, mask in zip(chunk, await lookup_indicators(chunk, use_filter=False)):
+            if mask:
+                found[ip] = mask
+        await asyncio.sleep(0) # Let other tasks run
+    return found
+
+async def index_legacy_expiries(count: int = 1000) -> int:
+    """
+    Adds legacy keys written before KEY_LEGACY_EXPIRY existed to the index (once, then
+    KEY_LEGACY_EXPIRY_INDEXED is set). Entries written since then are kept (ZADD NX).
+    Returns the number of keys indexed.
+    """
+    if await REDIS_CLIENT.exists(KEY_LEGACY_EXPIRY_INDEXED):
+        return 0
+    indexed = 0
+    for prefix in SOURCE_PREFIXES.values():
+        cursor = 0
+        while True:
+            cursor, keys = await REDIS_CLIENT.scan(cursor=cursor, match=f"{prefix}*", count=count)
+            if keys:
+                pipe = REDIS_CLIENT.pipeline(transaction=False)
+                for key in keys:
+                    pipe.ttl(key)
+                now = int(time.time())
+                expiries = {key: now + ttl for key, ttl in zip(keys, await pipe.execute()) if ttl > 0}
+                if expiries:
+                    indexed += await REDIS_CLIENT.zadd(KEY_LEGACY_EXPIRY, expiries, nx=True)
+            if str(cursor) == '0':
+                break
+    await REDIS_CLIENT.set(KEY_LEGACY_EXPIRY_INDEXED, int(time.time()))
+    if indexed:
+        logger.info(f"{C_BLUE}[CLEAN:DB] Indexed expiry of {indexed} existing legacy keys.{C_RESET}")
+    return indexed
+
+async def sweep_expired_indicators(batch: int = 500) -> int:
+    """
+    Logs and drops expired indicators: compact entries whose bucket is due, and legacy keys
+    that Redis expired since the last sweep (found through KEY_LEGACY_EXPIRY). The stats
+    counters are decremented by what expired. Returns expired source entries.
+    Without the legacy expiry index (see legacy_expiry_indexed) legacy expiries are not
+    logged; the index is dropped and the totals are recounted by a scan instead.
+    """
+    expired = {SOURCE_LOCAL: 0, SOURCE_OSINT: 0}
+    now = int(time.time())
+    while IP_STORAGE_BACKEND == "compact":
+        due = await REDIS_CLIENT.zrangebyscore(KEY_COMPACT_EXPIRY, "-inf", now, start=0, num=batch)
+        gone = []
+        for bucket_key in due:
+            result = await COMPACT_SWEEP_SCRIPT(keys=[KEY_COMPACT_EXPIRY, bucket_key, KEY_CHANGES],
+                                                args=[now, CHANGE_LOG_MAXLEN, len(KEY_COMPACT_BUCKET)])
+            for field, mask in zip(result[::2], result[1::2]):
+                gone.append(compact_ip(bucket_key, field))
+                for source in expired:
+                    if int(mask) & source:
+                        expired[source] += 1
+        REPUTATION_CACHE.invalidate(gone)
+        if len(due) < batch:
+            break
+        await asyncio.sleep(0) # Let other tasks run
+
+    if not legacy_expiry_indexed():
+        # Also frees an index left from an earlier setting; re-enabling it backfills again
+        await REDIS_CLIENT.unlink(KEY_LEGACY_EXPIRY, KEY_LEGACY_EXPIRY_INDEXED)
+        totals = {source: await count_indicators(source) for source in SOURCE_PREFIXES}
+        await REDIS_CLIENT.mset({KEY_STATS_LOCAL: totals[SOURCE_LOCAL], KEY_STATS_OSINT: totals[SOURCE_OSINT]})
+        return 0
+
+    await index_legacy_expiries()
+    while True:
+        due = await REDIS_CLIENT.zrangebyscore(KEY_LEGACY_EXPIRY, "-inf", now, start=0, num=batch)
+        if not due:
+            break
+        gone = await LEGACY_SWEEP_SCRIPT(keys=[KEY_LEGACY_EXPIRY, KEY_CHANGES] + due,
+                                         args=[now, CHANGE_LOG_MAXLEN, KEY_LOCAL, KEY_OSINT])
+        REPUTATION_CACHE.invalidate([key.split(":", 2)[2] for key in gone])
+        for key in gone:
+            expired[SOURCE_LOCAL if key.startswith(KEY_LOCAL) else SOURCE_OSINT] += 1
+        if len(due) < batch:
+            break
+        await asyncio.sleep(0) # Let other tasks run
+
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for source, counter in ((SOURCE_LOCAL, KEY_STATS_LOCAL), (SOURCE_OSINT, KEY_STATS_OSINT)):
+        if expired[source]:
+            pipe.decrby(counter, expired[source])
+    await pipe.execute()
+    return expired[SOURCE_LOCAL] + expired[SOURCE_OSINT]
+
+def indicator_reputation(mask: int):
     # 3. Local Data
-    if REDIS_CLIENT.exists(f"{KEY_LOCAL}{ip}"):
+    if mask & SOURCE_LOCAL:
         return "high", ["hfish honeypot"]
-    
     # 4. OSINT
-    if REDIS_CLIENT.exists(f"{KEY_OSINT}{ip}"):
+    if mask & SOURCE_OSINT:
         return "medium", ["osint feed"]
-    
     return "clean", []
 
+def get_list_reputation(ip: str):
+    """Whitelist/blacklist verdict from the local snapshot, or None if the IP is on neither list."""
+    # 1. Whitelist
+    if ip in LIST_SNAPSHOT.whitelist_index:
+        return "clean", ["whitelist"]
+    
+    # 2. Blacklist
+    if ip in LIST_SNAPSHOT.blacklist_index:
+        return "high", ["permanent blacklist"]
+
+    return None
+
+async def get_ip_reputation(ip: str):
+    cached = REPUTATION_CACHE.get(ip)
+    if cached is not None:
+        return cached
+    version = REPUTATION_CACHE.version
+
+    # 1./2. Whitelist & Blacklist
+    result = get_list_reputation(ip)
+    if not result:
+        # 3./4. Local Data & OSINT (one round-trip)
+        result = indicator_reputation((await lookup_indicators([ip]))[0])
+    REPUTATION_CACHE.put(ip, result, version)
+    return result
+
+async def get_ip_reputation_batch(ips: List[str]) -> dict:
+    """
+    Same cascade as get_ip_reputation for many IPs at once.
+    List checks are local; all remaining indicator lookups go out in one pipeline.
+    Returns {ip: (severity, judgments)} in input order.
+    """
+    results = {}
+    pending = []
+    version = REPUTATION_CACHE.version
+    for ip in ips:
+        results[ip] = REPUTATION_CACHE.get(ip)
+        if results[ip] is None:
+            results[ip] = get_list_reputation(ip)
+            if results[ip] is None:
+                pending.append(ip)
+            else:
+                REPUTATION_CACHE.put(ip, results[ip], version)
+
+    if pending:
+        for ip, mask in zip(pending, await lookup_indicators(pending)):
+            results[ip] = indicator_reputation(mask)
+            REPUTATION_CACHE.put(ip, results[ip], version)
+    return results
+
+def parse_resource_list(resources: List[str]) -> List[str]:
+    """Splits ThreatBook-style comma-separated resources, strips and de-duplicates (order preserved)."""
+    ips = {}
+    for resource in resources:
+        for ip in resource.split(","):
+            ip = ip.strip()
+            if ip:
+                ips[ip] = None
+    return list(ips)
+
 def format_threatbook_v3(ip: str, severity: str, judgments: List[str]):
+    return format_threatbook_v3_batch({ip: (severity, judgments)})
+
+def format_threatbook_v3_batch(results: dict):
+    update_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     return {
         "code": 0,
         "data": {
             ip: {
                 "severity": severity,
                 "judgments": judgments,
-                "update_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                "update_time": update_time
             }
+            for ip, (severity, judgments) in results.items()
         },
         "message": "success"
     }
 
 # --- Background Task: OSINT Feeds ---
-async def fetch_osint_feeds():
-    while True:
+OSINT_TTL = timedelta(days=90)
+OSINT_FETCH_CONCURRENCY = int(os.getenv("OSINT_FETCH_CONCURRENCY", "4")) # Feeds downloaded in parallel
+KEY_OSINT_FEED_STATS = "stats:osint_feeds" # Hash: feed name -> JSON metrics of the last run
+KEY_FEED_META = "ti:feed_meta:" # ti:feed_meta:{name} -> Hash: etag, last_modified, content_hash, last_full_apply
+KEY_FEED_SNAPSHOT = "ti:feed_snapshot:" # ti:feed_snapshot:{name} -> Set of IPs from the last applied download
+# Unchanged feed IPs are re-written (TTL refresh) at least this often; must stay well below OSINT_TTL
+OSINT_FULL_REFRESH_INTERVAL = timedelta(days=float(os.getenv("OSINT_FULL_REFRESH_DAYS", "7")))
+HTTP_USER_AGENT = "Honey-API-Bridge/1.0"
+
+def parse_plain_feed_line(line: str) -> Optional[str]:
+    """One IP per line, optionally followed by a comment."""
+    line = line.strip()
+    if not line or line.startswith("#") or line.startswith("//"):
+        return None
+    ip = line.split()[0].strip() # Handle potential comments
+    # Basic check if it looks like an IP
+    if len(ip) > 6 and "." in ip and "/" not in ip:
+        return ip
+    return None
+
+def parse_ipsum_line(line: str) -> Optional[str]:
+    """IPSum: '<ip> <score>' - keep IPs reported by more than 3 blacklists."""
+    if not line or line.startswith("#"):
+        return None
+    parts = line.split()
+    if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 3:
+        return parts[0]
+    return None
+
+def parse_threatfox_line(line: str) -> Optional[str]:
+    """ThreatFox CSV export: third column holds '"ip:port"'."""
+    if not line or line.startswith("#") or "ip:port" not in line:
+        return None
+    parts = line.split(",")
+    if len(parts) > 2:
+        ioc_value = parts[2].replace('"', '').strip()
+        if ":" in ioc_value: # strip port
+            ioc_value = ioc_value.split(":")[0]
+        return ioc_value or None
+    return None
+
+OSINT_FEEDS = [
+    {"name": "feodo", "url": "https://feodotracker.abuse.ch/downloads/ipblocklist.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "ipsum", "url": "https://raw.githubusercontent.com/stamparm/ipsum/master/ipsum.txt", "parser": parse_ipsum_line, "timeout": 10},
+    {"name": "cins", "url": "http://cinsscore.com/list/ci-badguys.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "greensnow", "url": "https://blocklist.greensnow.co/greensnow.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "blocklist_de", "url": "https://lists.blocklist.de/lists/all.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "emerging_threats", "url": "https://rules.emergingthreats.net/blockrules/compromised-ips.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "binarydefense", "url": "https://www.binarydefense.com/banlist.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "dshield", "url": "https://feeds.dshield.org/block.txt", "parser": parse_plain_feed_line, "timeout": 10},
+    {"name": "threatfox", "url": "https://threatfox.abuse.ch/export/csv/ip-port/recent/", "parser": parse_threatfox_line, "timeout": 15},
+]
+
+async def store_osint_ips(ips: List[str]) -> int:
+    """Writes OSINT IPs in chunks and returns the number of new IPs. Scan-blacklisted IPs are dropped."""
+    blacklist_index = LIST_SNAPSHOT.blacklist_index
+    new_ips = await store_indicators([ip for ip in ips if ip not in blacklist_index], SOURCE_OSINT, OSINT_TTL)
+    return len(new_ips)
+
+async def get_feed_meta(name: str) -> dict:
+    return await REDIS_CLIENT.hgetall(f"{KEY_FEED_META}{name}")
+
+def conditional_headers(meta: dict) -> dict:
+    """HTTP validators from the last download, so unchanged feeds answer 304."""
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+async def save_feed_meta(name: str, response: httpx.Response, content_hash: str, **extra):
+    await REDIS_CLIENT.hset(f"{KEY_FEED_META}{name}", mapping={
+        "etag": response.headers.get("etag", ""),
+        "last_modified": response.headers.get("last-modified", ""),
+        "content_hash": content_hash,
+        "checked": datetime.now().isoformat(),
+        **extra,
+    })
+
+async def process_osint_feed(client: httpx.AsyncClient, feed: dict, semaphore: asyncio.Semaphore) -> int:
+    """
+    Downloads one feed conditionally and applies only what changed. Returns the number of new IPs.
+    - 304 Not Modified or an identical content hash: nothing is written.
+    - Changed content: parsed IPs are streamed into a staging set and only the
+      difference against the previous snapshot is written.
+    - Every OSINT_FULL_REFRESH_INTERVAL all IPs are re-written to refresh their TTL.
+    IPs dropped by a feed are not deleted; they expire with OSINT_TTL.
+    """
+    async with semaphore:
+        name, url = feed["name"], feed["url"]
+        snapshot_key = f"{KEY_FEED_SNAPSHOT}{name}"
+        staging_key = f"{snapshot_key}:staging"
+        logger.info(f"{C_BLUE}[FETCH:OSINT] Processing feed: {url}{C_RESET}")
+        start_time = time.perf_counter()
+        lines = 0
+        applied = 0
+        new_count = 0
+        seen = set()
+        pending = []
+        status = "ok"
         try:
-            logger.info(f"{C_CYAN}[FETCH:OSINT] Starting OSINT feed update cycle...{C_RESET}")
-            count = 0 
-            
-            async def process_text_feed(url, timeout=10):
-                local_count = 0
-                logger.info(f"{C_BLUE}[FETCH:OSINT] Processing feed: {url}{C_RESET}")
-                try:
-                    loop = asyncio.get_event_loop()
-                    r = await loop.run_in_executor(None, lambda: requests.get(url, timeout=timeout, headers={"User-Agent": "Honey-API-Bridge/1.0"}))
-                    if r.status_code == 200:
-                        for line in r.text.splitlines():
-                            line = line.strip()
-                            if line and not line.startswith("#") and not line.startswith("//"):
-                                # Basic IP validation/cleaning
-                                ip = line.split()[0].strip() # Handle potential comments
-                                # Basic check if it looks like an IP
-                                if len(ip) > 6 and "." in ip and not "/" in ip:
-                                    key = f"{KEY_OSINT}{ip}"
-                                    if not REDIS_CLIENT.exists(key):
-                                        local_count += 1
-                                    REDIS_CLIENT.setex(key, timedelta(days=90), datetime.now().isoformat())
+            meta = await get_feed_meta(name)
+            last_full_apply = float(meta.get("last_full_apply") or 0)
+            full_refresh = (time.time() - last_full_apply >= OSINT_FULL_REFRESH_INTERVAL.total_seconds()
+                            or not await REDIS_CLIENT.exists(snapshot_key))
+            headers = {} if full_refresh else conditional_headers(meta)
+
+            await REDIS_CLIENT.delete(staging_key)
+            async with client.stream("GET", url, timeout=feed["timeout"], headers=headers) as r:
+                OSINT_FEED_DURATION.labels(name, "fetch").observe(time.perf_counter() - start_time)
+                if r.status_code == 304:
+                    status = "not modified"
+                elif r.status_code != 200:
+                    status = f"http {r.status_code}"
+                    logger.warning(f"{C_RED}[FETCH:OSINT] Failed to fetch {url} - Status: {r.status_code}{C_RESET}")
+                else:
+                    parse_start = time.perf_counter()
+                    digest = hashlib.sha256()
+                    async for line in r.aiter_lines():
+                        lines += 1
+                        digest.update(line.encode())
+                        ip = feed["parser"](line)
+                        if ip and ip not in seen:
+                            seen.add(ip)
+                            pending.append(ip)
+                            if len(pending) >= REDIS_WRITE_CHUNK_SIZE:
+                                await REDIS_CLIENT.sadd(staging_key, *pending)
+                                pending = []
+                    if pending:
+                        await REDIS_CLIENT.sadd(staging_key, *pending)
+                    content_hash = digest.hexdigest()
+                    OSINT_FEED_DURATION.labels(name, "parse").observe(time.perf_counter() - parse_start)
+
+                    extra = {}
+                    if not full_refresh and content_hash == meta.get("content_hash"):
+                        status = "unchanged"
+                        await REDIS_CLIENT.delete(staging_key)
                     else:
-                        logger.warning(f"{C_RED}[FETCH:OSINT] Failed to fetch {url} - Status: {r.status_code}{C_RESET}")
-                except Exception as ex:
-                    logger.error(f"{C_RED}[FETCH:OSINT] Error fetching {url}: {ex}{C_RESET}")
-                return local_count
-
-            # 1. Feodo Tracker
-            new_feodo = await process_text_feed("https://feodotracker.abuse.ch/downloads/ipblocklist.txt")
-            count += new_feodo
-            
-            # 2. IPSum (Top level)
-            new_ipsum = 0
-            try:
-                loop = asyncio.get_event_loop()
-                r = await loop.run_in_executor(None, lambda: requests.get("https://raw.githubusercontent.com/stamparm/ipsum/master/ipsum.txt", timeout=10))
-                if r.status_code == 200:
-                    for line in r.text.splitlines():
-                        if line and not line.startswith("#"):
-                            parts = line.split()
-                            if len(parts) > 1 and int(parts[1]) > 3:
-                                 ip = parts[0]
-                                 key = f"{KEY_OSINT}{ip}"
-                                 if not REDIS_CLIENT.exists(key):
-                                     new_ipsum += 1
-                                 REDIS_CLIENT.setex(key, timedelta(days=90), datetime.now().isoformat())
-            except Exception as e:
-                logger.error(f"❌ Error fetching IPSum: {e}")
-            count += new_ipsum
-
-            # 3. CINS Army
-            count += await process_text_feed("http://cinsscore.com/list/ci-badguys.txt")
-
-            # 4. GreenSnow
-            count += await process_text_feed("https://blocklist.greensnow.co/greensnow.txt")
-
-            # 5. Blocklist.de
-            count += await process_text_feed("https://lists.blocklist.de/lists/all.txt")
-
-            # 6. Emerging Threats
-            count += await process_text_feed("https://rules.emergingthreats.net/blockrules/compromised-ips.txt")
-
-            # 7. BinaryDefense
-            count += await process_text_feed("https://www.binarydefense.com/banlist.txt")
+                        if full_refresh:
+                            status = "full refresh"
+                            to_apply = list(seen)
+                            extra["last_full_apply"] = time.time()
+                        else:
+                            status = "changed"
+                            to_apply = list(await REDIS_CLIENT.sdiff(staging_key, snapshot_key))
+                        applied = len(to_apply)
+                        with OSINT_FEED_DURATION.labels(name, "store").time():
+                            new_count = await store_osint_ips(to_apply)
+                        if seen:
+                            await REDIS_CLIENT.rename(staging_key, snapshot_key)
+                        else:
+                            await REDIS_CLIENT.delete(snapshot_key)
+                    await save_feed_meta(name, r, content_hash, **extra)
+        except Exception as ex:
+            status = "error"
+            logger.error(f"{C_RED}[FETCH:OSINT] Error fetching {url}: {ex}{C_RESET}")
+
+        duration = time.perf_counter() - start_time
+        OSINT_FEED_DURATION.labels(name, "total").observe(duration)
+        OSINT_FEED_RUNS.labels(name, status).inc()
+        OSINT_FEED_NEW_IPS.labels(name).inc(new_count)
+        await REDIS_CLIENT.hset(KEY_OSINT_FEED_STATS, name, json.dumps({
+            "status": status,
+            "duration": round(duration, 3),
+            "lines": lines,
+            "ips": len(seen),
+            "applied": applied,
+            "new": new_count,
+            "updated": datetime.now().isoformat(),
+        }))
+        logger.info(f"{C_BLUE}[FETCH:OSINT] Feed '{name}' ({status}): {lines} lines, {len(seen)} IPs, {applied} applied, {new_count} new in {duration:.2f}s{C_RESET}")
+        return new_count
+
+async def run_osint_cycle() -> int:
+    """Fetches all OSINT feeds concurrently (bounded by OSINT_FETCH_CONCURRENCY). Returns the number of new IPs."""
+    logger.info(f"{C_CYAN}[FETCH:OSINT] Starting OSINT feed update cycle...{C_RESET}")
+    start_time = time.perf_counter()
+    semaphore = asyncio.Semaphore(OSINT_FETCH_CONCURRENCY)
+    with JOB_DURATION.labels("osint_cycle").time():
+        async with httpx.AsyncClient(headers={"User-Agent": HTTP_USER_AGENT}, follow_redirects=True) as client:
+            results = await asyncio.gather(*(process_osint_feed(client, feed, semaphore) for feed in OSINT_FEEDS))
+    count = sum(results)
+
+    # Update stats
+    await REDIS_CLIENT.set("stats:last_osint_count", count)
+    await REDIS_CLIENT.incrby(KEY_STATS_OSINT, count)
+    logger.info(f"{C_GREEN}[FETCH:OSINT] Feeds updated in {time.perf_counter() - start_time:.2f}s. Added {count} new IPs.{C_RESET}")
+    return count
 
-            # 8. DShield
-            count += await process_text_feed("https://feeds.dshield.org/block.txt")
+# --- Background Task: Global Blacklist Update ---
+def write_text_file(path: str, text: str):
+    with open(path, "w") as f:
+        f.write(text)
 
-            # 9. ThreatFox (CSV parsing)
-            new_threatfox = 0
-            try:
-                loop = asyncio.get_event_loop()
-                r = await loop.run_in_executor(None, lambda: requests.get("https://threatfox.abuse.ch/export/csv/ip-port/recent/", timeout=15))
-                if r.status_code == 200:
-                    for line in r.text.splitlines():
-                        if line and not line.startswith("#") and "ip:port" in line:
-                           parts = line.split(",")
-                           if len(parts) > 2:
-                               ioc_value = parts[2].replace('"', '')
-                               if ":" in ioc_value: # strip port
-                                   ioc_value = ioc_value.split(":")[0]
-                               
-                               key = f"{KEY_OSINT}{ioc_value}"
-                               if not REDIS_CLIENT.exists(key):
-                                   new_threatfox += 1
-                               REDIS_CLIENT.setex(key, timedelta(days=90), datetime.now().isoformat())
-            except Exception as e:
-                logger.error(f"❌ Error fetching ThreatFox: {e}")
-            count += new_threatfox
+def file_sha256(path: str) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
 
-            # Update stats
-            REDIS_CLIENT.set("stats:last_osint_count", count)
-            REDIS_CLIENT.incrby(KEY_STATS_OSINT, count)
-            logger.info(f"{C_GREEN}[FETCH:OSINT] Feeds updated. Added {count} new IPs.{C_RESET}")
-        except Exception as e:
-            logger.error(f"{C_RED}[FETCH:OSINT] Critical error fetching OSINT: {e}{C_RESET}")
-        
-        await asyncio.sleep(24 * 3600) # Every 24 hours
-
-# --- Background Task: Global Blacklist Update ---
-async def fetch_global_blacklist():
-    while True:
-        try:
-            logger.info(f"{C_CYAN}[FETCH:BLACKLIST] Starting global blacklist update...{C_RESET}")
-            r = requests.get(GLOBAL_BLACKLIST_URL, timeout=30)
-            if r.status_code == 200:
-                # Validate content briefly (check if it looks like a config file)
-                if r.text and len(r.text) > 10:
-                    with open("scan-blacklist.conf", "w") as f:
-                        f.write(r.text)
-                    logger.info(f"{C_GREEN}[FETCH:BLACKLIST] scan-blacklist.conf updated from Git.{C_RESET}")
-                    
-                    # Reload into Redis
-                    await load_blacklist_from_file()
-                else:
-                    logger.warning(f"{C_RED}[FETCH:BLACKLIST] Downloaded content seems empty or too short.{C_RESET}")
-            else:
-                logger.warning(f"{C_RED}[FETCH:BLACKLIST] Failed to fetch blacklist. Status: {r.status_code}{C_RESET}")
-        except Exception as e:
-            logger.error(f"{C_RED}[FETCH:BLACKLIST] Error updating global blacklist: {e}{C_RESET}")
-        
-        await asyncio.sleep(600) # Every 10 minutes
+async def run_global_blacklist_update() -> bool:
+    """Conditionally downloads the global scan-blacklist. Returns True if the file changed and was reloaded."""
+    logger.info(f"{C_CYAN}[FETCH:BLACKLIST] Starting global blacklist update...{C_RESET}")
+    meta = await get_feed_meta("global_blacklist")
+    # The scheduler lease can move between containers: only trust the stored validators
+    # if the local file is the download they describe
+    have_file = await asyncio.to_thread(file_sha256, "scan-blacklist.conf") == meta.get("content_hash")
+    headers = conditional_headers(meta) if have_file else {}
+
+    async with httpx.AsyncClient(headers={"User-Agent": HTTP_USER_AGENT}, follow_redirects=True) as client:
+        r = await client.get(GLOBAL_BLACKLIST_URL, timeout=30, headers=headers)
+
+    if r.status_code == 304:
+        logger.info(f"{C_BLUE}[FETCH:BLACKLIST] Not modified since last download, skipping.{C_RESET}")
+        return False
+    if r.status_code != 200:
+        logger.warning(f"{C_RED}[FETCH:BLACKLIST] Failed to fetch blacklist. Status: {r.status_code}{C_RESET}")
+        return False
+    # Validate content briefly (check if it looks like a config file)
+    if not r.text or len(r.text) <= 10:
+        logger.warning(f"{C_RED}[FETCH:BLACKLIST] Downloaded content seems empty or too short.{C_RESET}")
+        return False
+
+    content_hash = hashlib.sha256(r.content).hexdigest()
+    if have_file and content_hash == meta.get("content_hash"):
+        logger.info(f"{C_BLUE}[FETCH:BLACKLIST] Content unchanged, skipping.{C_RESET}")
+        await save_feed_meta("global_blacklist", r, content_hash)
+        return False
+
+    await asyncio.to_thread(write_text_file, "scan-blacklist.conf", r.text)
+    await save_feed_meta("global_blacklist", r, content_hash)
+    logger.info(f"{C_GREEN}[FETCH:BLACKLIST] scan-blacklist.conf updated from Git.{C_RESET}")
+
+    # Reload into Redis
+    await load_blacklist_from_file()
+    return True
+
+BACKGROUND_TASKS = set() # Strong references, so running tasks are not garbage-collected
+
+def background_task_done(task: asyncio.Task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"{C_RED}[SYSTEM] Background task '{task.get_name()}' stopped: {task.exception()!r}{C_RESET}")
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(background_task_done)
+    return task
 
 @app.on_event("startup")
 async def startup_event():
     log_logo()
     logger.info(f"{C_YELLOW}[SYSTEM] Starting application...{C_RESET}")
-    # Initialize optimized counters if they don't exist
-    if not REDIS_CLIENT.exists(KEY_STATS_LOCAL):
+    await check_storage_backend()
+    # Initialize optimized counters if they don't exist (legacy keys and compact entries)
+    if not await REDIS_CLIENT.exists(KEY_STATS_LOCAL):
         logger.info(f"{C_BLUE}[SYSTEM] Initializing stats:total_local counter...{C_RESET}")
-        local_count = len(REDIS_CLIENT.keys(f"{KEY_LOCAL}*"))
-        REDIS_CLIENT.set(KEY_STATS_LOCAL, local_count)
+        local_count = await count_indicators(SOURCE_LOCAL)
+        await REDIS_CLIENT.set(KEY_STATS_LOCAL, local_count)
         
-    if not REDIS_CLIENT.exists(KEY_STATS_OSINT):
+    if not await REDIS_CLIENT.exists(KEY_STATS_OSINT):
         logger.info(f"{C_BLUE}[SYSTEM] Initializing stats:total_osint counter...{C_RESET}")
-        osint_count = len(REDIS_CLIENT.keys(f"{KEY_OSINT}*"))
-        REDIS_CLIENT.set(KEY_STATS_OSINT, osint_count)
+        osint_count = await count_indicators(SOURCE_OSINT)
+        await REDIS_CLIENT.set(KEY_STATS_OSINT, osint_count)
+
+    # The cleanup job reloads the blacklist too, but it may not be due yet after a restart.
+    # Skipped cheaply when the files are unchanged, so every worker can do it.
+    await load_blacklist_from_file()
+    await refresh_list_snapshot(force=True)
+    API_KEY_CACHE.sync_generation(await REDIS_CLIENT.get(KEY_API_KEYS_GENERATION))
     
-    asyncio.create_task(fetch_osint_feeds())
-    asyncio.create_task(fetch_global_blacklist())
-    asyncio.create_task(periodic_db_cleanup())
-    asyncio.create_task(periodic_logo_display())
-
-async def periodic_logo_display():
-    """Displays the logo every 12 hours."""
-    while True:
-        await asyncio.sleep(12 * 3600)
-        log_logo()
+    start_background_task(generation_watcher())
+    start_background_task(HEALTH_PROBER.run())
+    start_background_task(STATS_SNAPSHOT.run())
+    start_background_task(BAN_FEED.run())
+    start_background_task(INDICATOR_FILTER.run())
+    start_background_task(monitor_event_loop_lag())
+    if WEBHOOK_WRITE_BEHIND:
+        WEBHOOK_BUFFER.start()
+    # OSINT feeds, global blacklist, DB cleanup and the logo run on the scheduler leader only
+    start_background_task(SCHEDULER.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if WEBHOOK_WRITE_BEHIND:
+        logger.info(f"{C_YELLOW}[SYSTEM] Draining webhook write-behind buffer ({len(WEBHOOK_BUFFER.pending)} IPs)...{C_RESET}")
+        await WEBHOOK_BUFFER.close()
+    await SCHEDULER.release()
+    for task in list(BACKGROUND_TASKS):
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    logger.info(f"{C_YELLOW}[SYSTEM] Shutting down, closing Redis connection pool...{C_RESET}")
+    await REDIS_CLIENT.aclose()
+    await REDIS_POOL.disconnect()
+
+async def display_logo():
+    """Scheduled every 12 hours."""
+    log_logo()
 
-async def load_blacklist_from_file():
-    """Reads scan-blacklist.conf and scan-blacklist-custom.conf to populate REDIS_CLIENT's blacklist."""
+BLACKLIST_CONF_FILES = ["scan-blacklist.conf", "scan-blacklist-custom.conf"]
+
+def parse_rule_line(line: str) -> str:
+    """Rule text of one config/import line without comments and whitespace (may be empty)."""
+    return line.split("#")[0].strip()
+
+def read_blacklist_files():
+    """Parses the blacklist config files. Returns (rules, per-file rule counts, sha256 of the raw files)."""
+    rules = []
+    counts = {}
+    digest = hashlib.sha256()
+    for conf_path in BLACKLIST_CONF_FILES:
+        if not os.path.exists(conf_path):
+            counts[conf_path] = None
+            continue
+        with open(conf_path, "rb") as f:
+            raw = f.read()
+        digest.update(conf_path.encode() + b"\0" + raw + b"\0")
+        count = 0
+        for line in raw.decode("utf-8", errors="replace").splitlines():
+            rule = parse_rule_line(line)
+            if rule:
+                rules.append(rule)
+                count += 1
+        counts[conf_path] = count
+    return rules, counts, digest.hexdigest()
+
+async def load_blacklist_from_file(force: bool = False) -> bool:
+    """
+    Reads scan-blacklist.conf and scan-blacklist-custom.conf into REDIS_CLIENT's blacklist.
+    The new set is built in a staging key and swapped in with RENAME inside one
+    transaction, so readers never see an empty or partial blacklist. Skipped when
+    the files are unchanged since the last load. Returns True if the blacklist was replaced.
+    """
     start_time = time.perf_counter()
     logger.info(f"{C_CYAN}[CACHE:WEBHOOK] Initiating blacklist cache reload...{C_RESET}")
-    
-    # Optional: Clear existing blacklist to ensure we reflect removals
-    # Using a temporary set would be atomic, but for now we simply delete and reload
-    REDIS_CLIENT.delete(KEY_BLACKLIST)
-    
-    conf_files = ["scan-blacklist.conf", "scan-blacklist-custom.conf"]
-    total_loaded = 0
-    
-    for conf_path in conf_files:
-        if os.path.exists(conf_path):
-            try:
-                count = 0
-                with open(conf_path, "r") as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith("#"):
-                            # Strip inline comments
-                            if "#" in line:
-                                line = line.split("#")[0]
-                            line = line.strip()
-                            if line:
-                                REDIS_CLIENT.sadd(KEY_BLACKLIST, line)
-                                count += 1
-                total_loaded += count
-                logger.info(f"{C_BLUE}[CACHE:WEBHOOK] Source '{conf_path}': processed {count} rules{C_RESET}")
-            except Exception as e:
-                logger.error(f"{C_RED}[CACHE:WEBHOOK] Error loading {conf_path}: {e}{C_RESET}")
+
+    try:
+        rules, counts, source_hash = await asyncio.to_thread(read_blacklist_files)
+    except OSError as e:
+        logger.error(f"{C_RED}[CACHE:WEBHOOK] Error reading blacklist files: {e}{C_RESET}")
+        return False
+
+    for conf_path, count in counts.items():
+        if count is not None:
+            logger.info(f"{C_BLUE}[CACHE:WEBHOOK] Source '{conf_path}': processed {count} rules{C_RESET}")
+        elif conf_path == "scan-blacklist.conf":
+            logger.warning(f"{C_YELLOW}[CACHE:WEBHOOK] Warning: {conf_path} not found.{C_RESET}")
         else:
-            if conf_path == "scan-blacklist.conf":
-                logger.warning(f"{C_YELLOW}[CACHE:WEBHOOK] Warning: {conf_path} not found.{C_RESET}")
-            else:
-                logger.info(f"{C_BLUE}[CACHE:WEBHOOK] Info: {conf_path} not found (optional) - Skipping.{C_RESET}")
+            logger.info(f"{C_BLUE}[CACHE:WEBHOOK] Info: {conf_path} not found (optional) - Skipping.{C_RESET}")
+
+    if not force and source_hash == await REDIS_CLIENT.get(KEY_BLACKLIST_SOURCE_HASH):
+        logger.info(f"{C_BLUE}[CACHE:WEBHOOK] Blacklist files unchanged, skipping reload.{C_RESET}")
+        return False
+
+    # Build the new set next to the live one and swap it in atomically
+    pipe = REDIS_CLIENT.pipeline(transaction=True)
+    pipe.unlink(KEY_BLACKLIST_STAGING)
+    for i in range(0, len(rules), REDIS_WRITE_CHUNK_SIZE):
+        pipe.sadd(KEY_BLACKLIST_STAGING, *rules[i:i + REDIS_WRITE_CHUNK_SIZE])
+    if rules:
+        pipe.rename(KEY_BLACKLIST_STAGING, KEY_BLACKLIST)
+    else:
+        pipe.unlink(KEY_BLACKLIST)
+    pipe.set(KEY_BLACKLIST_SOURCE_HASH, source_hash)
+    pipe.incr(KEY_LISTS_GENERATION)
+    pipe.scard(KEY_BLACKLIST)
+    final_count = (await pipe.execute())[-1]
 
-    final_count = REDIS_CLIENT.scard(KEY_BLACKLIST)
     duration = time.perf_counter() - start_time
+    JOB_DURATION.labels("blacklist_reload").observe(duration)
     logger.info(f"{C_GREEN}[CACHE:WEBHOOK] Cache reload complete in {duration:.4f}s.{C_RESET}")
-    logger.info(f"{C_GREEN}[CACHE:WEBHOOK] Cache Load Status: {final_count} Active Rules (from {total_loaded} processed entries){C_RESET}")
-    
+    logger.info(f"{C_GREEN}[CACHE:WEBHOOK] Cache Load Status: {final_count} Active Rules (from {len(rules)} processed entries){C_RESET}")
+
+    await refresh_list_snapshot(force=True)
+
     # Recalculate IP stats
     await recalculate_all_stats()
+    return True
 
 async def recalculate_all_stats():
-    """Recalculates IP counts for both blacklist and whitelist."""
-    await calculate_and_cache_ip_stats(KEY_BLACKLIST, "stats:blacklist_ip_count", "BLACKLIST")
-    await calculate_and_cache_ip_stats(KEY_WHITELIST, "stats:whitelist_ip_count", "WHITELIST")
-
-async def calculate_and_cache_ip_stats(set_key, stats_key, label):
-    """Calculates the total number of IPs in a set (expanding CIDRs) and caches it."""
-    try:
-        members = REDIS_CLIENT.smembers(set_key)
-        total_ips = 0
-        for member in members:
-            try:
-                # Basic cleaning
-                clean_member = member.strip()
-                if not clean_member: continue
-                
-                if "/" in clean_member:
-                    total_ips += ipaddress.ip_network(clean_member, strict=False).num_addresses
-                else:
-                    total_ips += 1
-            except ValueError:
-                logger.warning(f"{C_RED}[STATS] Invalid IP/CIDR in {label}: {member}{C_RESET}")
-                continue
-        
-        REDIS_CLIENT.set(stats_key, total_ips)
-        logger.info(f"{C_GREEN}[STATS] {label} IP count updated: {total_ips} IPs.{C_RESET}")
-    except Exception as e:
-        logger.error(f"{C_RED}[STATS] Error calculating {label} IPs: {e}{C_RESET}")
+    """Stores the number of unique IPs covered by blacklist and whitelist (overlapping rules count once)."""
+    await refresh_list_snapshot()
+    blacklist_ips = LIST_SNAPSHOT.blacklist_index.address_count()
+    whitelist_ips = LIST_SNAPSHOT.whitelist_index.address_count()
+    if await store_list_stats(["blacklist", "whitelist"]):
+        logger.info(f"{C_GREEN}[STATS] IP counts updated: BLACKLIST {blacklist_ips} IPs, WHITELIST {whitelist_ips} IPs.{C_RESET}")
+    else:
+        logger.info(f"{C_BLUE}[STATS] Lists changed while counting, the newer edit stores its own counts.{C_RESET}")
+    await STATS_SNAPSHOT.refresh()
 
-def purge_test_ip():
+async def purge_test_ip():
     """Specifically removes the test IP 1.2.3.4 from the database."""
     test_ip = "1.2.3.4"
     logger.info(f"{C_CYAN}[CLEAN:TEST_IP] Purging test IP: {test_ip}{C_RESET}")
     
-    # Remove from local
-    REDIS_CLIENT.delete(f"{KEY_LOCAL}{test_ip}")
-    
-    # Remove from OSINT
-    REDIS_CLIENT.delete(f"{KEY_OSINT}{test_ip}")
+    # Remove from local and OSINT
+    await remove_indicators([test_ip], SOURCE_LOCAL | SOURCE_OSINT)
 
-async def periodic_db_cleanup():
-    """Runs database cleanup tasks periodically."""
-    while True:
+async def purge_blacklisted_indicators(full: bool = False) -> dict:
+    """
+    Removes stored indicators covered by the blacklist. Returns removed IPs per source.
+    Only rules added since the last run (ti:blacklist minus ti:blacklist:applied) are
+    applied, each one expanded against the stored IPs it covers. A full pass over all
+    stored IPs runs only when forced or when no previous run is recorded.
+    """
+    removed = {SOURCE_LOCAL: 0, SOURCE_OSINT: 0}
+    full = full or not await REDIS_CLIENT.exists(KEY_BLACKLIST_APPLIED)
+    if full:
+        rules = await REDIS_CLIENT.smembers(KEY_BLACKLIST)
+    else:
+        rules = await REDIS_CLIENT.sdiff(KEY_BLACKLIST, KEY_BLACKLIST_APPLIED)
+    if not rules:
+        # Forget rules that left the blacklist, so they are re-applied if they come back
+        await REDIS_CLIENT.sinterstore(KEY_BLACKLIST_APPLIED, [KEY_BLACKLIST_APPLIED, KEY_BLACKLIST])
+        logger.info(f"{C_BLUE}[CLEAN:DB] No new blacklist rules since last cleanup, skipping IP purge.{C_RESET}")
+        return removed
+
+    networks = []
+    for rule in rules:
         try:
-            logger.info(f"{C_CYAN}[CLEAN:DB] Starting periodic database cleanup...{C_RESET}")
-            
-            # 1. Reload blacklist from file
-            await load_blacklist_from_file()
-            
-            # 2. Purge test IP
-            purge_test_ip()
-            
-            # 3. Fetch blacklist once for optimization
-            blacklist_members = REDIS_CLIENT.smembers(KEY_BLACKLIST)
-            if not blacklist_members:
-                logger.info(f"{C_YELLOW}[CLEAN:DB] Blacklist is empty, skipping IP scan.{C_RESET}")
-            else:
-                # 4. Purge blacklisted IPs from DB
-                removed_local = 0
-                removed_osint = 0
-                total_scanned = 0
-
-                # Cleanup ti:local:*
-                cursor = 0
-                while True:
-                    cursor, keys = REDIS_CLIENT.scan(cursor=cursor, match=f"{KEY_LOCAL}*", count=1000)
-                    total_scanned += len(keys)
-                    for key in keys:
-                        ip = key.replace(KEY_LOCAL, "")
-                        if is_ip_in_cidr_list(ip, blacklist_members):
-                            logger.info(f"{C_RED}[CLEAN:DB] Removing blacklisted local IP: {ip}{C_RESET}")
-                            REDIS_CLIENT.delete(key)
-                            REDIS_CLIENT.decr(KEY_STATS_LOCAL)
-                            removed_local += 1
-                        await asyncio.sleep(0) # Let other tasks run
-                    if str(cursor) == '0':
-                        break
-                
-                # Cleanup ti:osint:*
-                cursor = 0
-                while True:
-                    cursor, keys = REDIS_CLIENT.scan(cursor=cursor, match=f"{KEY_OSINT}*", count=1000)
-                    total_scanned += len(keys)
-                    for key in keys:
-                        ip = key.replace(KEY_OSINT, "")
-                        if is_ip_in_cidr_list(ip, blacklist_members):
-                            logger.info(f"{C_RED}[CLEAN:DB] Removing blacklisted OSINT IP: {ip}{C_RESET}")
-                            REDIS_CLIENT.delete(key)
-                            REDIS_CLIENT.decr(KEY_STATS_OSINT)
-                            removed_osint += 1
-                        await asyncio.sleep(0) # Let other tasks run
-                    if str(cursor) == '0':
-                        break
-
-                logger.info(f"{C_GREEN}[CLEAN:DB] Cleanup finished. Scanned {total_scanned} keys, removed {removed_local} local, {removed_osint} osint IPs.{C_RESET}")
+            networks.append(ipaddress.ip_network(rule, strict=False))
+        except ValueError:
+            continue
+
+    # Expand small rules directly, collect the rest for a single scan
+    targets = {SOURCE_LOCAL: set(), SOURCE_OSINT: set()}
+    scan_rules = []
+    if full or len(networks) > CLEANUP_EXPAND_MAX_RULES:
+        scan_rules = networks
+    else:
+        # The expansion budget is per run: once it is spent, the remaining rules share one scan
+        budget = CLEANUP_EXPAND_MAX_TOTAL
+        for network in networks:
+            cost = network_expansion_cost(network)
+            if cost > budget:
+                scan_rules.append(network)
+                continue
+            budget -= cost
+            found = await find_indicators_in_network(network)
+            if found is None:
+                scan_rules.append(network)
+                continue
+            for ip, mask in found.items():
+                for source in targets:
+                    if mask & source:
+                        targets[source].add(ip)
+
+    total_scanned = 0
+    if scan_rules:
+        index = CIDRIndex(str(network) for network in scan_rules)
+        for source in targets:
+            async for ips in iter_indicators(source):
+                total_scanned += len(ips)
+                targets[source].update(ip for ip in ips if ip in index)
+                await asyncio.sleep(0) # Let other tasks run
+
+    counters = {SOURCE_LOCAL: (KEY_STATS_LOCAL, "local"), SOURCE_OSINT: (KEY_STATS_OSINT, "OSINT")}
+    for source, ips in targets.items():
+        if ips:
+            for ip in ips:
+                logger.info(f"{C_RED}[CLEAN:DB] Removing blacklisted {counters[source][1]} IP: {ip}{C_RESET}")
+            removed[source] = await remove_indicators(list(ips), source)
+
+    # One counter adjustment per source, and remember which rules are applied
+    rules = list(rules)
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for source, count in removed.items():
+        if count:
+            pipe.decrby(counters[source][0], count)
+    if full:
+        pipe.unlink(KEY_BLACKLIST_APPLIED)
+    for i in range(0, len(rules), REDIS_WRITE_CHUNK_SIZE):
+        pipe.sadd(KEY_BLACKLIST_APPLIED, *rules[i:i + REDIS_WRITE_CHUNK_SIZE])
+    pipe.sinterstore(KEY_BLACKLIST_APPLIED, [KEY_BLACKLIST_APPLIED, KEY_BLACKLIST])
+    await pipe.execute()
+
+    mode = "full" if full else "incremental"
+    logger.info(f"{C_GREEN}[CLEAN:DB] Blacklist purge ({mode}): {len(rules)} rules, {len(scan_rules)} via scan of {total_scanned} keys, removed {removed[SOURCE_LOCAL]} local, {removed[SOURCE_OSINT]} osint IPs.{C_RESET}")
+    return removed
+
+async def run_db_cleanup():
+    """One cleanup pass: blacklist reload, test IP purge, expiry sweep and blacklist purge."""
+    logger.info(f"{C_CYAN}[CLEAN:DB] Starting periodic database cleanup...{C_RESET}")
+    with JOB_DURATION.labels("db_cleanup").time():
+        # 1. Reload blacklist from file
+        await load_blacklist_from_file()
+
+        # 2. Purge test IP
+        await purge_test_ip()
+
+        # 3. Drop expired compact entries and log legacy keys that expired via TTL (recount without the index)
+        expired = await sweep_expired_indicators()
+        if expired:
+            logger.info(f"{C_BLUE}[CLEAN:DB] Swept {expired} expired entries.{C_RESET}")
+
+        # 4. Purge IPs covered by blacklist rules added since the last run
+        await purge_blacklisted_indicators()
+
+# --- Background Task: Banned-IP Feed Export ---
+BAN_FEED_VARIANTS = {"all": (SOURCE_LOCAL, SOURCE_OSINT), "local": (SOURCE_LOCAL,), "osint": (SOURCE_OSINT,)}
+
+def render_ban_feeds(by_source: dict, whitelist_rules: set, previous: dict) -> dict:
+    """
+    Builds the feed artifact of every variant (runs in a worker thread). Variants whose
+    content did not change keep their previous artifact, so their ETag stays stable.
+    """
+    whitelist = CIDRIndex(whitelist_rules)
+    entries = {}
+    for source, ips in by_source.items():
+        parsed = set()
+        for ip in ips:
+            try:
+                addr = ipaddress.ip_address(ip)
+            except ValueError:
+                continue # Not usable by firewall clients
+            if whitelist.rule_count and ip in whitelist:
+                continue
+            parsed.add((addr.version, int(addr), str(addr)))
+        entries[source] = parsed
+
+    artifacts = {}
+    now = time.time()
+    for variant, sources in BAN_FEED_VARIANTS.items():
+        rows = sorted(set().union(*(entries[source] for source in sources)))
+        body = "".join(f"{row[2]}\n" for row in rows).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        old = previous.get(variant)
+        if old and old["etag"] == etag:
+            artifacts[variant] = old
+            continue
+        artifacts[variant] = {
+            "etag": etag,
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+            "count": len(rows),
+            "size": len(body),
+            "changed_at": now,
+            "last_modified": formatdate(now, usegmt=True),
+        }
+    return artifacts
+
+def write_binary_file(path: str, data: bytes):
+    """Writes a file atomically (temp file + rename), so readers never see a partial artifact."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Stores a feed build while the lease still carries the builder's token, so a node that
+# lost leadership cannot overwrite its successor's feed. Artifacts are keyed by ETag; an
+# empty artifact keeps the stored one, artifacts no variant uses any more are dropped.
+# Returns the new generation, or 0 if the lease has moved on.
+# KEYS[1]: scheduler lease, KEYS[2]: feed hash, ARGV[1]: "{token}:{node}", ARGV[2]: meta JSON,
+# ARGV[3..]: (etag, base64 artifact or '') per variant
+PUBLISH_BAN_FEED_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+local keep = {}
+for i = 3, #ARGV, 2 do
+    local field = 'gzip:' .. ARGV[i]
+    keep[field] = true
+    if ARGV[i + 1] ~= '' then redis.call('HSET', KEYS[2], field, ARGV[i + 1]) end
+end
+for _, field in ipairs(redis.call('HKEYS', KEYS[2])) do
+    if string.sub(field, 1, 5) == 'gzip:' and not keep[field] then redis.call('HDEL', KEYS[2], field) end
+end
+redis.call('HSET', KEYS[2], 'meta', ARGV[2])
+return redis.call('HINCRBY', KEYS[2], 'generation', 1)
+"""
+
+PUBLISH_BAN_FEED_SCRIPT = REDIS_CLIENT.register_script(PUBLISH_BAN_FEED_LUA)
+BAN_FEED_META_FIELDS = ("etag", "count", "size", "changed_at", "last_modified")
+
+class BanFeed:
+    """
+    Precomputed banned-IP feed for fail2ban clients: local + OSINT indicators minus the
+    whitelist, one IP per line, kept gzip-compressed per variant (all/local/osint).
+    Only the scheduler leader builds it: when the change log moved past the last build
+    (at most every min_interval) and every interval. The build is stored in KEY_BAN_FEED,
+    and every worker loads a new generation from there, so all workers and containers
+    serve the same bytes, ETags and cursor. Serving the feed never touches Redis.
+    """
+    def __init__(self, interval: float, min_interval: float, export_dir: str):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.export_dir = export_dir
+        self.artifacts = {} # variant -> {etag, gzip, count, size, changed_at, last_modified}
+        self.generation = None # KEY_BAN_FEED generation the artifacts belong to
+        self.published_token = 0 # Fencing token of this node's last published build
+        self.cursor = "0-0" # Change log position the current artifacts include
+        self.builds = 0
+        self.loads = 0
+        self.built_at = 0.0
+        self.build_seconds = 0.0
+        self.built_by = None
+
+    async def build_due(self) -> bool:
+        age = time.time() - self.built_at
+        if age >= self.interval:
+            return True
+        return age >= self.min_interval and await latest_change_id() != self.cursor
+
+    async def build(self, token: int, lease_value: str) -> int:
+        """Rebuilds all variants and publishes them. Returns the number of variants whose content changed."""
+        start = time.perf_counter()
+        # Changes logged after this point are replayed by /v3/feed/changes from this cursor
+        cursor = await latest_change_id()
+        await refresh_list_snapshot()
+        by_source = {}
+        for source in SOURCE_PREFIXES:
+            ips = set()
+            async for batch in iter_indicators(source):
+                ips.update(batch)
+            by_source[source] = ips
+
+        previous = self.artifacts
+        artifacts = await asyncio.to_thread(render_ban_feeds, by_source, set(LIST_SNAPSHOT.whitelist), previous)
+        changed = [variant for variant, artifact in artifacts.items() if previous.get(variant) is not artifact]
+        built_at = time.time()
+        build_seconds = time.perf_counter() - start
+        meta = {
+            "cursor": cursor, "built_at": built_at, "build_seconds": build_seconds, "node": SCHEDULER.node,
+            "variants": {variant: {field: artifact[field] for field in BAN_FEED_META_FIELDS} for variant, artifact in artifacts.items()},
+        }
+        # A new leader sends every artifact, in case the stored ones are missing
+        upload = set(artifacts) if token != self.published_token else set(changed)
+        args = [lease_value, json.dumps(meta)]
+        for variant, artifact in artifacts.items():
+            args.extend((artifact["etag"], base64.b64encode(artifact["gzip"]).decode() if variant in upload else ""))
+        generation = await PUBLISH_BAN_FEED_SCRIPT(keys=[KEY_SCHEDULER_LEASE, KEY_BAN_FEED], args=args)
+        if not generation:
+            logger.warning(f"{C_YELLOW}[FEED:EXPORT] Lost the scheduler lease during the build, feed not published.{C_RESET}")
+            return 0
+
+        self.published_token = token
+        self.apply(str(generation), meta, artifacts)
+        await self.export(changed)
+        self.builds += 1
+        if changed:
+            logger.info(f"{C_BLUE}[FEED:EXPORT] Rebuilt {', '.join(changed)} in {build_seconds:.2f}s ({artifacts['all']['count']} IPs, {len(artifacts['all']['gzip'])} bytes gzip).{C_RESET}")
+        return len(changed)
+
+    async def load(self) -> int:
+        """Loads a newer generation from KEY_BAN_FEED. Returns the number of variants that changed."""
+        generation, meta = await REDIS_CLIENT.hmget(KEY_BAN_FEED, "generation", "meta")
+        if generation is None or generation == self.generation:
+            return 0
+        meta = json.loads(meta)
+        changed = [variant for variant, info in meta["variants"].items()
+                   if self.artifacts.get(variant, {}).get("etag") != info["etag"]]
+        blobs = await REDIS_CLIENT.hmget(KEY_BAN_FEED, *[f"gzip:{meta['variants'][variant]['etag']}" for variant in changed]) if changed else []
+        if None in blobs:
+            return 0 # Replaced by a newer build in between, picked up on the next poll
+        artifacts = {variant: self.artifacts[variant] for variant in meta["variants"] if variant not in changed}
+        for variant, blob in zip(changed, blobs):
+            artifacts[variant] = {**meta["variants"][variant], "gzip": await asyncio.to_thread(base64.b64decode, blob)}
+        self.apply(generation, meta, artifacts)
+        await self.export(changed)
+        self.loads += 1
+        return len(changed)
+
+    def apply(self, generation: str, meta: dict, artifacts: dict):
+        self.artifacts = artifacts
+        self.generation = generation
+        self.cursor = meta["cursor"]
+        self.built_at = meta["built_at"]
+        self.build_seconds = meta["build_seconds"]
+        self.built_by = meta["node"]
+
+    async def export(self, variants: List[str]):
+        if self.export_dir:
+            for variant in variants:
+                name = "banned_ips.txt.gz" if variant == "all" else f"banned_ips_{variant}.txt.gz"
+                await asyncio.to_thread(write_binary_file, os.path.join(self.export_dir, name), self.artifacts[variant]["gzip"])
+
+    async def run(self):
+        while True:
+            try:
+                await self.load() # Also picks up the last build of a previous leader
+                token = SCHEDULER.token
+                if token and await self.build_due():
+                    await self.build(token, SCHEDULER.lease_value)
+            except Exception as e:
+                logger.error(f"{C_RED}[FEED:EXPORT] Error updating banned-IP feed: {e}{C_RESET}")
+            await asyncio.sleep(GENERATION_POLL_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            "generation": self.generation,
+            "builds": self.builds,
+            "loads": self.loads,
+            "built_at": datetime.fromtimestamp(self.built_at).isoformat() if self.built_at else None,
+            "built_by": self.built_by,
+            "build_seconds": round(self.build_seconds, 3),
+            "cursor": self.cursor,
+            "variants": {
+                variant: {"count": artifact["count"], "bytes": artifact["size"], "gzip_bytes": len(artifact["gzip"]), "etag": artifact["etag"]}
+                for variant, artifact in self.artifacts.items()
+            },
+        }
+
+BAN_FEED = BanFeed(FEED_EXPORT_INTERVAL, FEED_EXPORT_MIN_INTERVAL, FEED_EXPORT_DIR)
+
+# --- Background Scheduler ---
+# Takes the lease if it is free or renews it if this node holds it. A new lease gets the
+# next fencing token. Returns the token, or 0 if another node leads.
+# KEYS[1]: lease, KEYS[2]: fence counter, ARGV[1]: node, ARGV[2]: lease TTL in ms
+ACQUIRE_LEASE_LUA = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local token, node = string.match(current, '^(%d+):(.*)$')
+    if node ~= ARGV[1] then return 0 end
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(token)
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token .. ':' .. ARGV[1], 'PX', ARGV[2])
+return token
+"""
+
+# Runs only while the lease still carries the caller's token, so a node that lost
+# leadership can neither record a job run nor drop the new leader's lease.
+# KEYS[1]: lease, KEYS[2]: jobs hash, ARGV[1]: "{token}:{node}", ARGV[2]: job ('' releases), ARGV[3]: JSON
+FENCED_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+end
+return 1
+"""
+
+ACQUIRE_LEASE_SCRIPT = REDIS_CLIENT.register_script(ACQUIRE_LEASE_LUA)
+FENCED_LEASE_SCRIPT = REDIS_CLIENT.register_script(FENCED_LEASE_LUA)
+
+class ScheduledJob:
+    def __init__(self, name: str, func, interval: float, run_at_start: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.run_at_start = run_at_start # False: first run one interval after taking the lease
+
+class Scheduler:
+    """
+    Runs the periodic jobs on exactly one process across all workers and containers.
+    Every process competes for a Redis lease; the holder renews it every third of the
+    TTL and starts jobs whose last recorded run is older than their interval. A dead
+    leader's lease expires and another process takes over with a higher fencing token.
+    Job runs are recorded under that token only, and a leader that cannot renew in
+    time cancels its running jobs.
+    Fencing covers the scheduler's own bookkeeping (run records, lease release), not the
+    jobs' writes: a paused leader may still finish a job while its successor starts the
+    same one. The jobs are idempotent (upserts, hash-guarded reloads), so such an overlap
+    costs duplicate work, not wrong data.
+    """
+    def __init__(self, jobs: List[ScheduledJob], lease_ttl: float):
+        self.jobs = {job.name: job for job in jobs}
+        self.lease_ttl = lease_ttl
+        self.node = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.token = 0 # Fencing token while leading, 0 otherwise
+        self.leader_since = 0.0
+        self.renewed_at = 0.0 # time.monotonic() of the last successful renewal
+        self.tasks = {} # job name -> running asyncio.Task
+        self.records = {} # job name -> last run as recorded in Redis
+
+    @property
+    def lease_value(self) -> str:
+        return f"{self.token}:{self.node}"
+
+    def step_down(self, reason: str):
+        if self.token:
+            logger.warning(f"{C_YELLOW}[SCHEDULER] Lost leadership ({reason}), cancelling {len(self.tasks)} running job(s).{C_RESET}")
+        self.token = 0
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+
+    async def tick(self):
+        # Prune before reading the run records, so a job that just finished is judged by its new record
+        self.tasks = {name: task for name, task in self.tasks.items() if not task.done()}
+        pipe = REDIS_CLIENT.pipeline(transaction=False)
+        await ACQUIRE_LEASE_SCRIPT(keys=[KEY_SCHEDULER_LEASE, KEY_SCHEDULER_FENCE], args=[self.node, int(self.lease_ttl * 1000)], client=pipe)
+        pipe.hgetall(KEY_SCHEDULER_JOBS)
+        token, records = await pipe.execute()
+        self.records = {name: json.loads(value) for name, value in records.items()}
+        token = int(token)
+        if not token:
+            self.step_down("lease held by another node")
+            return
+        if token != self.token:
+            self.step_down("lease re-acquired")
+            self.token = token
+            self.leader_since = time.time()
+            logger.info(f"{C_GREEN}[SCHEDULER] {self.node} is now running the periodic jobs (fencing token {token}).{C_RESET}")
+        self.renewed_at = time.monotonic()
+
+        now = time.time()
+        for job in self.jobs.values():
+            if job.name in self.tasks:
+                continue
+            last_run = self.records.get(job.name, {}).get("started")
+            if last_run is None and not job.run_at_start:
+                last_run = self.leader_since
+            if last_run is None or now - last_run >= job.interval:
+                self.tasks[job.name] = asyncio.create_task(self.run_job(job, token))
+
+    async def run_job(self, job: ScheduledJob, token: int):
+        started = time.time()
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            await job.func()
         except Exception as e:
-            logger.error(f"{C_RED}[CLEAN:DB] Error during periodic cleanup: {e}{C_RESET}")
-        
-        await asyncio.sleep(3600) # Every 1 hour
+            status = "error"
+            logger.error(f"{C_RED}[SCHEDULER] Job '{job.name}' failed: {e}{C_RESET}")
+        record = {"started": started, "duration": round(time.perf_counter() - start, 3),
+                  "status": status, "node": self.node, "token": token}
+        if not await FENCED_LEASE_SCRIPT(keys=[KEY_SCHEDULER_LEASE, KEY_SCHEDULER_JOBS], args=[f"{token}:{self.node}", job.name, json.dumps(record)]):
+            logger.warning(f"{C_YELLOW}[SCHEDULER] Job '{job.name}' finished after losing the lease, run not recorded.{C_RESET}")
+
+    async def run(self):
+        interval = self.lease_ttl / 3
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"{C_RED}[SCHEDULER] Error renewing the scheduler lease: {e}{C_RESET}")
+                if self.token and time.monotonic() - self.renewed_at >= self.lease_ttl - interval:
+                    # The lease may already have passed to another node
+                    self.step_down("lease not renewed in time")
+            await asyncio.sleep(interval)
+
+    async def release(self):
+        """Hands the lease over on shutdown instead of letting it expire."""
+        if self.token:
+            lease_value = self.lease_value
+            self.step_down("shutdown")
+            await FENCED_LEASE_SCRIPT(keys=[KEY_SCHEDULER_LEASE, KEY_SCHEDULER_JOBS], args=[lease_value, "", ""])
+
+    def stats(self) -> dict:
+        return {
+            "node": self.node,
+            "leader": bool(self.token),
+            "fencing_token": self.token or None,
+            "leader_since": datetime.fromtimestamp(self.leader_since).isoformat() if self.token else None,
+            "running": sorted(self.tasks),
+            "jobs": {
+                name: {
+                    "interval": job.interval,
+                    "last_run": datetime.fromtimestamp(self.records[name]["started"]).isoformat() if name in self.records else None,
+                    **{key: value for key, value in self.records.get(name, {}).items() if key != "started"},
+                }
+                for name, job in self.jobs.items()
+            },
+        }
+
+SCHEDULER = Scheduler([
+    ScheduledJob("osint_feeds", run_osint_cycle, 24 * 3600),
+    ScheduledJob("global_blacklist", run_global_blacklist_update, 600),
+    ScheduledJob("db_cleanup", run_db_cleanup, 3600),
+    ScheduledJob("logo", display_logo, 12 * 3600, run_at_start=False),
+], SCHEDULER_LEASE_TTL)
 
 # --- API Routes ---
 
+async def verify_api_key(apikey: str):
+    valid = API_KEY_CACHE.get(apikey)
+    if valid is None:
+        # Check both old and new keys for compatibility (one round-trip)
+        pipe = REDIS_CLIENT.pipeline(transaction=False)
+        pipe.sismember(KEY_API_KEYS, apikey)
+        pipe.hexists(KEY_API_KEYS_V2, apikey)
+        legacy, v2 = await pipe.execute()
+        valid = bool(legacy or v2)
+        API_KEY_CACHE.put(apikey, valid)
+    if not valid:
+        raise HTTPException(status_code=403, detail="Invalid API Key")
+
+async def reputation_batch_response(ips: List[str]):
+    if len(ips) > REPUTATION_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Too many resources (max {REPUTATION_BATCH_MAX})")
+
+    results = await get_ip_reputation_batch(ips)
+    high = sum(1 for severity, _ in results.values() if severity == "high")
+    medium = sum(1 for severity, _ in results.values() if severity == "medium")
+    logger.info(f"{C_BLUE}[REPUTATION] Batch IP Check: {len(results)} IPs - {high} high, {medium} medium risk{C_RESET}")
+    return format_threatbook_v3_batch(results)
+
 @app.get("/v3/scene/ip_reputation")
 async def ip_reputation(resource: str, apikey: str):
-    # Check both old and new keys for compatibility
-    if not REDIS_CLIENT.sismember(KEY_API_KEYS, apikey) and not REDIS_CLIENT.hexists(KEY_API_KEYS_V2, apikey):
-        raise HTTPException(status_code=403, detail="Invalid API Key")
+    await verify_api_key(apikey)
+
+    # ThreatBook-style multi-resource query (comma-separated)
+    if "," in resource:
+        return await reputation_batch_response(parse_resource_list([resource]))
     
-    severity, judgments = get_ip_reputation(resource)
+    severity, judgments = await get_ip_reputation(resource)
     
     # Logging with colors
     if severity == "high":
@@ -472,30 +2683,92 @@ async def ip_reputation(resource: str, apikey: str):
         
     return format_threatbook_v3(resource, severity, judgments)
 
+@app.post("/v3/scene/ip_reputation")
+async def ip_reputation_batch(data: ReputationBatchRequest, apikey: str):
+    await verify_api_key(apikey)
+
+    resources = list(data.resources)
+    if data.resource:
+        resources.append(data.resource)
+    return await reputation_batch_response(parse_resource_list(resources))
+
+CHANGES_PAGE_MAX = 500 # Change log entries read per /v3/feed/changes request
+
+def changes_response(cursor: Optional[str], reset: bool, added=(), removed=(), more: bool = False):
+    return {
+        "code": 0,
+        "data": {"cursor": cursor, "reset": reset, "added": list(added), "removed": list(removed), "more": more},
+        "message": "success"
+    }
+
+@app.get("/v3/feed/changes")
+async def feed_changes(apikey: str, since: str = "", source: str = "all", limit: int = 100):
+    """
+    IPs added to or removed from the banned-IP feed after the cursor `since`, plus the next cursor.
+    "reset" means the changes cannot be replayed (no cursor, cursor trimmed from the log or a
+    whitelist edit): download /feed/banned_ips.txt and continue from its X-Feed-Cursor header.
+    """
+    await verify_api_key(apikey)
+    if source not in BAN_FEED_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"source must be one of: {', '.join(BAN_FEED_VARIANTS)}")
+    start = parse_stream_id(since) if since else None
+    if since and start is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if start is None:
+        return changes_response(None, True)
+    limit = min(max(1, limit), CHANGES_PAGE_MAX)
+
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    pipe.xrange(KEY_CHANGES, count=1)
+    pipe.xlen(KEY_CHANGES)
+    pipe.xrange(KEY_CHANGES, min=f"{start[0]}-{start[1] + 1}", count=limit)
+    oldest, length, entries = await pipe.execute()
+    # Approximate trimming keeps at least CHANGE_LOG_MAXLEN entries, so a shorter log was never trimmed
+    if oldest and length >= CHANGE_LOG_MAXLEN and start < parse_stream_id(oldest[0][0]):
+        return changes_response(None, True)
+    if not entries:
+        if start > parse_stream_id(await latest_change_id()):
+            return changes_response(None, True) # Cursor from a log that no longer exists
+        return changes_response(since, False)
+
+    names = {SOURCE_NAMES[source_bit] for source_bit in BAN_FEED_VARIANTS[source]}
+    touched = set()
+    for entry_id, fields in entries:
+        if fields.get("op") == "reset":
+            return changes_response(None, True)
+        if fields.get("source") in names:
+            touched.update(ip for ip in fields.get("ips", "").split(",") if ip)
+
+    # Report the current state of every touched IP, so overlapping sources and whitelisted IPs come out right
+    await refresh_list_snapshot()
+    whitelist = LIST_SNAPSHOT.whitelist_index
+    wanted = sum(BAN_FEED_VARIANTS[source])
+    ips = sorted(touched)
+    added, removed = [], []
+    for ip, mask in zip(ips, await lookup_indicators(ips, use_filter=False) if ips else []):
+        if mask & wanted and ip not in whitelist:
+            added.append(ip)
+        else:
+            removed.append(ip)
+    return changes_response(entries[-1][0], False, added, removed, more=len(entries) == limit)
+
 @app.post("/webhook")
 async def hfish_webhook(data: HFishWebhook):
     # 1. Immediate filtering for Scan-Blacklist
-    blacklist_members = REDIS_CLIENT.smembers(KEY_BLACKLIST)
-    if is_ip_in_cidr_list(data.attack_ip, blacklist_members):
+    if data.attack_ip in LIST_SNAPSHOT.blacklist_index:
         logger.info(f"{C_RED}[WEBHOOK] Discarding attack from Scan-Blacklisted IP: {data.attack_ip}{C_RESET}")
         return {"status": "filtered", "reason": "scan-blacklist"}
 
     logger.info(f"{C_BLUE}[WEBHOOK] Received attack from: {data.attack_ip}{C_RESET}")
-    # Store local data for 365 days
-    ip_key = f"{KEY_LOCAL}{data.attack_ip}"
-    is_new = not REDIS_CLIENT.exists(ip_key)
-    
-    if is_new:
-         # Increment daily/session counter for "Last Cloud IPs"
-         REDIS_CLIENT.incr("stats:cloud_new_24h")
-         # Increement total local counter
-         REDIS_CLIENT.incr(KEY_STATS_LOCAL)
-         # Set expire only if key is new (e.g. 24h window roughly)
-         if REDIS_CLIENT.ttl("stats:cloud_new_24h") == -1:
-             REDIS_CLIENT.expire("stats:cloud_new_24h", 86400)
-    
-    REDIS_CLIENT.setex(ip_key, timedelta(days=365), datetime.now().isoformat())
-    
+    if WEBHOOK_WRITE_BEHIND:
+        # Acknowledge now, the flusher writes it (coalesced with repeat hits) within WEBHOOK_FLUSH_INTERVAL
+        if not await WEBHOOK_BUFFER.add(data.attack_ip):
+            raise HTTPException(status_code=503, detail="Write buffer full, retry later", headers={"Retry-After": "5"})
+        return {"status": "ok"}
+
+    # Store local data for 365 days and update counters in one atomic round-trip
+    is_new = bool(await ingest_local_ips([data.attack_ip]))
+
     if is_new:
         logger.info(f"{C_GREEN}[WEBHOOK] New IP added: {data.attack_ip}{C_RESET}")
     else:
@@ -503,22 +2776,255 @@ async def hfish_webhook(data: HFishWebhook):
     
     return {"status": "ok"}
 
+def webhook_item_ip(item) -> Optional[str]:
+    """Attack IP of one batch item: either a plain string or an HFishWebhook-style object."""
+    if isinstance(item, dict):
+        item = item.get("attack_ip")
+    if not isinstance(item, str):
+        return None
+    return item.strip() or None
+
+async def read_webhook_batch(request: Request) -> List[str]:
+    """
+    Attack IPs from a JSON array or an NDJSON body (one IP or object per line).
+    NDJSON sent as application/x-ndjson is parsed while it streams in.
+    """
+    items = []
+
+    def add(item):
+        items.append(webhook_item_ip(item))
+        if len(items) > WEBHOOK_BATCH_MAX:
+            raise HTTPException(status_code=413, detail=f"Too many attack IPs (max {WEBHOOK_BATCH_MAX})")
+
+    def add_line(line: bytes):
+        line = line.strip()
+        if line:
+            try:
+                add(json.loads(line))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid NDJSON line")
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                add_line(line)
+        add_line(buffer)
+        return items
+
+    body = await request.body()
+    if body.lstrip().startswith(b"["):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON array")
+        for item in data:
+            add(item)
+    else:
+        for line in body.split(b"\n"):
+            add_line(line)
+    return items
+
+async def ingest_local_ips(ips: List[str]) -> List[str]:
+    """
+    Stores local attack IPs and updates the counters with INGEST_LOCAL_SCRIPT, one
+    atomic call per chunk, all in one pipelined round-trip. Returns the IPs that were new.
+    """
+    INDICATOR_FILTER.add(ips) # Ahead of the write, like queue_store_indicators
+    ttl_seconds = int(LOCAL_TTL.total_seconds())
+    indexed = int(legacy_expiry_indexed())
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for i in range(0, len(ips), REDIS_WRITE_CHUNK_SIZE):
+        chunk = ips[i:i + REDIS_WRITE_CHUNK_SIZE]
+        keys = [KEY_STATS_CLOUD_NEW, KEY_STATS_LOCAL, KEY_COMPACT_EXPIRY, KEY_LEGACY_EXPIRY, KEY_CHANGES]
+        args = [int(time.time()), ttl_seconds, datetime.now().isoformat(), CHANGE_LOG_MAXLEN, indexed]
+        for ip in chunk:
+            location = compact_location(ip) if IP_STORAGE_BACKEND == "compact" else None
+            keys.append(location[0] if location else f"{KEY_LOCAL}{ip}")
+            args.extend((location[1] if location else "", ip))
+        await INGEST_LOCAL_SCRIPT(keys=keys, args=args, client=pipe)
+    flags = [flag for chunk_flags in await pipe.execute() for flag in chunk_flags]
+    new_ips = [ip for ip, is_new in zip(ips, flags) if is_new]
+    if new_ips:
+        REPUTATION_CACHE.invalidate(new_ips)
+    return new_ips
+
+class WriteBehindBuffer:
+    """
+    Per-worker write-behind queue for /webhook (WEBHOOK_WRITE_BEHIND=true).
+    Accepted IPs are kept in memory and committed by a background flusher every
+    flush_interval seconds, or as soon as flush_items are pending. Repeat hits for
+    an IP that is still pending are coalesced into one write. Once max_pending IPs
+    are waiting, callers flush inline (backpressure) instead of growing the queue;
+    if that flush fails the IP is rejected, so the caller can answer 503.
+    """
+    def __init__(self, flush_interval: float, flush_items: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.flush_items = flush_items
+        self.max_pending = max_pending
+        self.pending = {} # ip -> None, insertion ordered
+        self.lock = None # asyncio primitives are created in start(), on the server's loop
+        self.wakeup = None
+        self.task = None # The flusher
+        self.running = False
+        self.accepted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.new = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.backpressure_waits = 0
+        self.rejected = 0
+        self.last_flush_duration = 0.0
+
+    def start(self):
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.running = True
+        self.task = start_background_task(self.run())
+
+    async def add(self, ip: str) -> bool:
+        """Queues an IP. Returns False if the queue is full and the inline flush failed."""
+        while ip not in self.pending and len(self.pending) >= self.max_pending:
+            self.backpressure_waits += 1
+            try:
+                await self.flush()
+            except Exception as e:
+                self.rejected += 1
+                logger.error(f"{C_RED}[WEBHOOK:BUFFER] Buffer full and flush failed, rejecting {ip}: {e}{C_RESET}")
+                return False
+        if ip in self.pending:
+            self.coalesced += 1
+            return True
+        self.pending[ip] = None
+        self.accepted += 1
+        if len(self.pending) >= self.flush_items:
+            self.wakeup.set()
+        return True
+
+    async def flush(self) -> int:
+        """Commits everything pending in one pipeline. Returns the number of IPs written."""
+        async with self.lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = list(self.pending), {}
+            start_time = time.perf_counter()
+            try:
+                new_ips = await ingest_local_ips(batch)
+            except Exception:
+                # Keep the batch (ahead of newer hits) for the next flush, within the limit
+                self.failed_flushes += 1
+                restored = dict.fromkeys(batch)
+                restored.update(self.pending)
+                self.pending = dict(list(restored.items())[:self.max_pending])
+                raise
+            self.last_flush_duration = time.perf_counter() - start_time
+            self.flushes += 1
+            self.written += len(batch)
+            self.new += len(new_ips)
+        logger.info(f"{C_GREEN}[WEBHOOK:BUFFER] Flushed {len(batch)} IPs ({len(new_ips)} new) in {self.last_flush_duration * 1000:.1f}ms{C_RESET}")
+        return len(batch)
+
+    async def run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"{C_RED}[WEBHOOK:BUFFER] Flush failed, {len(self.pending)} IPs kept for retry: {e}{C_RESET}")
+
+    async def close(self):
+        """Stops the flusher (letting a running flush finish) and drains the queue."""
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        await asyncio.wait({self.task}, timeout=self.flush_interval)
+        self.task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"{C_RED}[WEBHOOK:BUFFER] Final flush failed, {len(self.pending)} IPs not written: {e}{C_RESET}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": WEBHOOK_WRITE_BEHIND,
+            "pending": len(self.pending),
+            "accepted": self.accepted,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "new": self.new,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "backpressure_waits": self.backpressure_waits,
+            "rejected": self.rejected,
+            "last_flush_ms": round(self.last_flush_duration * 1000, 2),
+        }
+
+WEBHOOK_BUFFER = WriteBehindBuffer(WEBHOOK_FLUSH_INTERVAL, WEBHOOK_FLUSH_MAX_ITEMS, WEBHOOK_BUFFER_MAX)
+
+@app.post("/webhook/batch")
+async def hfish_webhook_batch(request: Request):
+    """
+    Bulk variant of /webhook for sensors: a JSON array or NDJSON stream of attack IPs
+    (strings or {"attack_ip": ...} objects). Returns a status per IP so the sender
+    can acknowledge the whole batch at once.
+    """
+    items = await read_webhook_batch(request)
+    results = {}
+    accepted = []
+    invalid = 0
+    filtered = 0
+    for ip in items:
+        if ip is None:
+            invalid += 1
+            continue
+        if ip in results:
+            continue
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            results[ip] = "invalid"
+            invalid += 1
+            continue
+        if ip in LIST_SNAPSHOT.blacklist_index:
+            results[ip] = "filtered"
+            filtered += 1
+        else:
+            results[ip] = "updated"
+            accepted.append(ip)
+
+    new_ips = await ingest_local_ips(accepted) if accepted else []
+    for ip in new_ips:
+        results[ip] = "new"
+
+    logger.info(f"{C_GREEN}[WEBHOOK:BATCH] Received {len(items)} attacks: {len(accepted)} accepted ({len(new_ips)} new), {filtered} scan-blacklisted, {invalid} invalid{C_RESET}")
+    return {
+        "status": "ok",
+        "received": len(items),
+        "accepted": len(accepted),
+        "new": len(new_ips),
+        "results": results,
+    }
+
 @app.post("/api/ban")
 async def manual_ban(ip: str = Form(...), user: str = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/login")
     
+    if ip in LIST_SNAPSHOT.blacklist_index:
+        logger.info(f"{C_RED}[MANUAL BAN] Ignoring Scan-Blacklisted IP: {ip}{C_RESET}")
+        return RedirectResponse(url="/", status_code=303)
+
     logger.info(f"{C_RED}[MANUAL BAN] Manually banning IP: {ip} for processing/reporting{C_RESET}")
     
-    ip_key = f"{KEY_LOCAL}{ip}"
-    is_new = not REDIS_CLIENT.exists(ip_key)
-    
-    if is_new:
-         REDIS_CLIENT.incr("stats:cloud_new_24h")
-         REDIS_CLIENT.incr(KEY_STATS_LOCAL)
-         if REDIS_CLIENT.ttl("stats:cloud_new_24h") == -1:
-             REDIS_CLIENT.expire("stats:cloud_new_24h", 86400)
-    
-    REDIS_CLIENT.setex(ip_key, timedelta(days=365), datetime.now().isoformat())
+    await ingest_local_ips([ip])
+
     return RedirectResponse(url="/", status_code=303)
 
 # --- Auth Routes ---
@@ -546,206 +3052,180 @@ async def dashboard(request: Request, user: str = Depends(get_current_user)):
     if not user:
         return RedirectResponse(url="/login")
         
-    # Stats (Optimized)
-    local_ips = int(REDIS_CLIENT.get(KEY_STATS_LOCAL) or 0)
-    osint_ips = int(REDIS_CLIENT.get(KEY_STATS_OSINT) or 0)
-    blacklist_count = REDIS_CLIENT.scard(KEY_BLACKLIST)
-    whitelist_count = REDIS_CLIENT.scard(KEY_WHITELIST)
-    
+    stats = await STATS_SNAPSHOT.get()
+
     # API Keys V2
-    api_keys_dict = REDIS_CLIENT.hgetall(KEY_API_KEYS_V2)
+    api_keys_dict = await REDIS_CLIENT.hgetall(KEY_API_KEYS_V2)
     # Support legacy keys (no name)
-    legacy_keys = REDIS_CLIENT.smembers(KEY_API_KEYS)
+    legacy_keys = await REDIS_CLIENT.smembers(KEY_API_KEYS)
     for lk in legacy_keys:
         if lk not in api_keys_dict:
             api_keys_dict[lk] = "Legacy Key"
-            
-    blacklist = list(REDIS_CLIENT.smembers(KEY_BLACKLIST))
-    whitelist = list(REDIS_CLIENT.smembers(KEY_WHITELIST))
-    
-    blacklist_ips = int(REDIS_CLIENT.get("stats:blacklist_ip_count") or 0)
-    whitelist_ips = int(REDIS_CLIENT.get("stats:whitelist_ip_count") or 0)
 
+    # Blacklist/whitelist tables are loaded page by page from /list/entries
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "stats": {
-            "local": local_ips,
-            "osint": osint_ips,
-            "blacklist": blacklist_count,
-            "blacklist_ips": blacklist_ips,
-            "whitelist": whitelist_count,
-            "whitelist_ips": whitelist_ips
-        },
-        "api_keys": api_keys_dict,
-        "blacklist": blacklist,
-        "whitelist": whitelist
+        "stats": stats,
+        "api_keys": api_keys_dict
     })
 
 @app.get("/api/stats")
-async def get_stats(user: str = Depends(get_current_user)):
+async def get_stats(request: Request, user: str = Depends(get_current_user)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-        
-    local_ips = int(REDIS_CLIENT.get(KEY_STATS_LOCAL) or 0)
-    osint_ips = int(REDIS_CLIENT.get(KEY_STATS_OSINT) or 0)
-    blacklist_count = REDIS_CLIENT.scard(KEY_BLACKLIST)
-    whitelist_count = REDIS_CLIENT.scard(KEY_WHITELIST)
-    
-    blacklist_ips = int(REDIS_CLIENT.get("stats:blacklist_ip_count") or 0)
-    whitelist_ips = int(REDIS_CLIENT.get("stats:whitelist_ip_count") or 0)
 
-    # Check External API Status
-    api_up = False
-    
-    # 1. Socket Check - Public (Port 443)
-    # This proves api.sec.lemue.org is reachable from 'external' perspective
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(2)
-        # Using the resolved IP if possible, or domain
-        result = s.connect_ex(("api.sec.lemue.org", 443))
-        if result == 0:
-            api_up = True
-        s.close()
-    except Exception:
-        pass
-        
-    # 2. Socket Check - Localhost (Port 8080) 
-    # Fallback to confirm the app process is listening locally
-    if not api_up:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            result = s.connect_ex(("127.0.0.1", 8080))
-            if result == 0:
-                api_up = True
-            s.close()
-        except Exception:
-            pass
-        
-    last_osint_count = REDIS_CLIENT.get("stats:last_osint_count")
-    if last_osint_count is None: last_osint_count = 0
-    
-    cloud_new_24h = REDIS_CLIENT.get("stats:cloud_new_24h")
-    if cloud_new_24h is None: cloud_new_24h = 0
+    # Served from the background snapshot; API reachability comes from the background prober
+    stats = dict(await STATS_SNAPSHOT.get())
+    stats["api_health"] = HEALTH_PROBER.snapshot()
+    return etag_json_response(request, stats)
 
-    return {
-        "local": local_ips,
-        "osint": osint_ips,
-        "blacklist": blacklist_count,
-        "blacklist_ips": blacklist_ips,
-        "whitelist": whitelist_count,
-        "whitelist_ips": whitelist_ips,
-        "api_up": api_up,
-        "last_osint_count": int(last_osint_count),
-        "last_cloud_count": int(cloud_new_24h)
-    }
+@app.get("/api/stats/stream")
+async def stream_stats(request: Request, user: str = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return stats_stream_response(request)
 
 # --- Public Status Routes ---
 
 @app.get("/status", response_class=HTMLResponse)
 async def status_page(request: Request):
-    # Stats (Optimized)
-    local_ips = int(REDIS_CLIENT.get(KEY_STATS_LOCAL) or 0)
-    osint_ips = int(REDIS_CLIENT.get(KEY_STATS_OSINT) or 0)
-    blacklist_count = REDIS_CLIENT.scard(KEY_BLACKLIST)
-    whitelist_count = REDIS_CLIENT.scard(KEY_WHITELIST)
-    
-    blacklist_ips = int(REDIS_CLIENT.get("stats:blacklist_ip_count") or 0)
-    whitelist_ips = int(REDIS_CLIENT.get("stats:whitelist_ip_count") or 0)
+    stats = await STATS_SNAPSHOT.get()
 
     return templates.TemplateResponse("status.html", {
         "request": request,
-        "stats": {
-            "local": local_ips,
-            "osint": osint_ips,
-            "blacklist": blacklist_count,
-            "blacklist_ips": blacklist_ips,
-            "whitelist": whitelist_count,
-            "whitelist_ips": whitelist_ips
-        }
+        "stats": stats
     })
 
 @app.get("/api/public/stats")
-async def get_public_stats():
-    local_ips = int(REDIS_CLIENT.get(KEY_STATS_LOCAL) or 0)
-    osint_ips = int(REDIS_CLIENT.get(KEY_STATS_OSINT) or 0)
-    blacklist_count = REDIS_CLIENT.scard(KEY_BLACKLIST)
-    whitelist_count = REDIS_CLIENT.scard(KEY_WHITELIST)
-    
-    blacklist_ips = int(REDIS_CLIENT.get("stats:blacklist_ip_count") or 0)
-    whitelist_ips = int(REDIS_CLIENT.get("stats:whitelist_ip_count") or 0)
+async def get_public_stats(request: Request):
+    # Served from the background snapshot (api_up is publicly exposed on the status page)
+    return etag_json_response(request, await STATS_SNAPSHOT.get())
 
-    # Check External API Status (Publicly exposed on status page)
-    api_up = False
-    
-    # 1. Socket Check - Public (Port 443)
+@app.get("/api/public/stats/stream")
+async def stream_public_stats(request: Request):
+    return stats_stream_response(request)
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match / If-Range comparison (weak prefixes are ignored)."""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def parse_byte_range(header: str, size: int):
+    """
+    Parses a single "bytes=" range. Returns (start, end) inclusive, None if the header
+    is absent or not a single byte range (full response), or False if unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(2)
-        result = s.connect_ex(("api.sec.lemue.org", 443))
-        if result == 0:
-            api_up = True
-        s.close()
-    except Exception:
-        pass
-        
-    # 2. Socket Check - Localhost (Port 8080) - Fallback
-    if not api_up:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            result = s.connect_ex(("127.0.0.1", 8080))
-            if result == 0:
-                api_up = True
-            s.close()
-        except Exception:
-            pass
-        
-    last_osint_count = REDIS_CLIENT.get("stats:last_osint_count")
-    if last_osint_count is None: last_osint_count = 0
-    
-    cloud_new_24h = REDIS_CLIENT.get("stats:cloud_new_24h")
-    if cloud_new_24h is None: cloud_new_24h = 0
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, end
 
-    return {
-        "local": local_ips,
-        "osint": osint_ips,
-        "blacklist": blacklist_count,
-        "blacklist_ips": blacklist_ips,
-        "whitelist": whitelist_count,
-        "whitelist_ips": whitelist_ips,
-        "api_up": api_up,
-        "last_osint_count": int(last_osint_count),
-        "last_cloud_count": int(cloud_new_24h)
+@app.get("/feed/banned_ips.txt")
+async def banned_ips_feed(request: Request, source: str = "all", apikey: str = ""):
+    """
+    Banned-IP feed for fail2ban clients (one IP per line), served from the precomputed
+    artifact. Supports gzip, ETag/If-None-Match and single byte ranges. Public unless
+    FEED_REQUIRE_API_KEY is set.
+    """
+    if FEED_REQUIRE_API_KEY:
+        await verify_api_key(apikey)
+    if source not in BAN_FEED_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"source must be one of: {', '.join(BAN_FEED_VARIANTS)}")
+    artifact = BAN_FEED.artifacts.get(source)
+    if artifact is None:
+        raise HTTPException(status_code=503, detail="Feed is being built", headers={"Retry-After": "30"})
+
+    # The gzip artifact is served as is; plain clients get it decompressed
+    compressed = "gzip" in request.headers.get("accept-encoding", "")
+    etag = artifact["etag"][:-1] + '-gzip"' if compressed else artifact["etag"]
+    headers = {
+        "ETag": etag,
+        "Last-Modified": artifact["last_modified"],
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "Accept-Ranges": "bytes",
+        "X-Feed-Count": str(artifact["count"]),
+        "X-Feed-Cursor": BAN_FEED.cursor,
     }
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    body = artifact["gzip"] if compressed else await asyncio.to_thread(gzip.decompress, artifact["gzip"])
+    if_range = request.headers.get("if-range")
+    byte_range = parse_byte_range(request.headers.get("range", ""), len(body)) if not if_range or if_range == etag else None
+    if byte_range is False:
+        headers["Content-Range"] = f"bytes */{len(body)}"
+        return Response(status_code=416, headers=headers)
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+        return Response(content=body[start:end + 1], status_code=206, media_type="text/plain", headers=headers)
+    return Response(content=body, media_type="text/plain", headers=headers)
 
 @app.post("/api-key/generate")
 async def generate_key(name: str = Form(...), user: str = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/login")
     new_key = str(uuid.uuid4())
-    REDIS_CLIENT.hset(KEY_API_KEYS_V2, new_key, name)
+    await REDIS_CLIENT.hset(KEY_API_KEYS_V2, new_key, name)
+    await bump_api_keys_generation()
     return RedirectResponse(url="/", status_code=303)
 
 @app.post("/api-key/delete")
 async def delete_key(key: str = Form(...), user: str = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/login")
-    REDIS_CLIENT.hdel(KEY_API_KEYS_V2, key)
-    REDIS_CLIENT.srem(KEY_API_KEYS, key) # Also remove from legacy just in case
+    await REDIS_CLIENT.hdel(KEY_API_KEYS_V2, key)
+    await REDIS_CLIENT.srem(KEY_API_KEYS, key) # Also remove from legacy just in case
+    await bump_api_keys_generation()
     return RedirectResponse(url="/", status_code=303)
 
+@app.get("/api/cache/stats")
+async def get_cache_stats(user: str = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return {
+        "api_keys": API_KEY_CACHE.stats(),
+        "reputation": REPUTATION_CACHE.stats(),
+        "webhook_buffer": WEBHOOK_BUFFER.stats(),
+        "stats_snapshot": STATS_SNAPSHOT.stats(),
+        "ban_feed": BAN_FEED.stats(),
+        "indicator_filter": INDICATOR_FILTER.stats(),
+        "scheduler": SCHEDULER.stats(),
+    }
+
+@app.post("/api/cleanup/full", status_code=202)
+async def force_full_cleanup(background_tasks: BackgroundTasks, user: str = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    logger.info(f"{C_YELLOW}[CLEAN:DB] Full blacklist purge requested from dashboard.{C_RESET}")
+    background_tasks.add_task(purge_blacklisted_indicators, full=True)
+    return {"status": "scheduled"}
+
 @app.post("/list/add")
 async def add_to_list(ip: str = Form(...), list_type: str = Form(...), user: str = Depends(get_current_user)):
     if not user: return RedirectResponse(url="/login")
     
     clean_ip = ip.strip()
-    if clean_ip:
-        if list_type == "blacklist":
-            REDIS_CLIENT.sadd(KEY_BLACKLIST, clean_ip)
-        elif list_type == "whitelist":
-            REDIS_CLIENT.sadd(KEY_WHITELIST, clean_ip)
+    if clean_ip and list_type in LIST_STATS_KEYS:
+        if await apply_list_edit(list_type, clean_ip, added=True):
+            await STATS_SNAPSHOT.refresh()
         
-    await recalculate_all_stats()
     return RedirectResponse(url="/", status_code=303)
 
 @app.post("/list/remove")
@@ -753,15 +3233,179 @@ async def remove_from_list(ip: str = Form(...), list_type: str = Form(...), user
     if not user: return RedirectResponse(url="/login")
     
     clean_ip = ip.strip()
-    if clean_ip:
-        if list_type == "blacklist":
-            REDIS_CLIENT.srem(KEY_BLACKLIST, clean_ip)
-        elif list_type == "whitelist":
-            REDIS_CLIENT.srem(KEY_WHITELIST, clean_ip)
+    if clean_ip and list_type in LIST_STATS_KEYS:
+        if await apply_list_edit(list_type, clean_ip, added=False):
+            await STATS_SNAPSHOT.refresh()
         
-    await recalculate_all_stats()
     return RedirectResponse(url="/", status_code=303)
 
+async def read_upload_chunks(upload, size: int = 65536):
+    while True:
+        chunk = await upload.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+async def iter_import_lines(request: Request):
+    """Lines of a list import: the "file" or "rules" field of a form upload, or the raw text body, read in chunks."""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        form = await request.form(max_part_size=LIST_IMPORT_MAX_FIELD_BYTES)
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            for line in (upload or form.get("rules") or "").splitlines():
+                yield line
+            return
+        chunks = read_upload_chunks(upload)
+    else:
+        chunks = request.stream()
+
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if buffer:
+        yield buffer.decode("utf-8", errors="replace")
+
+@app.post("/list/import")
+async def import_list(request: Request, list_type: str, skip_covered: bool = False, user: str = Depends(get_current_user)):
+    """
+    Bulk import of IP/CIDR rules (one per line, # comments allowed) into the blacklist or
+    whitelist. Rules are written in chunks while the upload streams in; the list generation
+    and IP counts are updated once at the end. Rules already covered by an existing CIDR
+    or by one accepted earlier in the same import are counted as "covered" and skipped if
+    skip_covered is set.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if list_type not in LIST_STATS_KEYS:
+        raise HTTPException(status_code=400, detail="list_type must be 'blacklist' or 'whitelist'")
+
+    key = KEY_BLACKLIST if list_type == "blacklist" else KEY_WHITELIST
+    await refresh_list_snapshot()
+    members = getattr(LIST_SNAPSHOT, list_type)
+    index = getattr(LIST_SNAPSHOT, f"{list_type}_index")
+    accepted = CIDRIndex() # Rules of this import, so later lines are checked against earlier ones
+    report = {"lines": 0, "valid": 0, "added": 0, "already_present": 0, "covered": 0, "duplicates": 0, "invalid": 0}
+    invalid_samples = []
+    seen = set()
+    pending = []
+    start_time = time.perf_counter()
+
+    async def commit(rules):
+        report["added"] += await REDIS_CLIENT.sadd(key, *rules)
+
+    async for line in iter_import_lines(request):
+        report["lines"] += 1
+        rule = parse_rule_line(line)
+        if not rule:
+            continue
+        if parse_ip_range(rule) is None:
+            report["invalid"] += 1
+            if len(invalid_samples) < 20:
+                invalid_samples.append(rule)
+            continue
+        report["valid"] += 1
+        if rule in seen:
+            report["duplicates"] += 1
+            continue
+        seen.add(rule)
+        if rule in members:
+            report["already_present"] += 1
+            continue
+        if index.covers(rule) or accepted.covers(rule):
+            report["covered"] += 1
+            if skip_covered:
+                continue
+        accepted.add(rule)
+        pending.append(rule)
+        if len(pending) >= REDIS_WRITE_CHUNK_SIZE:
+            await commit(pending)
+            pending = []
+    if pending:
+        await commit(pending)
+
+    if report["added"]:
+        if list_type == "blacklist":
+            await REDIS_CLIENT.unlink(KEY_BLACKLIST_SOURCE_HASH) # Next file reload rebuilds the set, as before
+        await REDIS_CLIENT.incr(KEY_LISTS_GENERATION)
+        await refresh_list_snapshot(force=True)
+        await recalculate_all_stats()
+        if list_type == "whitelist":
+            await log_change_reset("whitelist")
+
+    duration = time.perf_counter() - start_time
+    logger.info(f"{C_GREEN}[LIST:IMPORT] {list_type}: {report['added']} added, {report['already_present']} present, {report['covered']} covered, {report['invalid']} invalid in {duration:.2f}s{C_RESET}")
+    return {"list_type": list_type, **report, "invalid_samples": invalid_samples}
+
+LIST_PAGE_MAX = 500
+
+@app.get("/list/entries")
+async def list_entries(list_type: str, q: str = "", offset: int = 0, limit: int = 100,
+                       user: str = Depends(get_current_user)):
+    """
+    One page of the blacklist or whitelist, served from the worker's list snapshot.
+    If q is an IP or CIDR, returns the rules overlapping it (e.g. which rules contain
+    203.0.113.7); otherwise q is a prefix filter on the rule text.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if list_type not in LIST_STATS_KEYS:
+        raise HTTPException(status_code=400, detail="list_type must be 'blacklist' or 'whitelist'")
+    offset = max(0, offset)
+    limit = min(max(1, limit), LIST_PAGE_MAX)
+
+    await refresh_list_snapshot()
+    q = q.strip()
+    if q and parse_ip_range(q):
+        mode = "overlap"
+        matches = getattr(LIST_SNAPSHOT, f"{list_type}_index").overlapping(q)
+        total = len(matches)
+        items = matches[offset:offset + limit]
+    else:
+        mode = "prefix" if q else "all"
+        members = LIST_SNAPSHOT.sorted_members(list_type)
+        lo = bisect.bisect_left(members, q)
+        hi = bisect.bisect_right(members, q + "\uffff") if q else len(members)
+        total = hi - lo
+        items = members[lo + offset:min(hi, lo + offset + limit)]
+
+    return {"list_type": list_type, "mode": mode, "q": q, "total": total,
+            "offset": offset, "limit": limit, "items": items}
+
+@app.get("/list/export")
+async def export_list(list_type: str, user: str = Depends(get_current_user)):
+    """
+    Streams the blacklist or whitelist as text, one rule per line, using SSCAN (never loads
+    the whole set at once). SSCAN may return a member twice while the set is rehashed, so
+    members already sent are skipped.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if list_type not in LIST_STATS_KEYS:
+        raise HTTPException(status_code=400, detail="list_type must be 'blacklist' or 'whitelist'")
+
+    key = KEY_BLACKLIST if list_type == "blacklist" else KEY_WHITELIST
+
+    async def lines():
+        batch = []
+        sent = set()
+        async for member in REDIS_CLIENT.sscan_iter(key, count=1000):
+            if member in sent:
+                continue
+            sent.add(member)
+            batch.append(member)
+            if len(batch) >= 1000:
+                yield "\n".join(batch) + "\n"
+                batch = []
+        if batch:
+            yield "\n".join(batch) + "\n"
+
+    return StreamingResponse(lines(), media_type="text/plain",
+                             headers={"Content-Disposition": f'attachment; filename="{list_type}.txt"'})
+
 # --- Bridge Redirects for Uptime Kuma (Moved here for route priority) ---
 @app.get("/icon.svg")
 async def get_icon_bridge():
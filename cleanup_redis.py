@@ -9,6 +9,7 @@ KEY_WHITELIST = "ti:whitelist"
 KEY_BLACKLIST = "ti:blacklist"
 KEY_LOCAL_PREFIX = "ti:local:"
 KEY_OSINT_PREFIX = "ti:osint:"
+KEY_LISTS_GENERATION = "ti:lists:generation"
 
 target_ip = "::1"
 
@@ -22,6 +23,9 @@ def cleanup():
     # 2. Add to whitelist
     added_whitelist = REDIS_CLIENT.sadd(KEY_WHITELIST, target_ip)
     print(f"Added to {KEY_WHITELIST}: {added_whitelist}")
+
+    # Notify running workers that the lists changed
+    REDIS_CLIENT.incr(KEY_LISTS_GENERATION)
     
     # 3. Remove local entry
     local_key = f"{KEY_LOCAL_PREFIX}{target_ip}"
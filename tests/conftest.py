@@ -0,0 +1,44 @@
+import os
+import sys
+import asyncio
+from unittest import mock
+
+import fakeredis
+import pytest
+import redis.asyncio
+
+# app.main builds its Redis pool at import time. Tests point it at an in-process
+# fakeredis server (Lua scripts need the lupa package: pip install "fakeredis[lua]").
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "tools"))
+os.chdir(REPO_ROOT)
+
+FAKE_SERVER = fakeredis.FakeServer()
+
+def fake_pool(*args, **kwargs):
+    return fakeredis.FakeAsyncRedis(server=FAKE_SERVER, decode_responses=True).connection_pool
+
+with mock.patch.object(redis.asyncio.BlockingConnectionPool, "from_url", fake_pool):
+    from app import main  # noqa: E402
+
+@pytest.fixture(scope="session")
+def loop():
+    # One loop for the whole session: pooled connections are bound to the loop that opened them
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+@pytest.fixture
+def app_main(run, monkeypatch):
+    """app.main on an empty fake Redis, with the legacy key layout unless a test switches it."""
+    run(main.REDIS_CLIENT.flushall())
+    monkeypatch.setattr(main, "IP_STORAGE_BACKEND", "keys")
+    monkeypatch.setattr(main, "LIST_SNAPSHOT", main.ListSnapshot())
+    main.REPUTATION_CACHE.clear()
+    main.API_KEY_CACHE.clear()
+    return main
@@ -0,0 +1,110 @@
+import gzip
+
+import httpx
+
+from app.main import SOURCE_LOCAL, SOURCE_OSINT
+
+def leader(m, run, node="node-a"):
+    scheduler = m.Scheduler([], lease_ttl=30)
+    scheduler.node = node
+    run(scheduler.tick())
+    return scheduler
+
+def make_feed(m):
+    return m.BanFeed(900, 60, "")
+
+def fetch(m, run, path, headers=None):
+    async def get():
+        transport = httpx.ASGITransport(app=m.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path, headers=headers or {})
+    return run(get())
+
+def seed(m, run):
+    run(m.store_indicators(["198.51.100.7", "2001:db8::1", "10.0.0.5"], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.ingest_local_ips(["203.0.113.1", "198.51.100.7"]))
+    run(m.REDIS_CLIENT.sadd(m.KEY_WHITELIST, "10.0.0.0/8"))
+    run(m.REDIS_CLIENT.incr(m.KEY_LISTS_GENERATION))
+
+def lines(artifact):
+    return gzip.decompress(artifact["gzip"]).decode().splitlines()
+
+def test_leader_builds_variants_minus_whitelist(app_main, run):
+    m = app_main
+    seed(m, run)
+    scheduler = leader(m, run)
+    feed = make_feed(m)
+    assert run(feed.build(scheduler.token, scheduler.lease_value)) == 3
+
+    assert lines(feed.artifacts["all"]) == ["198.51.100.7", "203.0.113.1", "2001:db8::1"]
+    assert lines(feed.artifacts["local"]) == ["198.51.100.7", "203.0.113.1"]
+    assert lines(feed.artifacts["osint"]) == ["198.51.100.7", "2001:db8::1"]
+    assert feed.cursor == run(m.latest_change_id())
+
+    # Nothing changed: same artifacts, same ETags
+    etags = {variant: artifact["etag"] for variant, artifact in feed.artifacts.items()}
+    assert run(feed.build(scheduler.token, scheduler.lease_value)) == 0
+    assert {variant: artifact["etag"] for variant, artifact in feed.artifacts.items()} == etags
+
+def test_other_workers_load_the_same_build(app_main, run):
+    m = app_main
+    seed(m, run)
+    scheduler = leader(m, run)
+    built = make_feed(m)
+    run(built.build(scheduler.token, scheduler.lease_value))
+
+    loaded = make_feed(m)
+    assert run(loaded.load()) == 3
+    assert loaded.cursor == built.cursor
+    for variant, artifact in built.artifacts.items():
+        assert loaded.artifacts[variant]["etag"] == artifact["etag"]
+        assert loaded.artifacts[variant]["gzip"] == artifact["gzip"]
+    assert run(loaded.load()) == 0 # Same generation
+
+def test_stale_leader_cannot_publish(app_main, run):
+    m = app_main
+    seed(m, run)
+    stale = leader(m, run)
+    run(m.REDIS_CLIENT.delete(m.KEY_SCHEDULER_LEASE))
+    leader(m, run, "node-b")
+
+    feed = make_feed(m)
+    assert run(feed.build(stale.token, stale.lease_value)) == 0
+    assert feed.artifacts == {}
+    assert run(m.REDIS_CLIENT.exists(m.KEY_BAN_FEED)) == 0
+
+def test_route_serves_gzip_etag_and_ranges(app_main, run, monkeypatch):
+    m = app_main
+    seed(m, run)
+    scheduler = leader(m, run)
+    feed = make_feed(m)
+    run(feed.build(scheduler.token, scheduler.lease_value))
+    monkeypatch.setattr(m, "BAN_FEED", feed)
+
+    plain = fetch(m, run, "/feed/banned_ips.txt", {"Accept-Encoding": "identity"})
+    assert plain.status_code == 200
+    assert plain.text == "198.51.100.7\n203.0.113.1\n2001:db8::1\n"
+    assert plain.headers["X-Feed-Cursor"] == feed.cursor
+
+    compressed = fetch(m, run, "/feed/banned_ips.txt?source=local", {"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.text == "198.51.100.7\n203.0.113.1\n" # httpx decompresses
+
+    etag = plain.headers["ETag"]
+    assert fetch(m, run, "/feed/banned_ips.txt", {"Accept-Encoding": "identity", "If-None-Match": etag}).status_code == 304
+    partial = fetch(m, run, "/feed/banned_ips.txt", {"Accept-Encoding": "identity", "Range": "bytes=0-11"})
+    assert partial.status_code == 206
+    assert partial.text == "198.51.100.7"
+
+def test_route_requires_api_key_when_configured(app_main, run, monkeypatch):
+    m = app_main
+    scheduler = leader(m, run)
+    feed = make_feed(m)
+    run(feed.build(scheduler.token, scheduler.lease_value))
+    monkeypatch.setattr(m, "BAN_FEED", feed)
+    run(m.REDIS_CLIENT.sadd(m.KEY_API_KEYS, "feedkey"))
+
+    assert fetch(m, run, "/feed/banned_ips.txt").status_code == 200
+    monkeypatch.setattr(m, "FEED_REQUIRE_API_KEY", True)
+    assert fetch(m, run, "/feed/banned_ips.txt").status_code == 403
+    assert fetch(m, run, "/feed/banned_ips.txt?apikey=feedkey").status_code == 200
@@ -0,0 +1,76 @@
+import httpx
+
+from app.main import SOURCE_OSINT
+
+def changes(m, run, status=200, **params):
+    async def get():
+        transport = httpx.ASGITransport(app=m.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/v3/feed/changes", params={"apikey": "feedkey", **params})
+    response = run(get())
+    assert response.status_code == status
+    return response.json()["data"] if status == 200 else response
+
+def cursor(m, run):
+    return run(m.latest_change_id())
+
+def test_replays_adds_and_removes_per_source(app_main, run):
+    m = app_main
+    run(m.REDIS_CLIENT.sadd(m.KEY_API_KEYS, "feedkey"))
+    start = cursor(m, run)
+    run(m.store_indicators(["198.51.100.7", "2001:db8::1"], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.ingest_local_ips(["203.0.113.1", "198.51.100.7"]))
+    run(m.remove_indicators(["2001:db8::1"], SOURCE_OSINT))
+
+    data = changes(m, run, since=start)
+    assert data["added"] == ["198.51.100.7", "203.0.113.1"]
+    assert data["removed"] == ["2001:db8::1"]
+    assert data["cursor"] == cursor(m, run)
+    assert not data["reset"] and not data["more"]
+
+    # The local variant only sees the local writes
+    local = changes(m, run, since=start, source="local")
+    assert local["added"] == ["198.51.100.7", "203.0.113.1"]
+    assert local["removed"] == []
+
+    # Nothing new after the returned cursor
+    assert changes(m, run, since=data["cursor"]) == {"cursor": data["cursor"], "reset": False, "added": [], "removed": [], "more": False}
+
+def test_pages_through_the_log(app_main, run):
+    m = app_main
+    run(m.REDIS_CLIENT.sadd(m.KEY_API_KEYS, "feedkey"))
+    start = cursor(m, run)
+    for ip in ["198.51.100.1", "198.51.100.2", "198.51.100.3"]:
+        run(m.store_indicators([ip], SOURCE_OSINT, m.OSINT_TTL))
+
+    first = changes(m, run, since=start, limit=2)
+    assert first["added"] == ["198.51.100.1", "198.51.100.2"]
+    assert first["more"]
+    second = changes(m, run, since=first["cursor"], limit=2)
+    assert second["added"] == ["198.51.100.3"]
+    assert not second["more"]
+
+def test_reset_without_cursor_after_whitelist_edit_and_trim(app_main, run, monkeypatch):
+    m = app_main
+    run(m.REDIS_CLIENT.sadd(m.KEY_API_KEYS, "feedkey"))
+    assert changes(m, run)["reset"]
+
+    start = cursor(m, run)
+    run(m.refresh_list_snapshot(force=True))
+    run(m.apply_list_edit("whitelist", "10.0.0.0/8", added=True))
+    assert changes(m, run, since=start) == {"cursor": None, "reset": True, "added": [], "removed": [], "more": False}
+
+    # The cursor's successor was trimmed from the log
+    start = cursor(m, run)
+    for ip in ["198.51.100.1", "198.51.100.2", "198.51.100.3"]:
+        run(m.store_indicators([ip], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.REDIS_CLIENT.xtrim(m.KEY_CHANGES, maxlen=2, approximate=False))
+    monkeypatch.setattr(m, "CHANGE_LOG_MAXLEN", 2)
+    assert changes(m, run, since=start)["reset"]
+
+def test_rejects_bad_cursor_source_and_key(app_main, run):
+    m = app_main
+    run(m.REDIS_CLIENT.sadd(m.KEY_API_KEYS, "feedkey"))
+    changes(m, run, status=400, since="not-a-cursor")
+    changes(m, run, status=400, since="0-0", source="cloud")
+    changes(m, run, status=403, since="0-0", apikey="wrong")
@@ -0,0 +1,101 @@
+import random
+import ipaddress
+
+import pytest
+
+from app.main import CIDRIndex
+
+def random_rules(count, rng):
+    rules = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.2:
+            addr = ipaddress.IPv6Address(rng.getrandbits(128))
+            rules.append(str(ipaddress.IPv6Network(f"{addr}/{rng.randint(112, 124)}", strict=False)))
+        elif roll < 0.7:
+            # Dense /16 so rules overlap, nest and touch
+            addr = ipaddress.IPv4Address((10 << 24) | (1 << 16) | rng.getrandbits(16))
+            rules.append(str(ipaddress.IPv4Network(f"{addr}/{rng.randint(20, 30)}", strict=False)))
+        else:
+            rules.append(f"10.1.{rng.randint(0, 255)}.{rng.randint(0, 255)}")
+    return rules
+
+def sample_queries(rules, count, rng):
+    """Addresses at and around rule boundaries, plus random ones."""
+    queries = []
+    for rule in rng.sample(rules, min(count, len(rules))):
+        network = ipaddress.ip_network(rule, strict=False)
+        for address in (network.network_address, network.broadcast_address):
+            for delta in (-1, 0, 1):
+                try:
+                    queries.append(str(address + delta))
+                except ipaddress.AddressValueError:
+                    pass
+    queries.extend(str(ipaddress.IPv4Address((10 << 24) | (1 << 16) | rng.getrandbits(16))) for _ in range(count))
+    return queries
+
+def brute_contains(networks, ip):
+    address = ipaddress.ip_address(ip)
+    return any(address.version == network.version and address in network for network in networks)
+
+def brute_address_count(networks):
+    total = 0
+    for version in (4, 6):
+        total += sum(network.num_addresses for network in ipaddress.collapse_addresses(n for n in networks if n.version == version))
+    return total
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_lookups_match_brute_force(seed):
+    rng = random.Random(seed)
+    rules = random_rules(300, rng)
+    networks = [ipaddress.ip_network(rule, strict=False) for rule in rules]
+    index = CIDRIndex(rules + ["not-an-ip", ""])
+
+    for ip in sample_queries(rules, 200, rng):
+        assert (ip in index) == brute_contains(networks, ip), ip
+    assert index.address_count() == brute_address_count(networks)
+
+@pytest.mark.parametrize("seed", [4, 5])
+def test_covers_and_overlapping_match_brute_force(seed):
+    rng = random.Random(seed)
+    rules = random_rules(150, rng)
+    networks = [ipaddress.ip_network(rule, strict=False) for rule in rules]
+    index = CIDRIndex(rules)
+
+    for _ in range(150):
+        query = ipaddress.IPv4Network(f"10.1.{rng.randint(0, 255)}.{rng.randint(0, 255)}/{rng.randint(26, 32)}", strict=False)
+        expected_covers = all(brute_contains(networks, str(address)) for address in query)
+        assert index.covers(str(query)) == expected_covers, query
+        expected_overlapping = sorted(rule for rule, network in zip(rules, networks)
+                                      if network.version == 4 and network.overlaps(query))
+        assert index.overlapping(str(query)) == sorted(set(expected_overlapping)), query
+
+def test_incremental_add_and_remove_match_rebuild():
+    rng = random.Random(6)
+    rules = list(dict.fromkeys(random_rules(200, rng)))
+    index = CIDRIndex()
+    for rule in rules:
+        assert index.add(rule)
+    assert not index.add("not-an-ip")
+
+    removed = set(rng.sample(rules, 80))
+    for rule in removed:
+        assert index.remove(rule)
+    assert not index.remove(next(iter(removed)))
+
+    kept = [rule for rule in rules if rule not in removed]
+    rebuilt = CIDRIndex(kept)
+    networks = [ipaddress.ip_network(rule, strict=False) for rule in kept]
+    assert index.rule_count == rebuilt.rule_count == len(kept)
+    assert index.address_count() == rebuilt.address_count() == brute_address_count(networks)
+    for ip in sample_queries(rules, 100, rng):
+        assert (ip in index) == (ip in rebuilt) == brute_contains(networks, ip), ip
+
+def test_equivalent_rules_count_once():
+    index = CIDRIndex(["10.0.0.0/24", "10.0.0.7/24", "10.0.0.0/25"])
+    assert index.address_count() == 256
+    assert index.remove("10.0.0.0/24")
+    assert "10.0.0.200" in index # Still covered by 10.0.0.7/24
+    assert index.remove("10.0.0.7/24")
+    assert "10.0.0.200" not in index
+    assert index.address_count() == 128
@@ -0,0 +1,117 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+import migrate_compact_storage
+from app.main import SOURCE_LOCAL, SOURCE_OSINT
+
+IPS = ["198.51.100.7", "198.51.100.8", "203.0.113.1", "2001:db8::1"]
+
+@pytest.fixture(params=[("keys", False), ("keys", True), ("compact", False)], ids=["keys", "keys-indexed", "compact"])
+def backend(request, app_main, monkeypatch):
+    storage, expiry_index = request.param
+    monkeypatch.setattr(app_main, "IP_STORAGE_BACKEND", storage)
+    monkeypatch.setattr(app_main, "LEGACY_EXPIRY_INDEX", expiry_index)
+    return app_main
+
+def changes(m, run):
+    """Logged IPs per (op, source). The compact backend logs IPv4 and IPv6 writes as separate entries."""
+    logged = {}
+    for _, fields in run(m.REDIS_CLIENT.xrange(m.KEY_CHANGES)):
+        logged.setdefault((fields["op"], fields["source"]), []).extend(fields["ips"].split(","))
+    return {key: sorted(ips) for key, ips in logged.items()}
+
+def test_store_lookup_remove_round_trip(backend, run):
+    m = backend
+    assert sorted(run(m.store_indicators(IPS, SOURCE_OSINT, m.OSINT_TTL))) == sorted(IPS)
+    assert run(m.store_indicators(IPS[:2], SOURCE_OSINT, m.OSINT_TTL)) == []
+    assert run(m.ingest_local_ips(IPS[1:3])) == IPS[1:3]
+
+    assert run(m.lookup_indicators(IPS + ["192.0.2.1"], use_filter=False)) == [
+        SOURCE_OSINT, SOURCE_LOCAL | SOURCE_OSINT, SOURCE_LOCAL | SOURCE_OSINT, SOURCE_OSINT, 0]
+    assert run(m.count_indicators(SOURCE_LOCAL)) == 2
+    assert run(m.count_indicators(SOURCE_OSINT)) == 4
+
+    assert run(m.remove_indicators(IPS[1:], SOURCE_OSINT)) == 3
+    assert run(m.lookup_indicators(IPS, use_filter=False)) == [SOURCE_OSINT, SOURCE_LOCAL, SOURCE_LOCAL, 0]
+    assert changes(m, run) == {
+        ("add", "osint"): sorted(IPS),
+        ("add", "local"): sorted(IPS[1:3]),
+        ("remove", "osint"): sorted(IPS[1:]),
+    }
+
+def test_compact_layout_is_used_for_ipv4_only(backend, run):
+    m = backend
+    run(m.store_indicators(IPS, SOURCE_OSINT, m.OSINT_TTL))
+    legacy_keys = sorted(run(m.REDIS_CLIENT.keys(f"{m.KEY_OSINT}*")))
+    buckets = run(m.REDIS_CLIENT.keys(f"{m.KEY_COMPACT_BUCKET}*"))
+    if m.IP_STORAGE_BACKEND == "compact":
+        assert legacy_keys == [f"{m.KEY_OSINT}2001:db8::1"]
+        assert len(buckets) == 2
+    else:
+        assert legacy_keys == sorted(f"{m.KEY_OSINT}{ip}" for ip in IPS)
+        assert buckets == []
+
+def test_expiry_sweep_logs_and_counts(backend, run, monkeypatch):
+    m = backend
+    run(m.store_indicators(IPS, SOURCE_OSINT, timedelta(seconds=60)))
+    run(m.ingest_local_ips(IPS[:1]))
+    run(m.REDIS_CLIENT.set(m.KEY_STATS_OSINT, len(IPS)))
+
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    if not m.legacy_expiry_indexed():
+        # Expiries are not tracked: a re-added IP is new, the sweep recounts the totals
+        assert run(m.store_indicators(IPS[:1], SOURCE_OSINT, m.OSINT_TTL)) == IPS[:1]
+        assert run(m.sweep_expired_indicators()) == 0
+        assert run(m.REDIS_CLIENT.get(m.KEY_STATS_OSINT)) == "1"
+        assert ("expire", "osint") not in changes(m, run)
+        assert not run(m.REDIS_CLIENT.exists(m.KEY_LEGACY_EXPIRY))
+        return
+
+    # Refreshing an expired entry the sweep has not seen yet is not new
+    assert run(m.store_indicators(IPS[:1], SOURCE_OSINT, m.OSINT_TTL)) == []
+
+    assert run(m.sweep_expired_indicators()) == 3
+    assert run(m.REDIS_CLIENT.get(m.KEY_STATS_OSINT)) == "1"
+    assert run(m.lookup_indicators(IPS, use_filter=False)) == [SOURCE_LOCAL | SOURCE_OSINT, 0, 0, 0]
+    assert changes(m, run)[("expire", "osint")] == sorted(IPS[1:])
+    assert run(m.sweep_expired_indicators()) == 0
+
+def test_migration_round_trip(app_main, run, monkeypatch):
+    m = app_main
+    run(m.store_indicators(IPS, SOURCE_OSINT, m.OSINT_TTL))
+    run(m.ingest_local_ips(IPS[:2]))
+    before = run(m.lookup_indicators(IPS, use_filter=False))
+    log_length = run(m.REDIS_CLIENT.xlen(m.KEY_CHANGES))
+
+    monkeypatch.setattr(m, "IP_STORAGE_BACKEND", "compact")
+    assert run(migrate_compact_storage.migrate_source(SOURCE_LOCAL, True)) == 2
+    assert run(migrate_compact_storage.migrate_source(SOURCE_OSINT, True)) == 3
+
+    assert run(m.lookup_indicators(IPS, use_filter=False)) == before
+    legacy_keys = run(m.REDIS_CLIENT.keys(f"{m.KEY_LOCAL}*")) + run(m.REDIS_CLIENT.keys(f"{m.KEY_OSINT}*"))
+    assert legacy_keys == [f"{m.KEY_OSINT}2001:db8::1"] # IPv6 stays in the legacy layout
+    run(m.index_legacy_expiries()) # Keys written by the "keys" backend are indexed once
+    assert run(m.REDIS_CLIENT.zrange(m.KEY_LEGACY_EXPIRY, 0, -1)) == legacy_keys
+    assert run(m.REDIS_CLIENT.xlen(m.KEY_CHANGES)) == log_length # Migrated IPs are not new
+    assert run(m.count_indicators(SOURCE_LOCAL)) == 2
+    assert run(m.count_indicators(SOURCE_OSINT)) == 4
+
+def test_compact_backend_refuses_unmigrated_ipv4(app_main, run, monkeypatch):
+    m = app_main
+    run(m.store_indicators(IPS, SOURCE_OSINT, m.OSINT_TTL))
+    run(m.check_storage_backend()) # keys backend: nothing to check
+
+    monkeypatch.setattr(m, "IP_STORAGE_BACKEND", "compact")
+    with pytest.raises(RuntimeError):
+        run(m.check_storage_backend())
+    assert run(migrate_compact_storage.migrate_source(SOURCE_OSINT, True)) == 3
+    run(m.check_storage_backend()) # Only IPv6 is left under legacy keys
+    assert run(m.REDIS_CLIENT.exists(m.KEY_COMPACT_MIGRATED))
+
+    # Switching back to the keys backend writes IPv4 legacy keys again
+    monkeypatch.setattr(m, "IP_STORAGE_BACKEND", "keys")
+    run(m.check_storage_backend())
+    assert not run(m.REDIS_CLIENT.exists(m.KEY_COMPACT_MIGRATED))
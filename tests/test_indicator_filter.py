@@ -0,0 +1,57 @@
+from app.main import SOURCE_LOCAL, SOURCE_OSINT
+
+def make_filter(m):
+    return m.IndicatorFilter(True, 0.01, 1000, 3600)
+
+def test_filter_answers_misses_without_redis(app_main, run, monkeypatch):
+    m = app_main
+    run(m.store_indicators(["198.51.100.7"], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.ingest_local_ips(["203.0.113.1"]))
+    indicator_filter = make_filter(m)
+    run(indicator_filter.build())
+    monkeypatch.setattr(m, "INDICATOR_FILTER", indicator_filter)
+
+    assert run(m.lookup_indicators(["198.51.100.7", "203.0.113.1", "192.0.2.1"])) == [SOURCE_OSINT, SOURCE_LOCAL, 0]
+    assert indicator_filter.negatives == 1
+    assert indicator_filter.positives == 2
+
+def test_follow_changes_adds_writes_of_other_workers(app_main, run):
+    m = app_main
+    run(m.store_indicators(["198.51.100.7"], SOURCE_OSINT, m.OSINT_TTL))
+    other = make_filter(m)
+    run(other.build())
+
+    # Written by this worker: the global filter learns it, `other` only through the change log
+    run(m.store_indicators(["198.51.100.8"], SOURCE_OSINT, m.OSINT_TTL))
+    assert not other.might_contain("198.51.100.8")
+    assert run(other.follow_changes())
+    assert other.might_contain("198.51.100.8")
+
+def test_follow_changes_from_empty_log_is_not_a_gap(app_main, run):
+    m = app_main
+    indicator_filter = make_filter(m)
+    run(indicator_filter.build())
+    assert indicator_filter.cursor == "0-0"
+
+    run(m.store_indicators(["198.51.100.7"], SOURCE_OSINT, m.OSINT_TTL))
+    assert run(indicator_filter.follow_changes())
+    assert indicator_filter.might_contain("198.51.100.7")
+
+def test_log_trimmed_past_cursor_is_detected(app_main, run):
+    m = app_main
+    run(m.store_indicators(["198.51.100.7"], SOURCE_OSINT, m.OSINT_TTL))
+    indicator_filter = make_filter(m)
+    run(indicator_filter.build())
+
+    run(m.store_indicators(["198.51.100.8"], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.store_indicators(["198.51.100.9"], SOURCE_OSINT, m.OSINT_TTL))
+    run(m.REDIS_CLIENT.xtrim(m.KEY_CHANGES, maxlen=1, approximate=False)) # The entry adding .8 is gone
+    assert not run(indicator_filter.follow_changes())
+
+def test_filter_is_off_without_change_log(app_main, run, monkeypatch):
+    m = app_main
+    monkeypatch.setattr(m, "CHANGE_LOG_MAXLEN", 0)
+    indicator_filter = make_filter(m)
+    run(indicator_filter.run()) # Returns instead of looping
+    assert not indicator_filter.enabled
+    assert indicator_filter.might_contain("192.0.2.1")
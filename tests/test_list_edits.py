@@ -0,0 +1,46 @@
+def counts(m, run):
+    return run(m.REDIS_CLIENT.mget(m.LIST_STATS_KEYS["blacklist"], m.LIST_STATS_KEYS["whitelist"]))
+
+def test_edits_bump_generation_and_store_counts(app_main, run):
+    m = app_main
+    run(m.REDIS_CLIENT.set(m.KEY_BLACKLIST_SOURCE_HASH, "abc"))
+    run(m.refresh_list_snapshot(force=True))
+
+    assert run(m.apply_list_edit("blacklist", "198.51.100.0/24", added=True))
+    assert run(m.apply_list_edit("blacklist", "198.51.100.7", added=True)) # Covered: count stays
+    assert not run(m.apply_list_edit("blacklist", "198.51.100.7", added=True)) # Already present
+    assert run(m.REDIS_CLIENT.get(m.KEY_LISTS_GENERATION)) == "2"
+    assert run(m.REDIS_CLIENT.exists(m.KEY_BLACKLIST_SOURCE_HASH)) == 0
+    assert counts(m, run) == ["256", None]
+
+    assert run(m.apply_list_edit("whitelist", "10.0.0.0/30", added=True))
+    assert run(m.apply_list_edit("blacklist", "198.51.100.0/24", added=False))
+    assert not run(m.apply_list_edit("blacklist", "192.0.2.1", added=False))
+    assert counts(m, run) == ["1", "4"]
+    assert run(m.REDIS_CLIENT.smembers(m.KEY_BLACKLIST)) == {"198.51.100.7"}
+    assert m.LIST_SNAPSHOT.generation == "4"
+
+def test_edit_behind_another_worker_reloads(app_main, run):
+    m = app_main
+    run(m.refresh_list_snapshot(force=True))
+    run(m.apply_list_edit("blacklist", "198.51.100.0/24", added=True))
+
+    # Another worker's edit this snapshot has not seen yet
+    run(m.REDIS_CLIENT.sadd(m.KEY_BLACKLIST, "203.0.113.0/24"))
+    run(m.REDIS_CLIENT.incr(m.KEY_LISTS_GENERATION))
+
+    run(m.apply_list_edit("blacklist", "192.0.2.1", added=True))
+    assert m.LIST_SNAPSHOT.blacklist == {"198.51.100.0/24", "203.0.113.0/24", "192.0.2.1"}
+    assert counts(m, run)[0] == "513"
+
+def test_stale_counts_are_not_stored(app_main, run):
+    m = app_main
+    run(m.refresh_list_snapshot(force=True))
+    run(m.apply_list_edit("blacklist", "198.51.100.0/24", added=True))
+    assert counts(m, run)[0] == "256"
+
+    # A newer edit elsewhere moved the generation: this worker's counts are stale
+    run(m.REDIS_CLIENT.incr(m.KEY_LISTS_GENERATION))
+    m.LIST_SNAPSHOT.blacklist_index.add("203.0.113.0/24")
+    assert not run(m.store_list_stats(["blacklist"]))
+    assert counts(m, run)[0] == "256"
@@ -0,0 +1,107 @@
+import json
+import asyncio
+
+def make_scheduler(m, node, jobs=()):
+    scheduler = m.Scheduler(list(jobs), lease_ttl=30)
+    scheduler.node = node
+    return scheduler
+
+def test_single_leader_and_handover(app_main, run):
+    m = app_main
+    first, second = make_scheduler(m, "node-a"), make_scheduler(m, "node-b")
+    run(first.tick())
+    run(second.tick())
+    assert first.token == 1
+    assert second.token == 0
+
+    run(first.tick()) # Renewal keeps the token
+    assert first.token == 1
+
+    run(first.release())
+    assert run(m.REDIS_CLIENT.get(m.KEY_SCHEDULER_LEASE)) is None
+    run(second.tick())
+    assert second.token == 2
+    run(first.tick())
+    assert first.token == 0
+
+def test_stale_leader_cannot_record_or_release(app_main, run):
+    m = app_main
+    leader = make_scheduler(m, "node-a")
+    run(leader.tick())
+    stale_value = leader.lease_value
+
+    # The lease expires and another node takes over with a higher token
+    run(m.REDIS_CLIENT.delete(m.KEY_SCHEDULER_LEASE))
+    successor = make_scheduler(m, "node-b")
+    run(successor.tick())
+    assert successor.token == 2
+
+    fenced = [m.KEY_SCHEDULER_LEASE, m.KEY_SCHEDULER_JOBS]
+    assert run(m.FENCED_LEASE_SCRIPT(keys=fenced, args=[stale_value, "job", json.dumps({"started": 0})])) == 0
+    assert run(m.FENCED_LEASE_SCRIPT(keys=fenced, args=[stale_value, "", ""])) == 0
+    assert run(m.REDIS_CLIENT.hgetall(m.KEY_SCHEDULER_JOBS)) == {}
+    assert run(m.REDIS_CLIENT.get(m.KEY_SCHEDULER_LEASE)) == successor.lease_value
+
+def test_jobs_run_once_per_interval(app_main, run):
+    m = app_main
+    calls = []
+
+    async def job():
+        calls.append(1)
+
+    leader = make_scheduler(m, "node-a", [m.ScheduledJob("job", job, 3600)])
+    run(leader.tick())
+    run(next(iter(leader.tasks.values())))
+    assert calls == [1]
+
+    # A restarted node sees the recorded run and does not start the job again
+    restarted = make_scheduler(m, "node-a-restarted", [m.ScheduledJob("job", job, 3600)])
+    run(leader.release())
+    run(restarted.tick())
+    assert restarted.token
+    assert restarted.tasks == {}
+    assert restarted.records["job"]["status"] == "ok"
+
+def test_failed_job_is_recorded_and_late_runs_are_not(app_main, run):
+    m = app_main
+
+    async def failing():
+        raise ValueError("feed down")
+
+    leader = make_scheduler(m, "node-a", [m.ScheduledJob("failing", failing, 3600)])
+    run(leader.tick())
+    run(next(iter(leader.tasks.values())))
+    assert json.loads(run(m.REDIS_CLIENT.hget(m.KEY_SCHEDULER_JOBS, "failing")))["status"] == "error"
+
+    # A run that ends after the lease moved on is not recorded under the old token
+    run(m.REDIS_CLIENT.delete(m.KEY_SCHEDULER_LEASE, m.KEY_SCHEDULER_JOBS))
+    run(make_scheduler(m, "node-b").tick())
+    run(leader.run_job(m.ScheduledJob("late", failing, 3600), leader.token))
+    assert run(m.REDIS_CLIENT.hgetall(m.KEY_SCHEDULER_JOBS)) == {}
+
+def test_losing_the_lease_cancels_running_jobs(app_main, run):
+    m = app_main
+    blocker = []
+
+    async def slow():
+        blocker.append(1)
+        await asyncio.sleep(3600)
+
+    async def lead_then_lose():
+        leader = make_scheduler(m, "node-a", [m.ScheduledJob("slow", slow, 3600),
+                                              m.ScheduledJob("later", slow, 3600, run_at_start=False)])
+        await leader.tick()
+        assert list(leader.tasks) == ["slow"] # run_at_start=False waits one interval
+        task = leader.tasks["slow"]
+        await asyncio.sleep(0)
+        await m.REDIS_CLIENT.delete(m.KEY_SCHEDULER_LEASE)
+        await make_scheduler(m, "node-b").tick()
+        await leader.tick()
+        await asyncio.gather(task, return_exceptions=True)
+        return leader, task
+
+    leader, task = run(lead_then_lose())
+    assert blocker == [1]
+    assert task.cancelled()
+    assert leader.token == 0
+    assert leader.tasks == {}
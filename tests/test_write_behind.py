@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.main import SOURCE_LOCAL
+
+@pytest.fixture
+def buffer(app_main, run):
+    async def start():
+        buffer = app_main.WriteBehindBuffer(3600, 1000, 3)
+        buffer.start()
+        return buffer
+    buffer = run(start())
+    yield buffer
+    run(buffer.close())
+
+def post_webhook(m, run, ip):
+    async def post():
+        transport = httpx.ASGITransport(app=m.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/webhook", json={"attack_ip": ip})
+    return run(post())
+
+def test_flusher_is_a_tracked_background_task(app_main, buffer):
+    assert buffer.task in app_main.BACKGROUND_TASKS
+    assert not buffer.task.done()
+
+def test_repeat_hits_are_coalesced_into_one_write(app_main, buffer, run):
+    m = app_main
+    for ip in ["203.0.113.1", "203.0.113.2", "203.0.113.1"]:
+        assert run(buffer.add(ip))
+    assert list(buffer.pending) == ["203.0.113.1", "203.0.113.2"]
+    assert buffer.coalesced == 1
+
+    assert run(buffer.flush()) == 2
+    assert buffer.pending == {}
+    assert run(m.lookup_indicators(["203.0.113.1", "203.0.113.2"], use_filter=False)) == [SOURCE_LOCAL, SOURCE_LOCAL]
+    assert run(m.REDIS_CLIENT.get(m.KEY_STATS_LOCAL)) == "2"
+
+def test_full_buffer_flushes_inline(app_main, buffer, run):
+    for i in range(4):
+        assert run(buffer.add(f"203.0.113.{i}"))
+    assert buffer.backpressure_waits == 1
+    assert buffer.written == 3
+    assert list(buffer.pending) == ["203.0.113.3"]
+
+def test_failed_flush_keeps_the_batch_and_rejects_with_503(app_main, buffer, run, monkeypatch):
+    m = app_main
+    for i in range(3):
+        run(buffer.add(f"203.0.113.{i}"))
+
+    async def unavailable(ips):
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(m, "ingest_local_ips", unavailable)
+    monkeypatch.setattr(m, "WEBHOOK_WRITE_BEHIND", True)
+    monkeypatch.setattr(m, "WEBHOOK_BUFFER", buffer)
+    response = post_webhook(m, run, "198.51.100.7")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert list(buffer.pending) == [f"203.0.113.{i}" for i in range(3)] # Kept for the next flush
+    assert buffer.failed_flushes == 1
+    assert buffer.rejected == 1
+
+def test_close_drains_the_queue(app_main, buffer, run):
+    m = app_main
+    run(buffer.add("203.0.113.1"))
+    run(buffer.close())
+    assert not buffer.running
+    assert buffer.pending == {}
+    assert run(m.lookup_indicators(["203.0.113.1"], use_filter=False)) == [SOURCE_LOCAL]
+    run(asyncio.sleep(0)) # Let the cancelled flusher finish
+    assert buffer.task.done()
+    assert buffer.task not in m.BACKGROUND_TASKS
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import random
+import ipaddress
+
+# Run from anywhere: app.main expects the repository root as working directory
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+from app.main import CIDRIndex, is_ip_in_cidr_list  # noqa: E402
+
+RULE_COUNTS = [100, 1000, 5000]
+QUERIES = 2000
+SEED = 42
+
+def random_rules(count, rng):
+    rules = set()
+    while len(rules) < count:
+        roll = rng.random()
+        if roll < 0.1:
+            # IPv6 prefix
+            addr = ipaddress.IPv6Address(rng.getrandbits(128))
+            rules.add(str(ipaddress.IPv6Network(f"{addr}/{rng.randint(32, 64)}", strict=False)))
+        elif roll < 0.6:
+            # IPv4 CIDR
+            addr = ipaddress.IPv4Address(rng.getrandbits(32))
+            rules.add(str(ipaddress.IPv4Network(f"{addr}/{rng.randint(8, 30)}", strict=False)))
+        else:
+            # Single IPv4 address
+            rules.add(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+    return rules
+
+def random_queries(count, rng):
+    return [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(count)]
+
+def bench(label, func, queries):
+    start = time.perf_counter()
+    hits = sum(1 for ip in queries if func(ip))
+    elapsed = time.perf_counter() - start
+    per_call_us = elapsed / len(queries) * 1_000_000
+    print(f"  {label:<22} {elapsed * 1000:10.2f}ms total  {per_call_us:10.2f}µs/lookup  ({hits} hits)")
+    return elapsed, hits
+
+def run():
+    rng = random.Random(SEED)
+    queries = random_queries(QUERIES, rng)
+
+    for rule_count in RULE_COUNTS:
+        rules = random_rules(rule_count, rng)
+        print(f"Rules: {rule_count}, Lookups: {QUERIES}")
+
+        start = time.perf_counter()
+        index = CIDRIndex(rules)
+        print(f"  {'CIDRIndex build':<22} {(time.perf_counter() - start) * 1000:10.2f}ms")
+
+        linear_time, linear_hits = bench("is_ip_in_cidr_list", lambda ip: is_ip_in_cidr_list(ip, rules), queries)
+        index_time, index_hits = bench("CIDRIndex", lambda ip: ip in index, queries)
+
+        if linear_hits != index_hits:
+            print(f"  ❌ MISMATCH: linear={linear_hits} index={index_hits}")
+        else:
+            print(f"  ✅ Results match, speedup x{linear_time / index_time:.1f}")
+        print()
+
+if __name__ == "__main__":
+    run()
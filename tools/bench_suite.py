@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import ipaddress
+import subprocess
+from datetime import datetime
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import httpx
+
+# Reproducible benchmark of the reputation, webhook and ingestion paths against a
+# throwaway local redis-server. For every scale (stored IPs x blacklist rules) it
+# flushes the database, seeds synthetic data with a fixed seed and measures:
+#
+#   reputation        GET /v3/scene/ip_reputation (half stored IPs, half unknown)
+#   webhook           POST /webhook (half repeat attackers, half new)
+#   blacklist_reload  load_blacklist_from_file(force=True)
+#   db_cleanup        one run_db_cleanup pass (incremental, nothing new to purge)
+#   db_cleanup_full   one run_db_cleanup pass with a full blacklist purge scan
+#   osint_cold        run_osint_cycle, full download and store from a local fixture server
+#   osint_warm        run_osint_cycle where every feed answers 304
+#
+# HTTP paths run in-process through the ASGI app (no uvicorn, no background tasks),
+# so the numbers cover one worker plus Redis. Use tools/measure_latency.py against a
+# real deployment. Results are written as JSON; pass --compare to diff two runs.
+#
+#   redis-server --port 6390 --save '' --appendonly no &
+#   python tools/bench_suite.py --redis-url redis://localhost:6390/0 --flush
+#   python tools/bench_suite.py --redis-url redis://localhost:6390/0 --flush --ips 10000 --rules 100 --compare bench-old.json
+#
+# The target database is FLUSHED. Never point this at production data.
+
+INVOKE_DIR = os.getcwd()
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+SEED = 42
+SEED_CHUNK = 10000
+FIXTURE_OVERLAP = 0.5 # Share of each fixture feed that is already stored as OSINT
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def random_public_ips(count, rng, exclude=()):
+    """Unique random IPv4 addresses in 1.0.0.0 - 223.255.255.255."""
+    found = set()
+    while len(found) < count:
+        value = rng.getrandbits(32)
+        if 1 <= value >> 24 <= 223:
+            ip = str(ipaddress.IPv4Address(value))
+            if ip not in exclude:
+                found.add(ip)
+    return sorted(found)
+
+def random_rules(count, rng):
+    rules = set()
+    while len(rules) < count:
+        roll = rng.random()
+        if roll < 0.1:
+            addr = ipaddress.IPv6Address(rng.getrandbits(128))
+            rules.add(str(ipaddress.IPv6Network(f"{addr}/{rng.randint(32, 64)}", strict=False)))
+        elif roll < 0.6:
+            addr = ipaddress.IPv4Address(rng.getrandbits(32))
+            rules.add(str(ipaddress.IPv4Network(f"{addr}/{rng.randint(16, 30)}", strict=False)))
+        else:
+            rules.add(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+    return sorted(rules)
+
+def summarize(case, scale, ops, concurrency, elapsed, latencies, errors):
+    ms = [value * 1000 for value in latencies]
+    result = {
+        "case": case,
+        "ips": scale[0],
+        "rules": scale[1],
+        "ops": ops,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "ops_per_s": round(ops / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(max(ms), 3) if ms else 0.0,
+    }
+    print(f"  {case:<17} {result['ops_per_s']:>10.1f} ops/s  p50 {result['p50_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms  ({ops} ops, c={concurrency}, {errors} errors)")
+    return result
+
+async def drive(case, scale, func, items, concurrency):
+    """Runs func over items with `concurrency` workers; func returns True on success."""
+    latencies = []
+    errors = 0
+    pending = iter(items)
+
+    async def worker():
+        nonlocal errors
+        for item in pending:
+            start = time.perf_counter()
+            try:
+                ok = await func(item)
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(case, scale, len(items), concurrency, time.perf_counter() - start, latencies, errors)
+
+async def repeat(case, scale, func, runs, before=None):
+    """Times `runs` sequential calls of func; `before` runs untimed ahead of each call."""
+    timings = []
+    for _ in range(runs):
+        if before:
+            await before()
+        start = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - start)
+    return summarize(case, scale, runs, 1, sum(timings), timings, 0)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_fixture_server(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_feed_fixtures(m, directory, stored_osint, feed_ips, rng):
+    """One file per configured OSINT feed, in the format its parser expects."""
+    for number, feed in enumerate(m.OSINT_FEEDS):
+        known = rng.sample(stored_osint, min(len(stored_osint), int(feed_ips * FIXTURE_OVERLAP)))
+        ips = known + random_public_ips(feed_ips - len(known), rng)
+        lines = [f"# honey-api benchmark fixture: {feed['name']}"]
+        if feed["parser"] is m.parse_ipsum_line:
+            lines += [f"{ip}\t{rng.randint(4, 9)}" for ip in ips]
+        elif feed["parser"] is m.parse_threatfox_line:
+            lines += [f'"2024-01-01 00:00:00","{number}{i}","{ip}:443","ip:port","botnet_cc","Bench","","","75","",""' for i, ip in enumerate(ips)]
+        else:
+            lines += ips
+        path = os.path.join(directory, f"{feed['name']}.txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.utime(path, (1700000000, 1700000000)) # Fixed Last-Modified, so warm runs get 304
+
+async def reset_state(m):
+    await m.REDIS_CLIENT.flushdb()
+    await m.refresh_list_snapshot(force=True)
+    m.REPUTATION_CACHE.clear()
+
+async def seed(m, ips):
+    """Half local (webhook path), half OSINT (feed path)."""
+    half = len(ips) // 2
+    for i in range(0, half, SEED_CHUNK):
+        await m.ingest_local_ips(ips[i:i + SEED_CHUNK])
+    osint_new = 0
+    for i in range(half, len(ips), SEED_CHUNK):
+        osint_new += await m.store_osint_ips(ips[i:i + SEED_CHUNK])
+    await m.REDIS_CLIENT.incrby(m.KEY_STATS_OSINT, osint_new)
+    await m.INDICATOR_FILTER.build()
+
+async def run_scale(m, args, scale, apikey, client, fixture_dir):
+    ip_count, rule_count = scale
+    rng = random.Random(f"{SEED}:{ip_count}:{rule_count}")
+    print(f"Stored IPs: {ip_count}, blacklist rules: {rule_count}")
+
+    await reset_state(m)
+    await m.REDIS_CLIENT.hset(m.KEY_API_KEYS_V2, apikey, "bench")
+    with open("scan-blacklist.conf", "w") as f:
+        f.write("\n".join(random_rules(rule_count, rng)) + "\n")
+    await m.load_blacklist_from_file(force=True)
+
+    start = time.perf_counter()
+    stored = random_public_ips(ip_count, rng)
+    await seed(m, stored)
+    print(f"  {'seed':<17} {time.perf_counter() - start:>10.2f}s")
+
+    results = []
+    unknown = random_public_ips(args.requests, rng, exclude=set(stored))
+    queries = [rng.choice(stored) if i % 2 else unknown[i] for i in range(args.requests)]
+
+    async def reputation(ip):
+        r = await client.get("/v3/scene/ip_reputation", params={"apikey": apikey, "resource": ip})
+        return r.status_code == 200
+    results.append(await drive("reputation", scale, reputation, queries, args.concurrency))
+
+    attackers = [rng.choice(stored) if i % 2 else unknown[-1 - i] for i in range(args.requests)]
+
+    async def webhook(ip):
+        r = await client.post("/webhook", json={"attack_ip": ip})
+        return r.status_code == 200
+    results.append(await drive("webhook", scale, webhook, attackers, args.concurrency))
+
+    results.append(await repeat("blacklist_reload", scale, lambda: m.load_blacklist_from_file(force=True), args.runs))
+    results.append(await repeat("db_cleanup", scale, m.run_db_cleanup, args.runs))
+
+    async def forget_applied_rules():
+        await m.REDIS_CLIENT.unlink(m.KEY_BLACKLIST_APPLIED)
+    results.append(await repeat("db_cleanup_full", scale, m.run_db_cleanup, args.runs, before=forget_applied_rules))
+
+    stored_osint = stored[len(stored) // 2:]
+    write_feed_fixtures(m, fixture_dir, stored_osint, args.feed_ips, rng)
+
+    async def forget_feeds():
+        await m.REDIS_CLIENT.unlink(*[f"{prefix}{feed['name']}" for feed in m.OSINT_FEEDS
+                                      for prefix in (m.KEY_FEED_META, m.KEY_FEED_SNAPSHOT)])
+    results.append(await repeat("osint_cold", scale, m.run_osint_cycle, args.runs, before=forget_feeds))
+    results.append(await repeat("osint_warm", scale, m.run_osint_cycle, args.runs))
+    print()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["case"], r["ips"], r["rules"]): r for r in json.load(f)["results"]}
+    print(f"Compared with {baseline_path}:")
+    for r in results:
+        old = baseline.get((r["case"], r["ips"], r["rules"]))
+        if not old or not old["ops_per_s"] or not old["p99_ms"]:
+            continue
+        print(f"  {r['case']:<17} ips={r['ips']:<8} rules={r['rules']:<6} throughput x{r['ops_per_s'] / old['ops_per_s']:.2f}  p99 x{r['p99_ms'] / old['p99_ms']:.2f}")
+
+async def run(args):
+    # app.main reads its configuration at import time
+    os.environ["REDIS_URL"] = args.redis_url
+    os.environ["IP_STORAGE_BACKEND"] = args.storage
+    import logging
+    import app.main as m
+    logging.getLogger(m.__name__).setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if await m.REDIS_CLIENT.dbsize() and not args.flush:
+        print(f"❌ {args.redis_url} is not empty. Use a throwaway database and pass --flush to wipe it.")
+        return 1
+    redis_version = (await m.REDIS_CLIENT.info("server")).get("redis_version")
+
+    workdir = tempfile.mkdtemp(prefix="honey-bench-")
+    os.chdir(workdir) # Blacklist files are read from the working directory
+    fixture_dir = os.path.join(workdir, "feeds")
+    os.makedirs(fixture_dir)
+    server = start_fixture_server(fixture_dir)
+    for feed in m.OSINT_FEEDS:
+        feed["url"] = f"http://127.0.0.1:{server.server_port}/{feed['name']}.txt"
+
+    scales = [(ips, rules) for ips in args.ips for rules in args.rules]
+    results = []
+    transport = httpx.ASGITransport(app=m.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for scale in scales:
+            results += await run_scale(m, args, scale, "bench-key", client, fixture_dir)
+    server.shutdown()
+    await m.REDIS_CLIENT.flushdb()
+    await m.REDIS_CLIENT.aclose()
+
+    report = {
+        "meta": {
+            "started": datetime.now().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis_version": redis_version,
+            "storage": args.storage,
+            "seed": SEED,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "runs": args.runs,
+            "feed_ips": args.feed_ips,
+        },
+        "results": results,
+    }
+    output = os.path.join(INVOKE_DIR, args.output or f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, os.path.join(INVOKE_DIR, args.compare))
+    return 0
+
+def int_list(value):
+    return [int(part) for part in value.split(",") if part]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark reputation, webhook and ingestion paths against a local Redis")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15", help="Throwaway Redis database (it is flushed)")
+    parser.add_argument("--flush", action="store_true", help="Allow wiping a non-empty database")
+    parser.add_argument("--storage", choices=("keys", "compact"), default=os.getenv("IP_STORAGE_BACKEND", "keys"))
+    parser.add_argument("--ips", type=int_list, default=[10000, 1000000], help="Comma-separated stored IP counts")
+    parser.add_argument("--rules", type=int_list, default=[100, 10000], help="Comma-separated blacklist rule counts")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests per HTTP case")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=3, help="Runs per job case")
+    parser.add_argument("--feed-ips", type=int, default=20000, help="IPs per fixture OSINT feed")
+    parser.add_argument("--output", help="JSON results file (default bench-<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,58 @@
+import sys
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Measures latency of /v3/scene/ip_reputation under concurrent load.
+# Run it against a deployment before and after a change to compare p50/p99.
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def run(base_url, apikey, concurrency, total):
+    url = f"{base_url.rstrip('/')}/v3/scene/ip_reputation"
+    rng = random.Random(42)
+    ips = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}" for _ in range(total)]
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one(ip):
+        start = time.perf_counter()
+        try:
+            r = session.get(url, params={"apikey": apikey, "resource": ip}, timeout=10)
+            ok = r.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    print(f"Sending {total} requests to {url} with concurrency {concurrency}...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, ips))
+    elapsed = time.perf_counter() - start
+
+    latencies = [ms for ms, ok in results if ok]
+    errors = len(results) - len(latencies)
+    print(f"Throughput: {len(results) / elapsed:.1f} req/s ({errors} errors)")
+    print(f"Latency p50: {percentile(latencies, 50):.2f}ms")
+    print(f"Latency p95: {percentile(latencies, 95):.2f}ms")
+    print(f"Latency p99: {percentile(latencies, 99):.2f}ms")
+    print(f"Latency max: {max(latencies) if latencies else 0:.2f}ms")
+    return 0 if not errors else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent latency check for the reputation endpoint")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Base URL of honey-api")
+    parser.add_argument("--apikey", required=True, help="Valid API key")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+    sys.exit(run(args.url, args.apikey, args.concurrency, args.requests))
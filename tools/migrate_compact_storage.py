@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+# Migrates legacy per-IP keys (ti:local:{ip}, ti:osint:{ip}) into the compact IPv4
+# layout used by IP_STORAGE_BACKEND=compact and prints a memory comparison report.
+#
+#   docker compose exec ti-bridge python tools/migrate_compact_storage.py --report-only
+#   docker compose exec ti-bridge python tools/migrate_compact_storage.py
+#   docker compose exec ti-bridge python tools/migrate_compact_storage.py --delete-legacy
+#
+# Safe to re-run: compact expiries only ever move forward. Recommended order:
+# migrate while the old workers still run, stop them, re-run with --delete-legacy
+# to pick up writes made in between and drop the old keys, then start with
+# IP_STORAGE_BACKEND=compact. The app refuses to start in compact mode while IPv4
+# legacy keys are left; once none are, the tool sets ti:v4:migrated.
+# IPv6 (and other non-IPv4) keys are left untouched; the compact backend keeps using them.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+from app.main import (  # noqa: E402
+    REDIS_CLIENT, COMPACT_UPSERT_SCRIPT, KEY_COMPACT_BUCKET, KEY_COMPACT_EXPIRY, KEY_CHANGES, KEY_LEGACY_EXPIRY,
+    SOURCE_LOCAL, SOURCE_OSINT, SOURCE_PREFIXES, LOCAL_TTL, OSINT_TTL, compact_location, mark_compact_migrated,
+)
+
+BATCH = 1000
+SAMPLE_SIZE = 2000
+DEFAULT_TTL = {SOURCE_LOCAL: LOCAL_TTL, SOURCE_OSINT: OSINT_TTL}
+SOURCE_NAMES = {SOURCE_LOCAL: "local", SOURCE_OSINT: "osint"}
+
+def fmt_bytes(value):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(value) < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TiB"
+
+async def legacy_report():
+    """Counts legacy keys per source and estimates their memory from a sample."""
+    report = {}
+    for source, prefix in SOURCE_PREFIXES.items():
+        count = 0
+        ipv4 = 0
+        sampled = []
+        async for key in REDIS_CLIENT.scan_iter(match=f"{prefix}*", count=BATCH):
+            count += 1
+            if compact_location(key[len(prefix):]):
+                ipv4 += 1
+                if len(sampled) < SAMPLE_SIZE:
+                    sampled.append(key)
+        pipe = REDIS_CLIENT.pipeline(transaction=False)
+        for key in sampled:
+            pipe.memory_usage(key, samples=0)
+        usages = [usage for usage in await pipe.execute() if usage]
+        avg = sum(usages) / len(usages) if usages else 0
+        report[source] = {"keys": count, "ipv4": ipv4, "avg_bytes": avg, "ipv4_bytes": avg * ipv4}
+    return report
+
+async def compact_report():
+    """Exact memory of all compact buckets plus the expiry index."""
+    buckets = 0
+    entries = 0
+    total = 0
+    async for key in REDIS_CLIENT.scan_iter(match=f"{KEY_COMPACT_BUCKET}*", count=BATCH):
+        buckets += 1
+        entries += await REDIS_CLIENT.hlen(key)
+        total += await REDIS_CLIENT.memory_usage(key, samples=0) or 0
+    total += await REDIS_CLIENT.memory_usage(KEY_COMPACT_EXPIRY, samples=0) or 0
+    return {"buckets": buckets, "entries": entries, "bytes": total}
+
+async def migrate_source(source, delete_legacy):
+    prefix = SOURCE_PREFIXES[source]
+    default_ttl = int(DEFAULT_TTL[source].total_seconds())
+    migrated = 0
+    cursor = 0
+    while True:
+        cursor, keys = await REDIS_CLIENT.scan(cursor=cursor, match=f"{prefix}*", count=BATCH)
+        located = [(key, compact_location(key[len(prefix):])) for key in keys]
+        located = [(key, location) for key, location in located if location]
+        if located:
+            pipe = REDIS_CLIENT.pipeline(transaction=False)
+            for key, _ in located:
+                pipe.ttl(key)
+            ttls = await pipe.execute()
+
+            now = int(time.time())
+            bucket_keys = [KEY_COMPACT_EXPIRY, KEY_CHANGES]
+            args = [source, 0, SOURCE_NAMES[source]] # Change log maxlen 0: the IPs are not new
+            done = []
+            for (key, (bucket, field)), ttl in zip(located, ttls):
+                if ttl == -2:
+                    continue # Expired meanwhile
+                bucket_keys.append(bucket)
+                args.extend((field, now + (ttl if ttl > 0 else default_ttl), key[len(prefix):]))
+                done.append(key)
+            if done:
+                await COMPACT_UPSERT_SCRIPT(keys=bucket_keys, args=args)
+                if delete_legacy:
+                    await REDIS_CLIENT.unlink(*done)
+                    # Not expired, moved: keep the legacy sweep from logging them as expiries
+                    await REDIS_CLIENT.zrem(KEY_LEGACY_EXPIRY, *done)
+                migrated += len(done)
+        if str(cursor) == '0':
+            break
+    return migrated
+
+def print_report(legacy, compact):
+    print("----------------------------------------------------------------")
+    legacy_bytes = 0
+    legacy_ipv4 = 0
+    for source, data in legacy.items():
+        name = SOURCE_NAMES[source]
+        print(f"Legacy {name:<6} keys: {data['keys']:>10} ({data['ipv4']} IPv4), ~{data['avg_bytes']:.0f} B/key, IPv4 total ~{fmt_bytes(data['ipv4_bytes'])}")
+        legacy_bytes += data["ipv4_bytes"]
+        legacy_ipv4 += data["ipv4"]
+    print(f"Compact buckets:    {compact['buckets']:>10}, entries {compact['entries']}, total {fmt_bytes(compact['bytes'])}")
+    if compact["entries"]:
+        print(f"Compact per IP:     {compact['bytes'] / compact['entries']:.1f} B (both sources in one entry)")
+    if legacy_ipv4 and compact["bytes"]:
+        print(f"Legacy IPv4 keys ~{fmt_bytes(legacy_bytes)} vs compact {fmt_bytes(compact['bytes'])} -> x{legacy_bytes / compact['bytes']:.1f} smaller")
+    print("----------------------------------------------------------------")
+
+async def run(args):
+    info_before = await REDIS_CLIENT.info("memory")
+    print("Scanning legacy keys...")
+    legacy = await legacy_report()
+
+    if not args.report_only:
+        for source in (SOURCE_LOCAL, SOURCE_OSINT):
+            count = await migrate_source(source, args.delete_legacy)
+            print(f"Migrated {count} {SOURCE_NAMES[source]} IPv4 keys{' (legacy keys deleted)' if args.delete_legacy else ''}")
+        if args.delete_legacy:
+            if await mark_compact_migrated():
+                print("No IPv4 legacy keys left: IP_STORAGE_BACKEND=compact can start.")
+            else:
+                print("IPv4 legacy keys were written during the migration. Stop the old workers and re-run.")
+
+    compact = await compact_report()
+    print_report(legacy, compact)
+
+    info_after = await REDIS_CLIENT.info("memory")
+    print(f"Redis used_memory before: {fmt_bytes(info_before['used_memory'])}, after: {fmt_bytes(info_after['used_memory'])}")
+    await REDIS_CLIENT.aclose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate legacy indicator keys to the compact IPv4 layout")
+    parser.add_argument("--delete-legacy", action="store_true", help="Unlink legacy IPv4 keys after copying them")
+    parser.add_argument("--report-only", action="store_true", help="Only print the memory report")
+    asyncio.run(run(parser.parse_args()))